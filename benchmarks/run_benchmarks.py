@@ -0,0 +1,326 @@
+"""
+Times the parts of Megyr that add overhead on top of the MESA and GYRE runs
+themselves, using synthetic outputs and stub star and gyre executables, so
+that it can run offline and without MESA or GYRE installed.
+
+    python benchmarks/run_benchmarks.py --scale small
+    python benchmarks/run_benchmarks.py --scale medium --output results.csv
+    python benchmarks/run_benchmarks.py --baseline results.csv
+
+When a baseline csv from an earlier run is given, the script exits with an
+error if any benchmark is slower than the baseline by more than the given
+tolerance.
+"""
+
+from typing import Any, Callable, Dict, List, Optional
+
+import argparse
+import contextlib
+import io
+import os
+import os.path
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import megyr
+from megyr import oscillations_summary, parameters, profile, util
+
+import synthetic
+
+SCALES: Dict[str, Dict[str, Any]] = {
+    "small": {
+        "num_profiles": 20,
+        "num_zones": 500,
+        "num_columns": 30,
+        "num_summaries": 100,
+        "modes_per_l": 50,
+        "grid_values": [10, 10, 10],
+        "num_masses": 2,
+        "gyre_profiles": 4,
+    },
+    "medium": {
+        "num_profiles": 100,
+        "num_zones": 2000,
+        "num_columns": 60,
+        "num_summaries": 1000,
+        "modes_per_l": 100,
+        "grid_values": [40, 40, 40],
+        "num_masses": 4,
+        "gyre_profiles": 10,
+    },
+    "large": {
+        "num_profiles": 500,
+        "num_zones": 5000,
+        "num_columns": 100,
+        "num_summaries": 5000,
+        "modes_per_l": 200,
+        "grid_values": [100, 100, 100],
+        "num_masses": 8,
+        "gyre_profiles": 25,
+    },
+}
+
+
+class Benchmark:
+    """
+    A function to time, along with a setup function that is run before each
+    repetition, outside of the timing, and returns the arguments to call the
+    function with.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        function: Callable[..., Any],
+        setup: Callable[[], List[Any]] = lambda: [],
+    ) -> None:
+        self.name = name
+        self.function = function
+        self.setup = setup
+
+    def time(self, repeat: int) -> List[float]:
+        timings = []
+        for _ in range(repeat):
+            args = self.setup()
+
+            start = time.perf_counter()
+            self.function(*args)
+            timings.append(time.perf_counter() - start)
+
+        return timings
+
+
+def create_benchmarks(
+    scale: Dict[str, Any], data_dir: str, max_parallel: int
+) -> List[Benchmark]:
+    logs_dir = os.path.join(data_dir, "LOGS")
+    synthetic.write_mesa_logs(
+        logs_dir,
+        scale["num_profiles"],
+        num_zones=scale["num_zones"],
+        num_columns=scale["num_columns"],
+    )
+
+    summaries_dir = os.path.join(data_dir, "summaries")
+    os.makedirs(summaries_dir)
+
+    rng = np.random.default_rng(0)
+    summary_files = []
+    for i in range(scale["num_summaries"]):
+        summary_file = os.path.join(summaries_dir, "summary{}.txt".format(i))
+        synthetic.write_gyre_summary(summary_file, [0, 1, 2], scale["modes_per_l"], rng)
+        summary_files.append(summary_file)
+
+    summaries = [
+        oscillations_summary.read_oscillations_summary_file(f).data
+        for f in summary_files
+    ]
+
+    grid_params: Dict[str, Any] = {
+        "param_{}".format(i): np.linspace(0.0, 1.0, num_values).tolist()
+        for i, num_values in enumerate(scale["grid_values"])
+    }
+
+    run_dir = os.path.join(data_dir, "run")
+
+    def setup_run() -> List[Any]:
+        if os.path.isdir(run_dir):
+            shutil.rmtree(run_dir)
+
+        setup_run_dir(run_dir)
+
+        return []
+
+    return [
+        Benchmark(
+            "read_all_profile_attributes",
+            lambda: profile.read_all_profile_attributes(
+                logs_dir, scale["num_profiles"]
+            ),
+        ),
+        Benchmark(
+            "read_oscillations_summary_file",
+            lambda: [
+                oscillations_summary.read_oscillations_summary_file(f)
+                for f in summary_files
+            ],
+        ),
+        Benchmark(
+            "DataFrameAggregator",
+            lambda: aggregate_summaries(summaries),
+        ),
+        Benchmark(
+            "DataFrameAggregator (streaming)",
+            lambda: aggregate_summaries(
+                summaries, os.path.join(data_dir, "streamed.csv")
+            ),
+        ),
+        Benchmark(
+            "create_grid",
+            lambda: sum(1 for _ in parameters.create_grid(pd.DataFrame(), grid_params)),
+        ),
+        Benchmark(
+            "megyr.run",
+            lambda: run_megyr(run_dir, scale, max_parallel),
+            setup_run,
+        ),
+        Benchmark(
+            "megyr.run (all completed)",
+            lambda: run_megyr(run_dir, scale, max_parallel),
+        ),
+    ]
+
+
+def aggregate_summaries(
+    summaries: List[pd.DataFrame], stream_filepath: Optional[str] = None
+) -> None:
+    aggregator = util.DataFrameAggregator(True, stream_filepath)
+
+    for i, summary in enumerate(summaries):
+        aggregator.append_rows(summary, constants={"profile": i % 100, "l": i % 3})
+
+    if stream_filepath is None:
+        aggregator.data
+    else:
+        aggregator.write_to_file(stream_filepath)
+
+
+def setup_run_dir(run_dir: str) -> None:
+    os.makedirs(run_dir)
+
+    for template in ["inlist.mustache", "gyre.in.mustache"]:
+        shutil.copy(os.path.join(BENCHMARKS_DIR, "templates", template), run_dir)
+
+
+def run_megyr(run_dir: str, scale: Dict[str, Any], max_parallel: int) -> None:
+    stubs_dir = os.path.join(BENCHMARKS_DIR, "stubs")
+
+    def gyre_params(mesa_params: Dict[str, Any], mesa_data: pd.DataFrame) -> Any:
+        return {
+            "profile": {
+                "type": "every",
+                "then": "profile",
+                "k": max(1, scale["num_profiles"] // scale["gyre_profiles"]),
+            },
+            "l": [0, 1, 2],
+            "n_freq": [scale["modes_per_l"]],
+            "seconds_per_run": [0],
+        }
+
+    config = {
+        "input": {
+            "mesa_configs": ["inlist.mustache"],
+            "gyre_config": "gyre.in.mustache",
+        },
+        "output": {"gyre_oscillations_ad_summary_file": "oscillations_ad.csv"},
+        "settings": {
+            "mesa_star_location": os.path.join(stubs_dir, "star"),
+            "gyre_location": os.path.join(stubs_dir, "gyre"),
+            "max_parallel_mesa": max_parallel,
+            "max_parallel_gyre": max_parallel,
+        },
+        "stages": {
+            "mesa_params": {
+                "initial_mass": np.linspace(1.0, 3.0, scale["num_masses"]).tolist(),
+                "num_profiles": [scale["num_profiles"]],
+                "num_zones": [scale["num_zones"]],
+                "num_columns": [scale["num_columns"]],
+                "seconds_per_profile": [0],
+            },
+            "gyre_params": gyre_params,
+        },
+    }
+
+    previous_dir = os.getcwd()
+    os.chdir(run_dir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            megyr.run(config)
+    finally:
+        os.chdir(previous_dir)
+
+
+def compare_to_baseline(
+    results: pd.DataFrame, baseline: pd.DataFrame, tolerance: float
+) -> List[str]:
+    """
+    Returns the names of the benchmarks whose best time is slower than their
+    best time in the baseline by more than the given fraction.
+    """
+    merged = results.merge(baseline, on="benchmark", suffixes=("", "_baseline"))
+    slower = merged["best"] > merged["best_baseline"] * (1.0 + tolerance)
+
+    return list(merged["benchmark"][slower])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-parallel", type=int, default=1)
+    parser.add_argument(
+        "--only", nargs="+", help="names of the benchmarks to run", default=None
+    )
+    parser.add_argument("--output", help="csv file to write the results to")
+    parser.add_argument("--baseline", help="csv file of earlier results")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="fraction a benchmark may be slower than the baseline",
+    )
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="megyr_benchmarks_")
+    try:
+        print("Generating {} synthetic data in {}".format(args.scale, data_dir))
+        benchmarks = create_benchmarks(SCALES[args.scale], data_dir, args.max_parallel)
+
+        rows = []
+        for benchmark in benchmarks:
+            if args.only is not None and benchmark.name not in args.only:
+                continue
+
+            timings = benchmark.time(args.repeat)
+            rows.append(
+                {
+                    "benchmark": benchmark.name,
+                    "scale": args.scale,
+                    "best": min(timings),
+                    "median": statistics.median(timings),
+                    "repeat": args.repeat,
+                }
+            )
+            print("{:<35} {:10.4f}s".format(benchmark.name, min(timings)))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    results = pd.DataFrame(rows)
+
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+
+    if args.baseline is not None:
+        baseline = pd.read_csv(args.baseline)
+        slower = compare_to_baseline(results, baseline, args.tolerance)
+
+        if len(slower) > 0:
+            sys.exit(
+                "Benchmarks slower than the baseline by more than {:.0%}: {}".format(
+                    args.tolerance, ", ".join(slower)
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+"""
+Generators for synthetic MESA and GYRE output files, in the same fixed width
+formats that MESA and GYRE write, for benchmarking Megyr without needing to
+run either of them.
+"""
+
+from typing import Any, Dict, List, Optional, TextIO
+
+import os
+import os.path
+import time
+
+import numpy as np
+
+# Column widths used by MESA (r15140 and later) and GYRE
+MESA_COLUMN_WIDTH = 40
+GYRE_COLUMN_WIDTH = 25
+
+PROFILE_ATTRIBUTES = [
+    "model_number",
+    "num_zones",
+    "initial_mass",
+    "initial_z",
+    "star_age",
+    "time_step",
+    "Teff",
+    "photosphere_L",
+    "photosphere_r",
+    "center_eta",
+    "center_h1",
+    "center_he3",
+    "center_he4",
+    "star_mass",
+    "star_mdot",
+    "star_mass_h1",
+    "star_mass_he3",
+    "star_mass_he4",
+    "tau_factor",
+    "tau_base",
+    "version_number",
+    "compiler",
+    "date",
+]
+
+PROFILE_COLUMNS = [
+    "zone",
+    "mass",
+    "logR",
+    "logT",
+    "logRho",
+    "logP",
+    "x_mass_fraction_H",
+    "y_mass_fraction_He",
+    "z_mass_fraction_metals",
+    "brunt_N2",
+    "lamb_S",
+    "pressure_scale_height",
+    "gradT",
+    "grada",
+    "gradr",
+]
+
+HISTORY_COLUMNS = [
+    "model_number",
+    "star_age",
+    "star_mass",
+    "log_dt",
+    "num_zones",
+    "log_Teff",
+    "log_L",
+    "log_R",
+    "log_g",
+    "center_h1",
+    "center_he4",
+    "log_center_T",
+    "log_center_Rho",
+]
+
+GYRE_SUMMARY_COLUMNS = [
+    "l",
+    "n_pg",
+    "n_p",
+    "n_g",
+    "Re(freq)",
+    "Im(freq)",
+    "E",
+    "E_p",
+    "E_g",
+    "E_norm",
+]
+
+
+def write_mesa_logs(
+    logs_dir: str,
+    num_profiles: int,
+    num_zones: int = 1000,
+    num_attributes: int = len(PROFILE_ATTRIBUTES),
+    num_columns: int = len(PROFILE_COLUMNS),
+    models_per_profile: int = 10,
+    initial_mass: float = 1.0,
+    seconds_per_profile: float = 0.0,
+    seed: int = 0,
+) -> None:
+    """
+    Writes a synthetic MESA LOGS directory, with a history file, the given
+    number of profiles (each with a GYRE model file), and a profiles index.
+
+    The files are written in the same order that MESA writes them, with the
+    profiles index rewritten after each profile, so the directory can also be
+    read while it is being written. Waits for the given number of seconds
+    before each profile to mimic the time MESA takes to evolve the model.
+    """
+    os.makedirs(logs_dir, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+
+    with open(os.path.join(logs_dir, "history.data"), "w") as history:
+        write_history_header(history, initial_mass)
+
+        model_numbers = []
+        for profile_number in range(1, num_profiles + 1):
+            time.sleep(seconds_per_profile)
+
+            model_number = profile_number * models_per_profile
+            write_history_rows(
+                history,
+                range(model_number - models_per_profile + 1, model_number + 1),
+                initial_mass,
+                rng,
+            )
+            history.flush()
+
+            profile_filepath = os.path.join(
+                logs_dir, "profile{}.data".format(profile_number)
+            )
+            write_profile(
+                profile_filepath,
+                model_number,
+                num_zones,
+                num_attributes,
+                num_columns,
+                initial_mass,
+                rng,
+            )
+            write_gyre_model(profile_filepath + ".GYRE", num_zones, rng)
+
+            model_numbers.append(model_number)
+            write_profiles_index(
+                os.path.join(logs_dir, "profiles.index"), model_numbers
+            )
+
+
+def write_profile(
+    filepath: str,
+    model_number: int,
+    num_zones: int,
+    num_attributes: int,
+    num_columns: int,
+    initial_mass: float,
+    rng: np.random.Generator,
+) -> None:
+    age = model_number * 1.0e7
+
+    known_attributes: Dict[str, Any] = {
+        "model_number": model_number,
+        "num_zones": num_zones,
+        "initial_mass": initial_mass,
+        "initial_z": 0.02,
+        "star_age": age,
+        "star_mass": initial_mass,
+        "version_number": '"r15140"',
+        "compiler": '"gfortran"',
+        "date": '"20210101"',
+    }
+
+    attributes = {
+        name: known_attributes.get(name, rng.uniform(0.0, 1.0))
+        for name in extra_names(PROFILE_ATTRIBUTES, "attribute", num_attributes)
+    }
+
+    names = extra_names(PROFILE_COLUMNS, "column", num_columns)
+    data = rng.uniform(-10.0, 10.0, size=(num_zones, len(names)))
+    data[:, 0] = np.arange(1, num_zones + 1)
+
+    with open(filepath, "w") as f:
+        write_fixed_width_table(f, attributes, names, data, MESA_COLUMN_WIDTH)
+
+
+def write_history_header(f: TextIO, initial_mass: float) -> None:
+    attributes = {
+        "version_number": '"r15140"',
+        "compiler": '"gfortran"',
+        "initial_mass": initial_mass,
+        "initial_z": 0.02,
+        "burn_min1": 50.0,
+        "burn_min2": 1000.0,
+    }
+
+    write_fixed_width_table(
+        f, attributes, HISTORY_COLUMNS, np.empty((0, 0)), MESA_COLUMN_WIDTH
+    )
+
+
+def write_history_rows(
+    f: TextIO, model_numbers: range, initial_mass: float, rng: np.random.Generator
+) -> None:
+    data = rng.uniform(-10.0, 10.0, size=(len(model_numbers), len(HISTORY_COLUMNS)))
+    data[:, 0] = model_numbers
+    data[:, 1] = np.array(model_numbers) * 1.0e7
+    data[:, 2] = initial_mass
+
+    write_fixed_width_rows(f, data, MESA_COLUMN_WIDTH)
+
+
+def write_profiles_index(filepath: str, model_numbers: List[int]) -> None:
+    with open(filepath, "w") as f:
+        f.write(
+            "{:12d} models.    lines hold model number, priority, and profile number.\n".format(
+                len(model_numbers)
+            )
+        )
+
+        for profile_number, model_number in enumerate(model_numbers, start=1):
+            f.write("{:10d}{:10d}{:10d}\n".format(model_number, 1, profile_number))
+
+
+def write_gyre_model(filepath: str, num_zones: int, rng: np.random.Generator) -> None:
+    """
+    Writes a file in the shape of a GYRE stellar model. The values are random,
+    since only the stub GYRE reads them.
+    """
+    data = rng.uniform(0.0, 1.0, size=(num_zones, 18))
+    data[:, 0] = np.arange(1, num_zones + 1)
+
+    with open(filepath, "w") as f:
+        f.write("{:6d}{:26.16E}{:26.16E}{:26.16E}{:6d}\n".format(num_zones, 1, 1, 1, 1))
+        np.savetxt(f, data, fmt="%6d" + "%26.16E" * 17, delimiter="")
+
+
+def write_gyre_summary(
+    filepath: str,
+    ls: List[int],
+    modes_per_l: int,
+    rng: Optional[np.random.Generator] = None,
+) -> None:
+    """
+    Writes a synthetic GYRE summary file with the given number of modes for
+    each of the given harmonic degrees.
+    """
+    rng = rng if rng is not None else np.random.default_rng(0)
+
+    attributes = {
+        "M_star": 1.9890000000000000e33,
+        "R_star": 6.9598000000000000e10,
+        "L_star": 3.8418000000000000e33,
+    }
+
+    data = rng.uniform(
+        0.0, 1.0, size=(len(ls) * modes_per_l, len(GYRE_SUMMARY_COLUMNS))
+    )
+    data[:, 0] = np.repeat(ls, modes_per_l)
+    data[:, 1] = np.tile(np.arange(1, modes_per_l + 1), len(ls))
+    data[:, 2] = data[:, 1]
+    data[:, 3] = 0
+    data[:, 4] = 100.0 * data[:, 1] + data[:, 0]
+
+    with open(filepath, "w") as f:
+        write_fixed_width_table(
+            f,
+            attributes,
+            GYRE_SUMMARY_COLUMNS,
+            data,
+            GYRE_COLUMN_WIDTH,
+            num_int_columns=4,
+        )
+
+
+def write_fixed_width_table(
+    f: TextIO,
+    attributes: Dict[str, Any],
+    names: List[str],
+    data: "np.ndarray[Any, Any]",
+    width: int,
+    num_int_columns: int = 1,
+) -> None:
+    """
+    Writes a table in the format used by MESA and GYRE output files: a header
+    of numbered attribute names and values, a blank line, then numbered column
+    names and the rows of data. The first num_int_columns columns of the data
+    are written as integers.
+    """
+    f.write(format_row(range(1, len(attributes) + 1), width))
+    f.write(format_row(attributes.keys(), width))
+    f.write(format_row([format_value(v) for v in attributes.values()], width))
+    f.write("\n")
+
+    f.write(format_row(range(1, len(names) + 1), width))
+    f.write(format_row(names, width))
+
+    write_fixed_width_rows(f, data, width, num_int_columns)
+
+
+def write_fixed_width_rows(
+    f: TextIO, data: "np.ndarray[Any, Any]", width: int, num_int_columns: int = 1
+) -> None:
+    if data.size == 0:
+        return
+
+    num_int_columns = min(num_int_columns, data.shape[1])
+    row_format = "%{}d".format(width) * num_int_columns + "%{}.16E".format(width) * (
+        data.shape[1] - num_int_columns
+    )
+
+    np.savetxt(f, data, fmt=row_format, delimiter="")
+
+
+def format_row(values: Any, width: int) -> str:
+    return "".join(str(value).rjust(width) for value in values) + "\n"
+
+
+def format_value(value: Any) -> str:
+    if isinstance(value, float):
+        return "{:.16E}".format(value)
+
+    return str(value)
+
+
+def extra_names(names: List[str], kind: str, num: int) -> List[str]:
+    """
+    Returns the given number of names, using the given names first and then
+    numbered extra names.
+
+    >>> extra_names(["zone", "mass"], "column", 4)
+    ['zone', 'mass', 'extra_column_1', 'extra_column_2']
+    """
+    extra = ["extra_{}_{}".format(kind, i) for i in range(1, num - len(names) + 1)]
+
+    return (names + extra)[:num]
+
+
+def read_namelist_values(filepath: str) -> Dict[str, List[str]]:
+    """
+    Reads the "name = value" settings from the given Fortran namelist file,
+    such as a MESA inlist or a GYRE config, ignoring which group they are in.
+    Each name maps to all of the values given for it, in order, with any
+    quotes around string values removed.
+    """
+    values: Dict[str, List[str]] = {}
+    with open(filepath) as f:
+        for line in f:
+            line = line.split("!")[0]
+            if "=" not in line:
+                continue
+
+            name, value = line.split("=", 1)
+            values.setdefault(name.strip(), []).append(value.strip().strip("'\""))
+
+    return values
@@ -1,20 +1,49 @@
-from typing import Any, Callable, cast, Dict, List, Optional, Tuple
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    cast,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 import argparse
+import asyncio
+import concurrent.futures
 import datetime
+import itertools
 import json
+import multiprocessing
 import os.path
 import sys
 
 import pandas as pd
 
+from . import budget
 from . import config_validation
 from . import gyre
+from . import ledger
 from . import mesa
 from . import oscillations_summary
 from . import parameters
+from . import refinement
+from . import resources
+from . import scheduling
+from . import store
+from . import supervision
+from . import tracing
 from . import util
 
+TASK_STORE_DIR_NAME = ".task_store"
+
 
 def run(config: Dict[str, Any]) -> None:
     config_errors = config_validation.validate_config(config)
@@ -29,114 +58,1235 @@ def run(config: Dict[str, Any]) -> None:
 
     util.create_dir(output_dir)
 
-    completed_tasks, completed_filepath = get_completed_tasks(config)
+    trace_file = config["output"].get("trace_file")
+    if trace_file is not None:
+        tracing.start_tracing(os.path.join(output_dir, trace_file))
+
+    templates = list(config["input"]["mesa_configs"])
+    if config_validation.should_run_gyre(config):
+        templates.append(config["input"]["gyre_config"])
+
+    util.preload_templates([os.path.join(work_dir, t) for t in templates])
+
+    completed_tasks = ledger.TaskLedger("completed_tasks.csv")
 
     mesa_params = config["stages"]["mesa_params"]
 
+    grid_refinement = create_refinement(config)
+
     # Get or calculate the mesa param grid
-    if isinstance(mesa_params, dict):
+    mesa_grid: Sequence[Dict[str, Any]]
+    if grid_refinement is not None:
+        mesa_grid = grid_refinement.initial_combs()
+    elif isinstance(mesa_params, dict):
         mesa_grid = parameters.create_grid(pd.DataFrame(), mesa_params)
     else:
         mesa_grid = mesa_params
 
-    for mesa_comb in mesa_grid:
-        print("MESA: " + str(mesa_comb))
+    max_parallel_mesa = cast(int, config["settings"]["max_parallel_mesa"])
+
+    if "total_cores" in config["settings"]:
+        # Created before any workers are forked, so that they all share it
+        budget.set_core_budget(
+            budget.CoreBudget(
+                config["settings"]["total_cores"],
+                len(mesa_grid),
+                max_parallel_mesa,
+                multiprocessing.get_context("fork"),
+            )
+        )
 
-        if config_validation.nested_in(config, ["settings", "mesa_mp_threads"]):
-            util.set_num_mp_threads(config["settings"]["mesa_mp_threads"])
+    try:
+        with tracing.span("run_grid", "megyr"):
+            run_mesa_grid(
+                config,
+                mesa_params,
+                mesa_grid,
+                work_dir,
+                output_dir,
+                completed_tasks,
+                max_parallel_mesa,
+            )
 
-        mesa_dir_name = mesa.create_mesa_dir_name(mesa_comb)
-        logs_dir_name = "LOGS"
+            if grid_refinement is not None:
+                refine_mesa_grid(
+                    config,
+                    mesa_params,
+                    grid_refinement,
+                    mesa_grid,
+                    work_dir,
+                    output_dir,
+                    completed_tasks,
+                    max_parallel_mesa,
+                )
+    finally:
+        budget.set_core_budget(None)
 
-        if task_not_completed(completed_tasks, mesa_dir_name):
-            mesa_task = lambda: mesa.run_mesa(
-                config, mesa_comb, work_dir, output_dir, mesa_dir_name, logs_dir_name
+        summary = tracing.finish_tracing()
+        if summary is not None:
+            util.print_progress(
+                "Time spent in each stage (seconds):\n" + summary.to_string(index=False)
             )
-            run_task(completed_filepath, completed_tasks, mesa_dir_name, mesa_task)
-        else:
-            print("Already completed MESA")
 
-        mesa_data = load_or_collect_mesa_data(
-            config, output_dir, mesa_dir_name, logs_dir_name
+
+def run_mesa_grid(
+    config: Dict[str, Any],
+    mesa_params: Any,
+    mesa_grid: Sequence[Dict[str, Any]],
+    work_dir: str,
+    output_dir: str,
+    completed_tasks: ledger.TaskLedger,
+    max_parallel_mesa: int,
+) -> None:
+    if max_parallel_mesa > 1:
+        run_mesa_grid_in_parallel(
+            config,
+            mesa_params,
+            mesa_grid,
+            work_dir,
+            output_dir,
+            completed_tasks,
+            max_parallel_mesa,
         )
+    else:
+        for mesa_comb in mesa_grid:
+            run_mesa_comb(
+                config,
+                mesa_params,
+                mesa_comb,
+                work_dir,
+                output_dir,
+                completed_tasks,
+            )
+
 
-        # TODO: Add preivously calculated mesa values to "values"
+def create_refinement(config: Dict[str, Any]) -> Optional[refinement.GridRefinement]:
+    """
+    Creates the refinement of the MESA grid set by the "mesa_refine" stage, or
+    returns None if the MESA grid is not set to be refined.
+    """
+    if not config_validation.nested_in(config, ["stages", "mesa_refine"]):
+        return None
 
-        if config_validation.should_run_gyre(config):
-            gyre_params = config["stages"]["gyre_params"](mesa_params, mesa_data)
+    spec = config["stages"]["mesa_refine"]
 
-            gyre_grid = parameters.create_grid(mesa_data, gyre_params)
+    params = parameters.process_params(pd.DataFrame(), config["stages"]["mesa_params"])
 
-            if config_validation.nested_in(config, ["settings", "gyre_mp_threads"]):
-                util.set_num_mp_threads(config["settings"]["gyre_mp_threads"])
+    return refinement.GridRefinement(
+        params,
+        spec.get("params", refinement.refinable_params(params)),
+        spec["tolerance"],
+        spec["budget"],
+        spec.get("max_depth"),
+    )
 
-            record_oscill_ad = config_validation.nested_in(
-                config, ["output", "gyre_oscillations_ad_summary_file"]
+
+def refine_mesa_grid(
+    config: Dict[str, Any],
+    mesa_params: Any,
+    grid_refinement: refinement.GridRefinement,
+    mesa_grid: Sequence[Dict[str, Any]],
+    work_dir: str,
+    output_dir: str,
+    completed_tasks: ledger.TaskLedger,
+    max_parallel_mesa: int,
+) -> None:
+    """
+    Refines the MESA grid, which has already been run, in rounds. Each round
+    finds the metric of each of the MESA runs of the last round, and then runs
+    MESA (and GYRE) for the new combinations that the refinement adds.
+
+    Since the metric is found from the outputs of the runs, re-running Megyr
+    repeats the same rounds without running MESA or GYRE again, and then
+    carries on refining if the budget or tolerance has been changed.
+    """
+    records: List[Dict[str, Any]] = []
+
+    mesa_combs = mesa_grid
+    refinement_round = 0
+    while True:
+        # Runs recorded by worker processes are only in the ledger file
+        completed_tasks.refresh()
+
+        for mesa_comb in mesa_combs:
+            metric = get_refinement_metric(
+                config, mesa_comb, output_dir, completed_tasks
             )
+            grid_refinement.add_metric(mesa_comb, metric)
 
-            oscillations_ad = util.DataFrameAggregator(should_read=record_oscill_ad)
-            for gyre_comb in gyre_grid:
-                print("GYRE: " + str(gyre_comb))
-                gyre_dir_name = "gyre"
-                gyre_prefix = gyre.create_gyre_prefix(gyre_comb)
+            records.append(dict(mesa_comb, round=refinement_round, metric=metric))
 
-                gyre_task_name = mesa_dir_name + "-" + gyre_prefix
+        write_refinement_file(config, output_dir, records)
 
-                ad_output_summary = "summary_" + gyre_prefix + ".txt"
-                ad_output_summary_file = os.path.join(
-                    output_dir, mesa_dir_name, gyre_dir_name, ad_output_summary
-                )
+        mesa_combs = grid_refinement.refine()
+        if len(mesa_combs) == 0:
+            break
+
+        refinement_round += 1
+        util.print_progress(
+            "Refining MESA grid, round {}: {} new combinations".format(
+                refinement_round, len(mesa_combs)
+            )
+        )
 
-                def transform_oscillations(rows: pd.DataFrame) -> pd.DataFrame:
-                    for key in gyre_comb:
-                        v = gyre_comb[key]
+        budget.add_mesa_runs(len(mesa_combs))
 
-                        rows[key] = v
+        run_mesa_grid(
+            config,
+            mesa_params,
+            mesa_combs,
+            work_dir,
+            output_dir,
+            completed_tasks,
+            max_parallel_mesa,
+        )
 
-                    return rows
 
-                read_ad: Callable[[], None] = lambda: oscillations_ad.append_from_file(
-                    filepath=ad_output_summary_file,
-                    read_function=load_ad_summary_file,
-                    transform_func=transform_oscillations,
-                )
+def get_refinement_metric(
+    config: Dict[str, Any],
+    mesa_comb: Dict[str, Any],
+    output_dir: str,
+    completed_tasks: ledger.TaskLedger,
+) -> Optional[float]:
+    """
+    Applies the metric of the "mesa_refine" stage to the results of the MESA
+    run for the given combination. Returns None if the MESA run was not
+    completed, such as if it timed out.
+
+    The metric is given the MESA parameter combination and the MESA profile
+    data. If GYRE is run and its oscillation summaries are aggregated, then the
+    aggregated summary of the MESA run is also passed to it through an
+    additional "oscillations" keyword argument.
+    """
+    mesa_dir_name = mesa.create_mesa_dir_name(mesa_comb)
+    logs_dir_name = "LOGS"
+
+    if not completed_tasks.is_completed(mesa_dir_name):
+        return None
+
+    metric = config["stages"]["mesa_refine"]["metric"]
+
+    mesa_data = load_or_collect_mesa_data(
+        config, output_dir, mesa_dir_name, logs_dir_name
+    )
 
-                if task_not_completed(completed_tasks, gyre_task_name):
-
-                    def gyre_task() -> None:
-                        gyre.run_gyre(
-                            config,
-                            mesa_comb,
-                            mesa_data,
-                            gyre_comb,
-                            work_dir,
-                            output_dir,
-                            mesa_dir_name,
-                            logs_dir_name,
-                            gyre_dir_name,
-                            gyre_prefix,
-                            ad_output_summary,
-                        )
-                        read_ad()
-
-                    run_task(
-                        completed_filepath, completed_tasks, gyre_task_name, gyre_task
-                    )
-                else:
-                    print("Already completed GYRE")
+    if not config_validation.should_run_gyre(config) or not config_validation.nested_in(
+        config, ["output", "gyre_oscillations_ad_summary_file"]
+    ):
+        return cast(Optional[float], metric(mesa_comb, mesa_data))
+
+    oscillations_file = os.path.join(
+        output_dir, mesa_dir_name, config["output"]["gyre_oscillations_ad_summary_file"]
+    )
+    try:
+        oscillations = pd.read_csv(oscillations_file)
+    except pd.errors.EmptyDataError:
+        oscillations = pd.DataFrame()
 
-                    read_ad()
+    return cast(
+        Optional[float], metric(mesa_comb, mesa_data, oscillations=oscillations)
+    )
+
+
+def write_refinement_file(
+    config: Dict[str, Any], output_dir: str, records: List[Dict[str, Any]]
+) -> None:
+    filename = config["output"].get("mesa_refinement_file")
+    if filename is None:
+        return
 
-            if config_validation.nested_in(
-                config, ["output", "gyre_oscillations_ad_summary_file"]
-            ):
-                oscillations_ad_file = os.path.join(
+    pd.DataFrame(records).to_csv(os.path.join(output_dir, filename), index=False)
+
+
+def run_mesa_comb(
+    config: Dict[str, Any],
+    mesa_params: Any,
+    mesa_comb: Dict[str, Any],
+    work_dir: str,
+    output_dir: str,
+    completed_tasks: ledger.TaskLedger,
+) -> None:
+    util.print_progress("MESA: " + str(mesa_comb))
+
+    mesa_dir_name = mesa.create_mesa_dir_name(mesa_comb)
+    logs_dir_name = "LOGS"
+
+    mesa_key = mesa.create_mesa_task_key(config, mesa_comb, work_dir, logs_dir_name)
+
+    task_store = get_task_store(config, output_dir)
+    mesa_outputs = {
+        logs_dir_name: os.path.join(output_dir, mesa_dir_name, logs_dir_name)
+    }
+
+    def mesa_task() -> None:
+        try:
+            mesa.run_mesa(
+                config,
+                mesa_comb,
+                work_dir,
+                output_dir,
+                mesa_dir_name,
+                logs_dir_name,
+                mesa_key,
+            )
+        finally:
+            budget.finish_mesa_run()
+
+        if task_store is not None:
+            task_store.put(mesa_key, mesa_outputs)
+
+    def reuse_mesa_task() -> None:
+        assert task_store is not None
+
+        util.create_dir(os.path.join(output_dir, mesa_dir_name))
+        mesa.create_mesa_configs(
+            config,
+            mesa.extract_additional_values(config, mesa_comb),
+            work_dir,
+            output_dir,
+            mesa_dir_name,
+            logs_dir_name,
+        )
+
+        task_store.get(mesa_key, mesa_outputs)
+
+    if not task_not_completed(completed_tasks, mesa_dir_name, mesa_key):
+        util.print_progress("Already completed MESA")
+        budget.finish_mesa_run()
+    elif task_store is not None and task_store.contains(mesa_key):
+        util.print_progress("Reusing the results of an identical MESA run")
+        budget.finish_mesa_run()
+
+        run_task(completed_tasks, mesa_dir_name, reuse_mesa_task, mesa_key)
+    elif (
+        config_validation.should_run_gyre(config)
+        and config["settings"]["pipeline_gyre"]
+    ):
+        run_mesa_comb_pipelined(
+            config,
+            mesa_params,
+            mesa_comb,
+            work_dir,
+            output_dir,
+            mesa_dir_name,
+            logs_dir_name,
+            completed_tasks,
+            mesa_key,
+            mesa_task,
+        )
+
+        return
+    elif not run_task(completed_tasks, mesa_dir_name, mesa_task, mesa_key, mesa_comb):
+        return
+
+    mesa_data = load_or_collect_mesa_data(
+        config, output_dir, mesa_dir_name, logs_dir_name
+    )
+
+    # TODO: Add preivously calculated mesa values to "values"
+
+    if config_validation.should_run_gyre(config):
+        history = load_mesa_history(config, output_dir, mesa_dir_name, logs_dir_name)
+
+        gyre_params = get_gyre_params(config, mesa_params, mesa_data, history)
+
+        gyre_grid = parameters.create_grid(mesa_data, gyre_params)
+
+        run_gyre_grid(
+            config,
+            mesa_comb,
+            mesa_data,
+            gyre_grid,
+            work_dir,
+            output_dir,
+            mesa_dir_name,
+            logs_dir_name,
+            completed_tasks,
+            mesa_key,
+            history,
+        )
+
+
+def get_gyre_params(
+    config: Dict[str, Any],
+    mesa_params: Any,
+    mesa_data: pd.DataFrame,
+    history: Optional[pd.DataFrame],
+) -> Union[Dict[str, Any], parameters.Sampling]:
+    if history is None:
+        return cast(
+            Union[Dict[str, Any], parameters.Sampling],
+            config["stages"]["gyre_params"](mesa_params, mesa_data),
+        )
+
+    return cast(
+        Union[Dict[str, Any], parameters.Sampling],
+        config["stages"]["gyre_params"](mesa_params, mesa_data, history=history),
+    )
+
+
+def run_mesa_comb_pipelined(
+    config: Dict[str, Any],
+    mesa_params: Any,
+    mesa_comb: Dict[str, Any],
+    work_dir: str,
+    output_dir: str,
+    mesa_dir_name: str,
+    logs_dir_name: str,
+    completed_tasks: ledger.TaskLedger,
+    mesa_key: str,
+    mesa_task: Callable[[], None],
+) -> None:
+    """
+    Runs MESA for one parameter combination while starting GYRE runs on the
+    profiles that MESA has already finished writing.
+
+    While MESA is running, "profiles.index" is polled for new profiles. The
+    "gyre_params" stage is applied to the profiles finished so far and any new
+    GYRE combinations are queued right away. Once MESA finishes, the stage is
+    applied to the full profile data and the remaining combinations are run.
+    Only the combinations in that final grid are included in the oscillation
+    summary. If MESA times out, then the GYRE runs that have not started yet
+    are cancelled and no summary is written.
+    """
+    gyre_futures: Dict[
+        str, "concurrent.futures.Future[List[Optional[pd.DataFrame]]]"
+    ] = {}
+
+    max_parallel_gyre = cast(int, config["settings"]["max_parallel_gyre"])
+    poll_interval = cast(float, config["settings"]["pipeline_poll_interval"])
+
+    mesa_pool = concurrent.futures.ThreadPoolExecutor(1)
+    gyre_pool = concurrent.futures.ThreadPoolExecutor(max_parallel_gyre)
+
+    def queue_gyre_combs(
+        mesa_data: pd.DataFrame, history: Optional[pd.DataFrame]
+    ) -> Sequence[Dict[str, Any]]:
+        gyre_params = get_gyre_params(config, mesa_params, mesa_data, history)
+
+        gyre_grid = parameters.create_grid(mesa_data, gyre_params)
+        batches = gyre.batch_gyre_grid(
+            gyre_grid, config["settings"]["gyre_batch_params"]
+        )
+
+        for batch, gyre_comb in zip(
+            batches, merge_gyre_batches(config, gyre_grid, batches)
+        ):
+            gyre_prefix = gyre.create_gyre_prefix(gyre_comb)
+
+            if gyre_prefix not in gyre_futures:
+                gyre_futures[gyre_prefix] = gyre_pool.submit(
+                    run_gyre_batch,
+                    config,
+                    mesa_comb,
+                    mesa_data,
+                    [gyre_grid[i] for i in batch],
+                    work_dir,
                     output_dir,
                     mesa_dir_name,
-                    config["output"]["gyre_oscillations_ad_summary_file"],
+                    logs_dir_name,
+                    completed_tasks,
+                    mesa_key,
+                    history,
                 )
 
-                oscillations_ad.write_to_file(oscillations_ad_file)
+        return gyre_grid
+
+    try:
+        mesa_future = mesa_pool.submit(
+            run_task,
+            completed_tasks,
+            mesa_dir_name,
+            mesa_task,
+            mesa_key,
+            mesa_comb,
+        )
+
+        finished_data = pd.DataFrame()
+        while True:
+            done, _ = concurrent.futures.wait([mesa_future], timeout=poll_interval)
+            if len(done) > 0:
+                break
+
+            new_data = mesa.get_finished_mesa_data(
+                output_dir, mesa_dir_name, logs_dir_name, len(finished_data)
+            )
+
+            if len(new_data) > 0:
+                try:
+                    partial_history = load_mesa_history(
+                        config,
+                        output_dir,
+                        mesa_dir_name,
+                        logs_dir_name,
+                        in_progress=True,
+                    )
+                except (FileNotFoundError, IndexError):
+                    # MESA has not finished writing the history header yet
+                    continue
+
+                finished_data = pd.concat([finished_data, new_data])
+
+                queue_gyre_combs(finished_data, partial_history)
+
+        if not mesa_future.result():
+            gyre_pool.shutdown(wait=True, cancel_futures=True)
+            return
+
+        mesa_data = load_or_collect_mesa_data(
+            config, output_dir, mesa_dir_name, logs_dir_name
+        )
+
+        history = load_mesa_history(config, output_dir, mesa_dir_name, logs_dir_name)
+
+        gyre_grid = queue_gyre_combs(mesa_data, history)
+
+        batches = gyre.batch_gyre_grid(
+            gyre_grid, config["settings"]["gyre_batch_params"]
+        )
+        batch_prefixes = [
+            gyre.create_gyre_prefix(gyre_comb)
+            for gyre_comb in merge_gyre_batches(config, gyre_grid, batches)
+        ]
+
+        results = iterate_batch_results(
+            batches, lambda b: gyre_futures.pop(batch_prefixes[b]).result()
+        )
+
+        write_oscillations_ad(config, output_dir, mesa_dir_name, gyre_grid, results)
+    except BaseException:
+        gyre_pool.shutdown(wait=True, cancel_futures=True)
+        raise
+    finally:
+        mesa_pool.shutdown(wait=True)
+        gyre_pool.shutdown(wait=True)
+
+
+def run_gyre_grid(
+    config: Dict[str, Any],
+    mesa_comb: Dict[str, Any],
+    mesa_data: pd.DataFrame,
+    gyre_grid: Sequence[Dict[str, Any]],
+    work_dir: str,
+    output_dir: str,
+    mesa_dir_name: str,
+    logs_dir_name: str,
+    completed_tasks: ledger.TaskLedger,
+    mesa_key: str,
+    history: Optional[pd.DataFrame] = None,
+) -> None:
+    """
+    Runs GYRE for each of the GYRE parameter combinations of one MESA run.
+
+    If "max_parallel_gyre" is set to more than one, then that many GYRE runs
+    are performed at the same time, starting with the runs that are expected
+    to take the longest. The oscillation summaries are still aggregated in the
+    order of the grid, so the output does not depend on the order in which the
+    runs are performed.
+
+    Combinations that differ only in the "gyre_batch_params" are run together
+    as one GYRE run, whose oscillation summary is split back up into the
+    results of each combination.
+    """
+    if config["settings"]["engine"] == "asyncio":
+        asyncio.run(
+            run_gyre_grid_async(
+                config,
+                mesa_comb,
+                mesa_data,
+                gyre_grid,
+                work_dir,
+                output_dir,
+                mesa_dir_name,
+                logs_dir_name,
+                completed_tasks,
+                mesa_key,
+                history,
+            )
+        )
+
+        return
+
+    batches = gyre.batch_gyre_grid(gyre_grid, config["settings"]["gyre_batch_params"])
+
+    run_batch: Callable[[int], List[Optional[pd.DataFrame]]] = lambda b: run_gyre_batch(
+        config,
+        mesa_comb,
+        mesa_data,
+        [gyre_grid[i] for i in batches[b]],
+        work_dir,
+        output_dir,
+        mesa_dir_name,
+        logs_dir_name,
+        completed_tasks,
+        mesa_key,
+        history,
+    )
+
+    max_parallel_gyre = cast(int, config["settings"]["max_parallel_gyre"])
+
+    # The results are produced lazily, in grid order, so that each one can be
+    # aggregated and released as soon as it is ready
+    if max_parallel_gyre > 1:
+        order = order_gyre_grid(
+            config,
+            merge_gyre_batches(config, gyre_grid, batches),
+            completed_tasks,
+            mesa_dir_name,
+            mesa_comb,
+        )
+
+        with concurrent.futures.ThreadPoolExecutor(max_parallel_gyre) as pool:
+            futures: Dict[
+                int, "concurrent.futures.Future[List[Optional[pd.DataFrame]]]"
+            ] = {}
+            for b in order:
+                futures[b] = pool.submit(run_batch, b)
+
+            results = iterate_batch_results(batches, lambda b: futures.pop(b).result())
+
+            write_oscillations_ad(config, output_dir, mesa_dir_name, gyre_grid, results)
+    else:
+        results = iterate_batch_results(batches, run_batch)
+
+        write_oscillations_ad(config, output_dir, mesa_dir_name, gyre_grid, results)
+
+
+async def run_gyre_grid_async(
+    config: Dict[str, Any],
+    mesa_comb: Dict[str, Any],
+    mesa_data: pd.DataFrame,
+    gyre_grid: Sequence[Dict[str, Any]],
+    work_dir: str,
+    output_dir: str,
+    mesa_dir_name: str,
+    logs_dir_name: str,
+    completed_tasks: ledger.TaskLedger,
+    mesa_key: str,
+    history: Optional[pd.DataFrame] = None,
+) -> None:
+    """
+    Runs GYRE for each of the GYRE parameter combinations of one MESA run as
+    tasks on an asyncio event loop, with up to "max_parallel_gyre" runs at
+    once.
+
+    Since the GYRE runs are waited on by the event loop rather than by
+    threads, many runs can be performed at once from a single thread. Each
+    task parses its oscillation summary as soon as its run finishes, and the
+    summaries are aggregated in grid order while the later runs are still
+    going. If any run fails, then the runs still going are stopped.
+    """
+    max_parallel_gyre = cast(int, config["settings"]["max_parallel_gyre"])
+    semaphore = asyncio.Semaphore(max_parallel_gyre)
+
+    batches = gyre.batch_gyre_grid(gyre_grid, config["settings"]["gyre_batch_params"])
+
+    async def run_batch(b: int) -> List[Optional[pd.DataFrame]]:
+        async with semaphore:
+            return await run_gyre_batch_async(
+                config,
+                mesa_comb,
+                mesa_data,
+                [gyre_grid[i] for i in batches[b]],
+                work_dir,
+                output_dir,
+                mesa_dir_name,
+                logs_dir_name,
+                completed_tasks,
+                mesa_key,
+                history,
+            )
+
+    order = order_gyre_grid(
+        config,
+        merge_gyre_batches(config, gyre_grid, batches),
+        completed_tasks,
+        mesa_dir_name,
+        mesa_comb,
+    )
+
+    # The GYRE runs wait for cores on their own threads, so that they cannot
+    # starve the event loop of the threads it needs
+    with budget.gyre_wait_executor(max_parallel_gyre):
+        # Tasks start in the order they are created, so the semaphore is acquired
+        # by the longest runs first
+        tasks: Dict[int, "asyncio.Task[List[Optional[pd.DataFrame]]]"] = {}
+        for b in order:
+            tasks[b] = asyncio.create_task(run_batch(b))
+
+        async def results() -> AsyncIterator[Optional[pd.DataFrame]]:
+            batch_results: Dict[int, List[Optional[pd.DataFrame]]] = {}
+            for b, j, is_last in locate_batch_combs(batches):
+                if b not in batch_results:
+                    batch_results[b] = await tasks.pop(b)
+
+                yield batch_results[b][j]
+
+                if is_last:
+                    del batch_results[b]
+
+        try:
+            await write_oscillations_ad_async(
+                config, output_dir, mesa_dir_name, gyre_grid, results()
+            )
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+
+
+def order_gyre_grid(
+    config: Dict[str, Any],
+    gyre_grid: Sequence[Dict[str, Any]],
+    completed_tasks: ledger.TaskLedger,
+    mesa_dir_name: str,
+    mesa_comb: Dict[str, Any],
+) -> Sequence[int]:
+    """
+    Returns the indices of the GYRE combinations (or merged batches of them)
+    of one MESA run in the order to start them in when running them in
+    parallel.
+    """
+    if not config["settings"]["schedule_longest_first"]:
+        return range(len(gyre_grid))
+
+    return scheduling.order_longest_first(
+        gyre_grid,
+        completed_tasks,
+        lambda gyre_comb: create_gyre_task_name(mesa_dir_name, gyre_comb),
+        shared_params=mesa_comb,
+    )
+
+
+def create_gyre_task_name(mesa_dir_name: str, gyre_comb: Dict[str, Any]) -> str:
+    return mesa_dir_name + "-" + gyre.create_gyre_prefix(gyre_comb)
+
+
+def merge_gyre_batches(
+    config: Dict[str, Any],
+    gyre_grid: Sequence[Dict[str, Any]],
+    batches: List[List[int]],
+) -> List[Dict[str, Any]]:
+    return [
+        gyre.merge_gyre_batch(
+            [gyre_grid[i] for i in batch], config["settings"]["gyre_batch_params"]
+        )
+        for batch in batches
+    ]
+
+
+def locate_batch_combs(batches: List[List[int]]) -> List[Tuple[int, int, bool]]:
+    """
+    Returns where the result of each GYRE combination is found, in grid
+    order, as the index of its batch, its index within the batch, and whether
+    it is the last combination of the batch to be reached.
+    """
+    num_combs = sum(len(batch) for batch in batches)
+
+    locations: List[Tuple[int, int, bool]] = [(0, 0, False)] * num_combs
+    for b, batch in enumerate(batches):
+        last = max(batch)
+        for j, i in enumerate(batch):
+            locations[i] = (b, j, i == last)
+
+    return locations
+
+
+def iterate_batch_results(
+    batches: List[List[int]],
+    get_batch_results: Callable[[int], List[Optional[pd.DataFrame]]],
+) -> Iterator[Optional[pd.DataFrame]]:
+    """
+    Yields the result of each GYRE combination in grid order, from the results
+    of the batches that they were run in. The results of each batch are only
+    fetched once its first combination is reached, and are released after its
+    last combination.
+    """
+    batch_results: Dict[int, List[Optional[pd.DataFrame]]] = {}
+    for b, j, is_last in locate_batch_combs(batches):
+        if b not in batch_results:
+            batch_results[b] = get_batch_results(b)
+
+        yield batch_results[b][j]
+
+        if is_last:
+            del batch_results[b]
+
+
+class GyreBatchRun:
+    """
+    The GYRE run for one batch of GYRE parameter combinations of a MESA run,
+    along with the names, key, and outputs used to record, reuse, and read the
+    results of the run.
+
+    Unless "gyre_batch_params" is set, each batch holds a single combination,
+    which is run and recorded on its own.
+    """
+
+    def __init__(
+        self,
+        config: Dict[str, Any],
+        mesa_comb: Dict[str, Any],
+        mesa_data: pd.DataFrame,
+        gyre_combs: List[Dict[str, Any]],
+        work_dir: str,
+        output_dir: str,
+        mesa_dir_name: str,
+        logs_dir_name: str,
+        mesa_key: str,
+        history: Optional[pd.DataFrame] = None,
+    ) -> None:
+        self.config = config
+        self.mesa_comb = mesa_comb
+        self.mesa_data = mesa_data
+        self.gyre_combs = gyre_combs
+        self.work_dir = work_dir
+        self.output_dir = output_dir
+        self.mesa_dir_name = mesa_dir_name
+        self.logs_dir_name = logs_dir_name
+        self.history = history
+
+        self.batch_params = cast(List[str], config["settings"]["gyre_batch_params"])
+        self.gyre_comb = gyre.merge_gyre_batch(gyre_combs, self.batch_params)
+
+        self.gyre_dir_name = "gyre"
+        self.gyre_prefix = gyre.create_gyre_prefix(self.gyre_comb)
+
+        self.task_name = create_gyre_task_name(mesa_dir_name, self.gyre_comb)
+        self.params = dict(mesa_comb, **self.gyre_comb)
+
+        self.ad_output_summary = "summary_" + self.gyre_prefix + ".txt"
+        self.ad_output_summary_file = os.path.join(
+            output_dir, mesa_dir_name, self.gyre_dir_name, self.ad_output_summary
+        )
+
+        if self.is_batched:
+            self.derived = gyre.create_gyre_batch_values(
+                config,
+                mesa_comb,
+                mesa_data,
+                gyre_combs,
+                self.ad_output_summary,
+                history,
+            )
+        else:
+            self.derived = gyre.create_gyre_values(
+                config,
+                mesa_comb,
+                mesa_data,
+                gyre_combs[0],
+                self.ad_output_summary,
+                history,
+            )
+        rendered_config = gyre.render_gyre_config(
+            config,
+            mesa_comb,
+            self.derived,
+            work_dir,
+            logs_dir_name,
+            self.gyre_dir_name,
+        )
+        self.key = gyre.create_gyre_task_key(
+            config,
+            mesa_key,
+            rendered_config,
+            output_dir,
+            mesa_dir_name,
+            self.gyre_dir_name,
+            self.gyre_prefix,
+        )
+
+        self.task_store = get_task_store(config, output_dir)
+        self.outputs = {"summary.txt": self.ad_output_summary_file}
+
+        # Checked before GYRE is run, so that a batch whose summary could not
+        # be split up is never recorded as completed
+        if self.is_batched and config_validation.nested_in(
+            config, ["output", "gyre_oscillations_ad_summary_file"]
+        ):
+            gyre.check_batch_summary_items(
+                rendered_config, self.gyre_combs, self.batch_params
+            )
+
+    @property
+    def is_batched(self) -> bool:
+        return len(self.batch_params) > 0
+
+    def read_ad(self) -> List[Optional[pd.DataFrame]]:
+        """
+        Reads the oscillation summary of the run, returning the rows of each
+        of the GYRE combinations of the batch.
+        """
+        if not config_validation.nested_in(
+            self.config, ["output", "gyre_oscillations_ad_summary_file"]
+        ):
+            return [None] * len(self.gyre_combs)
+
+        rows = load_ad_summary_file(self.ad_output_summary_file)
+        if rows is None or not self.is_batched:
+            return [rows] * len(self.gyre_combs)
+
+        return list(gyre.split_batch_summary(rows, self.gyre_combs, self.batch_params))
+
+    def can_reuse(self) -> bool:
+        return self.task_store is not None and self.task_store.contains(self.key)
+
+    def reuse(self) -> None:
+        assert self.task_store is not None
+
+        util.create_dir(
+            os.path.join(self.output_dir, self.mesa_dir_name, self.gyre_dir_name)
+        )
+        self.task_store.get(self.key, self.outputs)
+
+    def run(self) -> None:
+        self._remove_outputs()
+
+        gyre.run_gyre(
+            self.config,
+            self.mesa_comb,
+            self.mesa_data,
+            self.gyre_comb,
+            self.work_dir,
+            self.output_dir,
+            self.mesa_dir_name,
+            self.logs_dir_name,
+            self.gyre_dir_name,
+            self.gyre_prefix,
+            self.ad_output_summary,
+            history=self.history,
+            derived=self.derived,
+        )
+
+        self._store_outputs()
+
+    async def run_async(self) -> None:
+        self._remove_outputs()
+
+        await gyre.run_gyre_async(
+            self.config,
+            self.mesa_comb,
+            self.mesa_data,
+            self.gyre_comb,
+            self.work_dir,
+            self.output_dir,
+            self.mesa_dir_name,
+            self.logs_dir_name,
+            self.gyre_dir_name,
+            self.gyre_prefix,
+            self.ad_output_summary,
+            history=self.history,
+            derived=self.derived,
+        )
+
+        self._store_outputs()
+
+    def _remove_outputs(self) -> None:
+        # The outputs of an earlier run may be hard linked into the task
+        # store, so they need to be removed rather than overwritten
+        store.remove_outputs(list(self.outputs.values()))
+
+    def _store_outputs(self) -> None:
+        if self.task_store is not None:
+            self.task_store.put(self.key, self.outputs)
+
+
+def run_gyre_batch(
+    config: Dict[str, Any],
+    mesa_comb: Dict[str, Any],
+    mesa_data: pd.DataFrame,
+    gyre_combs: List[Dict[str, Any]],
+    work_dir: str,
+    output_dir: str,
+    mesa_dir_name: str,
+    logs_dir_name: str,
+    completed_tasks: ledger.TaskLedger,
+    mesa_key: str,
+    history: Optional[pd.DataFrame] = None,
+) -> List[Optional[pd.DataFrame]]:
+    gyre_run = GyreBatchRun(
+        config,
+        mesa_comb,
+        mesa_data,
+        gyre_combs,
+        work_dir,
+        output_dir,
+        mesa_dir_name,
+        logs_dir_name,
+        mesa_key,
+        history,
+    )
+
+    util.print_progress("GYRE: " + str(gyre_run.gyre_comb))
+
+    if not task_not_completed(completed_tasks, gyre_run.task_name, gyre_run.key):
+        util.print_progress("Already completed GYRE")
+    elif gyre_run.can_reuse():
+        util.print_progress("Reusing the results of an identical GYRE run")
+
+        run_task(completed_tasks, gyre_run.task_name, gyre_run.reuse, gyre_run.key)
+    elif not run_task(
+        completed_tasks,
+        gyre_run.task_name,
+        gyre_run.run,
+        gyre_run.key,
+        gyre_run.params,
+    ):
+        return [None] * len(gyre_combs)
+
+    return gyre_run.read_ad()
+
+
+async def run_gyre_batch_async(
+    config: Dict[str, Any],
+    mesa_comb: Dict[str, Any],
+    mesa_data: pd.DataFrame,
+    gyre_combs: List[Dict[str, Any]],
+    work_dir: str,
+    output_dir: str,
+    mesa_dir_name: str,
+    logs_dir_name: str,
+    completed_tasks: ledger.TaskLedger,
+    mesa_key: str,
+    history: Optional[pd.DataFrame] = None,
+) -> List[Optional[pd.DataFrame]]:
+    gyre_run = GyreBatchRun(
+        config,
+        mesa_comb,
+        mesa_data,
+        gyre_combs,
+        work_dir,
+        output_dir,
+        mesa_dir_name,
+        logs_dir_name,
+        mesa_key,
+        history,
+    )
+
+    util.print_progress("GYRE: " + str(gyre_run.gyre_comb))
+
+    if not task_not_completed(completed_tasks, gyre_run.task_name, gyre_run.key):
+        util.print_progress("Already completed GYRE")
+    elif gyre_run.can_reuse():
+        util.print_progress("Reusing the results of an identical GYRE run")
+
+        run_task(completed_tasks, gyre_run.task_name, gyre_run.reuse, gyre_run.key)
+    elif not await run_task_async(
+        completed_tasks,
+        gyre_run.task_name,
+        gyre_run.run_async,
+        gyre_run.key,
+        gyre_run.params,
+    ):
+        return [None] * len(gyre_combs)
+
+    return gyre_run.read_ad()
+
+
+def write_oscillations_ad(
+    config: Dict[str, Any],
+    output_dir: str,
+    mesa_dir_name: str,
+    gyre_grid: Sequence[Dict[str, Any]],
+    results: Iterable[Optional[pd.DataFrame]],
+) -> None:
+    """
+    Aggregates the oscillation summaries of the given GYRE runs into one file.
+
+    The results are consumed one at a time, so if they are produced lazily and
+    the summary is streamed, then the summaries never all need to be held in
+    memory at once. Runs without results, such as runs that timed out, are
+    left out of the summary.
+    """
+    oscillations_ad, oscillations_ad_file = create_oscillations_ad_aggregator(
+        config, output_dir, mesa_dir_name
+    )
+
+    # The results are always consumed, since they may be lazily running the
+    # GYRE tasks
+    for gyre_comb, rows in zip(gyre_grid, results):
+        if oscillations_ad is not None and rows is not None:
+            with tracing.span("aggregate_oscillations_summary", "aggregate"):
+                oscillations_ad.append_rows(rows, constants=gyre_comb)
+
+    if oscillations_ad is not None:
+        with tracing.span("write_oscillations_summary", "aggregate"):
+            oscillations_ad.write_to_file(oscillations_ad_file)
+
+
+async def write_oscillations_ad_async(
+    config: Dict[str, Any],
+    output_dir: str,
+    mesa_dir_name: str,
+    gyre_grid: Sequence[Dict[str, Any]],
+    results: AsyncIterator[Optional[pd.DataFrame]],
+) -> None:
+    """
+    Aggregates the oscillation summaries of the given GYRE runs into one file
+    in the same way as write_oscillations_ad, as they are produced by the
+    given asynchronous iterator.
+    """
+    oscillations_ad, oscillations_ad_file = create_oscillations_ad_aggregator(
+        config, output_dir, mesa_dir_name
+    )
+
+    i = 0
+    async for rows in results:
+        if oscillations_ad is not None and rows is not None:
+            with tracing.span("aggregate_oscillations_summary", "aggregate"):
+                oscillations_ad.append_rows(rows, constants=gyre_grid[i])
+
+        i += 1
+
+    if oscillations_ad is not None:
+        with tracing.span("write_oscillations_summary", "aggregate"):
+            oscillations_ad.write_to_file(oscillations_ad_file)
+
+
+def create_oscillations_ad_aggregator(
+    config: Dict[str, Any], output_dir: str, mesa_dir_name: str
+) -> Tuple[Optional[util.DataFrameAggregator], str]:
+    """
+    Creates the aggregator for the oscillation summaries of one MESA run,
+    returning it along with the filepath to write the summaries to. The
+    aggregator is None if the summaries are not set to be recorded.
+    """
+    if not config_validation.nested_in(
+        config, ["output", "gyre_oscillations_ad_summary_file"]
+    ):
+        return None, ""
+
+    oscillations_ad_file = os.path.join(
+        output_dir,
+        mesa_dir_name,
+        config["output"]["gyre_oscillations_ad_summary_file"],
+    )
+
+    stream_filepath = (
+        oscillations_ad_file
+        if config["settings"]["stream_oscillations_summaries"]
+        else None
+    )
+
+    oscillations_ad = util.DataFrameAggregator(
+        should_read=True, stream_filepath=stream_filepath
+    )
+
+    return oscillations_ad, oscillations_ad_file
+
+
+def run_mesa_grid_in_parallel(
+    config: Dict[str, Any],
+    mesa_params: Any,
+    mesa_grid: Sequence[Dict[str, Any]],
+    work_dir: str,
+    output_dir: str,
+    completed_tasks: ledger.TaskLedger,
+    max_workers: int,
+) -> None:
+    """
+    Runs each of the MESA parameter combinations, along with its GYRE sub-grid,
+    on a pool of worker processes.
+
+    The workers are forked and given the config through the pool initializer,
+    so stage functions in the config (including lambdas) never need to be
+    pickled. Only the MESA parameter combinations are sent to the workers. The
+    completed tasks file and the console output are shared between the
+    workers through a lock.
+
+    The combinations that are expected to take the longest are run first, so
+    that a long run is not left running alone at the end of the grid.
+    """
+    mp_context = multiprocessing.get_context("fork")
+    lock = mp_context.Lock()
+
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=mp_context,
+        initializer=init_mesa_worker,
+        initargs=(
+            config,
+            mesa_params,
+            work_dir,
+            output_dir,
+            completed_tasks,
+            lock,
+        ),
+    )
+
+    util.set_output_lock(lock)
+    try:
+        if config["settings"]["schedule_longest_first"]:
+            order = scheduling.order_longest_first(
+                mesa_grid, completed_tasks, mesa.create_mesa_dir_name
+            )
+        else:
+            order = range(len(mesa_grid))
+
+        combs = (mesa_grid[i] for i in order)
+
+        # Only keep a few combinations queued per worker, so that large grids
+        # are not all created and submitted up front
+        futures: Set["concurrent.futures.Future[None]"] = set()
+        while True:
+            for comb in itertools.islice(combs, 2 * max_workers - len(futures)):
+                futures.add(pool.submit(run_mesa_comb_in_worker, comb))
+
+            if len(futures) == 0:
+                break
+
+            done, futures = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                future.result()
+    except BaseException:
+        pool.shutdown(wait=True, cancel_futures=True)
+        raise
+    finally:
+        pool.shutdown(wait=True)
+        util.set_output_lock(None)
+
+
+_mesa_worker_state: Dict[str, Any] = {}
+
+
+def init_mesa_worker(
+    config: Dict[str, Any],
+    mesa_params: Any,
+    work_dir: str,
+    output_dir: str,
+    completed_tasks: ledger.TaskLedger,
+    lock: Any,
+) -> None:
+    _mesa_worker_state.update(
+        config=config,
+        mesa_params=mesa_params,
+        work_dir=work_dir,
+        output_dir=output_dir,
+        completed_tasks=completed_tasks,
+    )
+
+    util.set_output_lock(lock)
+
+
+def run_mesa_comb_in_worker(mesa_comb: Dict[str, Any]) -> None:
+    state = _mesa_worker_state
+
+    try:
+        run_mesa_comb(
+            state["config"],
+            state["mesa_params"],
+            mesa_comb,
+            state["work_dir"],
+            state["output_dir"],
+            state["completed_tasks"],
+        )
+    finally:
+        # Worker processes do not flush their spans when they exit
+        tracing.flush()
 
 
 def handle_config_errors(config_errors: List[str]) -> None:
@@ -151,21 +1301,68 @@ def handle_config_errors(config_errors: List[str]) -> None:
 def load_or_collect_mesa_data(
     config: Dict[str, Any], output_dir: str, mesa_dir_name: str, logs_dir_name: str
 ) -> pd.DataFrame:
-    filename = cast(str, config["output"]["mesa_profile_summary_file"])
+    filename = cast(Optional[str], config["output"]["mesa_profile_summary_file"])
 
-    get_summary_file_name: Callable[[], str] = lambda: os.path.join(
-        output_dir, mesa_dir_name, filename
-    )
+    if filename is None:
+        return mesa.get_mesa_data(config, output_dir, mesa_dir_name, logs_dir_name)
+
+    summary_file = os.path.join(output_dir, mesa_dir_name, filename)
+    sources_file = summary_file + ".sources.csv"
 
-    if filename is not None and os.path.isfile(get_summary_file_name()):
-        rows = pd.read_csv(get_summary_file_name())
+    sources: Optional[pd.DataFrame] = None
+    if os.path.isfile(summary_file):
+        rows = pd.read_csv(summary_file)
+
+        if not config["settings"]["refresh_mesa_profile_summary"]:
+            return rows
+
+        if os.path.isfile(sources_file):
+            sources = pd.read_csv(sources_file)
     else:
-        rows = mesa.get_mesa_data(config, output_dir, mesa_dir_name, logs_dir_name)
+        rows = pd.DataFrame({"profile": []})
+        sources = pd.DataFrame({"profile": [], "size": [], "mtime_ns": []})
 
-        if filename is not None:
-            rows.to_csv(get_summary_file_name(), index=False)
+    try:
+        new_rows, new_sources = mesa.refresh_mesa_data(
+            output_dir, mesa_dir_name, logs_dir_name, rows, sources
+        )
+    except FileNotFoundError:
+        if len(rows) > 0:
+            # The MESA logs have been removed, so the summary is all that is
+            # left of the run
+            return rows
+
+        raise
 
-    return rows
+    if sources is None or not new_sources.equals(sources):
+        new_rows.to_csv(summary_file, index=False)
+        new_sources.to_csv(sources_file, index=False)
+
+    return new_rows
+
+
+def load_mesa_history(
+    config: Dict[str, Any],
+    output_dir: str,
+    mesa_dir_name: str,
+    logs_dir_name: str,
+    in_progress: bool = False,
+) -> Optional[pd.DataFrame]:
+    """
+    Loads the MESA history data to pass to the GYRE stages, if they are set to
+    receive it.
+
+    If MESA is still running, then the history is read without using or
+    writing the cache, and any row that is still being written is ignored.
+    """
+    if not config["settings"]["read_mesa_history"]:
+        return None
+
+    columns = config["settings"].get("mesa_history_columns")
+
+    return mesa.get_mesa_history(
+        output_dir, mesa_dir_name, logs_dir_name, columns, in_progress
+    )
 
 
 def load_oscillations_file(
@@ -205,60 +1402,103 @@ def handle_missing_ad_summary(filepath: str) -> None:
     sys.exit(1)
 
 
-def get_completed_tasks(config: Dict[str, Any]) -> Tuple[pd.DataFrame, str]:
-    completed_filepath = "completed_tasks.csv"
+def task_not_completed(
+    completed: ledger.TaskLedger, task_name: str, key: Optional[str] = None
+) -> bool:
+    return not completed.is_completed(task_name, key)
 
-    try:
-        return pd.read_csv(completed_filepath), completed_filepath
-    except FileNotFoundError:
-        completed = pd.DataFrame(
-            {"task_name": [], "start": [], "end": [], "duration": []}
-        )
-
-        completed.to_csv(completed_filepath, index=False)
-
-        return completed, completed_filepath
 
+def get_task_store(
+    config: Dict[str, Any], output_dir: str
+) -> Optional[store.TaskStore]:
+    """
+    Returns the store of task outputs to reuse the results of identical tasks
+    from, or None if reusing results is disabled.
+    """
+    if not config["settings"]["task_store"]:
+        return None
 
-def task_not_completed(completed: pd.DataFrame, task_name: str) -> bool:
-    return task_name not in list(completed["task_name"])
+    return store.TaskStore(os.path.join(output_dir, TASK_STORE_DIR_NAME))
 
 
 def run_task(
-    filepath: str,
-    completed: pd.DataFrame,
+    completed: ledger.TaskLedger,
     task_name: str,
     task_function: Callable[[], None],
-) -> None:
+    key: str = "",
+    params: Optional[Dict[str, Any]] = None,
+) -> bool:
+    """
+    Runs the given task and records it in the ledger. Returns False if the
+    task was stopped for going over its time limits, in which case it is
+    recorded as timed out rather than completed.
+    """
     start = datetime.datetime.now()
-    task_function()
+    status = ledger.COMPLETED
+    with resources.collect_usage() as usage:
+        try:
+            task_function()
+        except supervision.TaskTimeoutError as e:
+            status = handle_task_timeout(task_name, e)
     end = datetime.datetime.now()
 
-    duration = (end - start).seconds
+    record_task(completed, task_name, start, end, usage, key, params, status)
 
-    new_row = pd.DataFrame(
-        {
-            "task_name": [task_name],
-            "start": [start],
-            "end": [end],
-            "duration": [duration],
-        }
-    )
+    return status == ledger.COMPLETED
 
-    completed = pd.concat([completed, new_row])
 
-    # completed.append(
-    #     pd.DataFrame(
-    #         {
-    #             "task_name": [task_name],
-    #             "start": [start],
-    #             "end": [end],
-    #             "duration": [duration],
-    #         }
-    #     )
-    # )
+async def run_task_async(
+    completed: ledger.TaskLedger,
+    task_name: str,
+    task_function: Callable[[], Awaitable[None]],
+    key: str = "",
+    params: Optional[Dict[str, Any]] = None,
+) -> bool:
+    start = datetime.datetime.now()
+    status = ledger.COMPLETED
+    with resources.collect_usage() as usage:
+        try:
+            await task_function()
+        except supervision.TaskTimeoutError as e:
+            status = handle_task_timeout(task_name, e)
+    end = datetime.datetime.now()
+
+    record_task(completed, task_name, start, end, usage, key, params, status)
+
+    return status == ledger.COMPLETED
+
+
+def handle_task_timeout(task_name: str, error: supervision.TaskTimeoutError) -> str:
+    util.print_progress("Stopped {}, which {}".format(task_name, error))
 
-    with open(filepath, "a") as f:
-        new_row_contents = ",".join([task_name, str(start), str(end), str(duration)])
+    return ledger.TIMED_OUT
 
-        f.write(new_row_contents + "\n")
+
+def record_task(
+    completed: ledger.TaskLedger,
+    task_name: str,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    usage: resources.ResourceUsage,
+    key: str = "",
+    params: Optional[Dict[str, Any]] = None,
+    status: str = ledger.COMPLETED,
+) -> None:
+    duration = (end - start).total_seconds()
+
+    completed.record(
+        task_name,
+        {
+            "start": str(start),
+            "end": str(end),
+            "duration": str(duration),
+            "key": key,
+            "params": (
+                json.dumps(params, sort_keys=True, default=str)
+                if params is not None
+                else ""
+            ),
+            **usage.to_record(),
+            "status": status,
+        },
+    )
@@ -0,0 +1,334 @@
+from typing import Any, AsyncIterator, Iterator, Optional
+
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import multiprocessing
+
+from . import tracing
+
+# The core budget shared by all of the MESA and GYRE runs, if one is set
+_core_budget: Optional["CoreBudget"] = None
+
+# Executor that GYRE runs on an event loop wait for cores on, if one is set
+_wait_executor: contextvars.ContextVar[
+    Optional[concurrent.futures.ThreadPoolExecutor]
+] = contextvars.ContextVar("wait_executor", default=None)
+
+
+class CoreBudget:
+    """
+    A budget of CPU cores that is shared between all of the MESA and GYRE runs
+    being performed at once, including those in forked worker processes.
+
+    Each run reserves a number of cores before it starts, and the number of
+    Open MP threads that it is given is the number of cores that it reserved,
+    so the total number of threads in use never goes over the budget.
+
+    MESA runs are given a fair share of the budget based on how many MESA runs
+    can still be running at once, so when only a few MESA runs are left they
+    are each given more threads. Since MESA runs take much longer than GYRE
+    runs, a MESA run waits for cores held by GYRE runs to be freed so that it
+    can get its full share, and no new GYRE runs are started while it waits.
+    MESA runs never wait on each other, so if there are more MESA runs at once
+    than cores, the extra runs are each given a single core over the budget.
+    GYRE runs are given a fixed number of threads, so they fan out over any
+    cores that MESA is not using.
+    """
+
+    def __init__(
+        self,
+        total_cores: int,
+        num_mesa_runs: int,
+        max_parallel_mesa: int,
+        mp_context: Optional[Any] = None,
+    ) -> None:
+        assert total_cores > 0
+
+        context = mp_context if mp_context is not None else multiprocessing
+
+        self.total_cores = total_cores
+        self.max_parallel_mesa = max_parallel_mesa
+
+        self._condition = context.Condition()
+        self._free_cores = context.Value("i", total_cores, lock=False)
+        self._mesa_cores = context.Value("i", 0, lock=False)
+        self._waiting_mesa_runs = context.Value("i", 0, lock=False)
+        self._remaining_mesa_runs = context.Value("i", num_mesa_runs, lock=False)
+
+    @property
+    def free_cores(self) -> int:
+        with self._condition:
+            return int(self._free_cores.value)
+
+    def mesa_share(self, max_cores: Optional[int] = None) -> int:
+        """
+        Returns the number of cores to give to a MESA run that is starting
+        now, which is an even split of the budget between the MESA runs that
+        can still be running at once, up to the given maximum.
+
+        >>> budget = CoreBudget(16, num_mesa_runs=10, max_parallel_mesa=4)
+        >>> budget.mesa_share()
+        4
+        >>> for _ in range(9):
+        ...     budget.finish_mesa_run()
+        >>> budget.mesa_share()
+        16
+        >>> budget.mesa_share(max_cores=8)
+        8
+        """
+        with self._condition:
+            remaining = int(self._remaining_mesa_runs.value)
+
+        num_running = max(1, min(self.max_parallel_mesa, remaining))
+        share = max(1, self.total_cores // num_running)
+
+        return min(share, max_cores) if max_cores is not None else share
+
+    def finish_mesa_run(self) -> None:
+        with self._condition:
+            self._remaining_mesa_runs.value -= 1
+
+    def add_mesa_runs(self, num_mesa_runs: int) -> None:
+        with self._condition:
+            self._remaining_mesa_runs.value += num_mesa_runs
+
+    @contextlib.contextmanager
+    def reserve_mesa(self, max_cores: Optional[int] = None) -> Iterator[int]:
+        """
+        Reserves the share of cores for a MESA run for as long as the context
+        is open, yielding the number of cores that were reserved.
+
+        The run waits for cores held by GYRE runs to be freed, but not for
+        cores held by other MESA runs, so it may be given less than its share.
+        If other MESA runs already hold every core, then the run starts right
+        away with a single core over the budget.
+
+        >>> budget = CoreBudget(4, num_mesa_runs=2, max_parallel_mesa=2)
+        >>> with budget.reserve_mesa() as cores:
+        ...     with budget.reserve_gyre(4) as gyre_cores:
+        ...         (cores, gyre_cores, budget.free_cores)
+        (2, 2, 0)
+        >>> budget.free_cores
+        4
+        >>> budget = CoreBudget(1, num_mesa_runs=2, max_parallel_mesa=2)
+        >>> with budget.reserve_mesa() as cores:
+        ...     with budget.reserve_mesa() as other_cores:
+        ...         (cores, other_cores, budget.free_cores)
+        (1, 1, -1)
+        """
+        share = self.mesa_share(max_cores)
+
+        def available() -> int:
+            return min(share, self.total_cores - int(self._mesa_cores.value))
+
+        with self._condition:
+            self._waiting_mesa_runs.value += 1
+            try:
+                with tracing.span("wait_for_cores", "budget"):
+                    self._condition.wait_for(
+                        lambda: available() <= 0
+                        or self._free_cores.value >= available()
+                    )
+            finally:
+                self._waiting_mesa_runs.value -= 1
+
+            cores = max(1, available())
+            self._free_cores.value -= cores
+            self._mesa_cores.value += cores
+
+            self._condition.notify_all()
+
+        try:
+            yield cores
+        finally:
+            with self._condition:
+                self._free_cores.value += cores
+                self._mesa_cores.value -= cores
+
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def reserve_gyre(self, max_cores: int) -> Iterator[int]:
+        """
+        Reserves up to the given number of cores for a GYRE run for as long as
+        the context is open, yielding the number of cores that were reserved.
+
+        The run waits until at least one core is free and no MESA runs are
+        waiting for cores.
+        """
+        cores = self.acquire_gyre(max_cores)
+        try:
+            yield cores
+        finally:
+            self.release_gyre(cores)
+
+    def acquire_gyre(self, max_cores: int) -> int:
+        """
+        Waits for cores for a GYRE run in the same way as reserve_gyre,
+        returning the number of cores that were reserved. The cores must be
+        given back with release_gyre.
+        """
+        with self._condition:
+            with tracing.span("wait_for_cores", "budget"):
+                self._condition.wait_for(
+                    lambda: self._free_cores.value > 0
+                    and self._waiting_mesa_runs.value == 0
+                )
+
+            cores = min(max(1, max_cores), int(self._free_cores.value))
+            self._free_cores.value -= cores
+
+        return cores
+
+    def release_gyre(self, cores: int) -> None:
+        """
+        Gives back the cores reserved for a GYRE run. This never waits for
+        other runs, so it is safe to call from an event loop.
+        """
+        with self._condition:
+            self._free_cores.value += cores
+
+            self._condition.notify_all()
+
+
+def set_core_budget(core_budget: Optional[CoreBudget]) -> None:
+    global _core_budget
+
+    _core_budget = core_budget
+
+
+def core_budget() -> Optional[CoreBudget]:
+    return _core_budget
+
+
+def finish_mesa_run() -> None:
+    """
+    Marks one of the MESA runs as finished (or skipped), so that the remaining
+    MESA runs can be given a larger share of the core budget.
+    """
+    if _core_budget is not None:
+        _core_budget.finish_mesa_run()
+
+
+def add_mesa_runs(num_mesa_runs: int) -> None:
+    """
+    Adds to the number of MESA runs left to perform, such as when new runs are
+    added to the grid, so that the share of the core budget given to each
+    MESA run accounts for them.
+    """
+    if _core_budget is not None:
+        _core_budget.add_mesa_runs(num_mesa_runs)
+
+
+@contextlib.contextmanager
+def reserve_mesa_threads(num_threads: Optional[int]) -> Iterator[Optional[int]]:
+    """
+    Reserves cores from the core budget for a MESA run, yielding the number of
+    threads that the run should use.
+
+    If no core budget is set, then the given number of threads is used as-is.
+    Otherwise the run is given its share of the budget, using the given number
+    of threads as the maximum.
+    """
+    if _core_budget is None:
+        yield num_threads
+        return
+
+    with _core_budget.reserve_mesa(num_threads) as cores:
+        yield cores
+
+
+@contextlib.contextmanager
+def reserve_gyre_threads(num_threads: Optional[int]) -> Iterator[Optional[int]]:
+    """
+    Reserves cores from the core budget for a GYRE run, yielding the number of
+    threads that the run should use.
+
+    If no core budget is set, then the given number of threads is used as-is.
+    Otherwise the run is given up to the given number of threads, or a
+    single thread if no number is given.
+    """
+    if _core_budget is None:
+        yield num_threads
+        return
+
+    with _core_budget.reserve_gyre(
+        num_threads if num_threads is not None else 1
+    ) as cores:
+        yield cores
+
+
+@contextlib.contextmanager
+def gyre_wait_executor(max_parallel_gyre: int) -> Iterator[None]:
+    """
+    Gives the GYRE runs started on the event loop in the current context a
+    dedicated executor to wait for cores on, with a thread for each of the
+    "max_parallel_gyre" runs that can be waiting at once.
+
+    Since the waiting runs have their own threads, they can never take all of
+    the threads of the default executor of the event loop and starve the work
+    that would free up cores.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_parallel_gyre, thread_name_prefix="wait_for_cores"
+    )
+
+    token = _wait_executor.set(executor)
+    try:
+        yield
+    finally:
+        _wait_executor.reset(token)
+
+        # Waits that were cancelled while running release their cores once
+        # they get them, so they do not need to be waited on here
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+@contextlib.asynccontextmanager
+async def reserve_gyre_threads_async(
+    num_threads: Optional[int],
+) -> AsyncIterator[Optional[int]]:
+    """
+    Reserves cores for a GYRE run in the same way as reserve_gyre_threads,
+    without blocking the event loop while waiting for cores to be freed.
+
+    Since the core budget is shared with other processes through locks, the
+    waiting is done on the executor given by gyre_wait_executor, or on a
+    thread of its own if there is none. The cores are given back directly on
+    the event loop, since that never waits.
+    """
+    core_budget = _core_budget
+    if core_budget is None:
+        yield num_threads
+        return
+
+    max_cores = num_threads if num_threads is not None else 1
+
+    executor = _wait_executor.get()
+    if executor is None:
+        own_executor = concurrent.futures.ThreadPoolExecutor(1)
+        waiting = own_executor.submit(core_budget.acquire_gyre, max_cores)
+        own_executor.shutdown(wait=False)
+    else:
+        waiting = executor.submit(core_budget.acquire_gyre, max_cores)
+
+    def release_reserved(
+        reserved: "concurrent.futures.Future[int]",
+    ) -> None:
+        if not reserved.cancelled() and reserved.exception() is None:
+            core_budget.release_gyre(reserved.result())
+
+    try:
+        cores = await asyncio.wrap_future(waiting)
+    except asyncio.CancelledError:
+        # A wait that has already started cannot be interrupted, so the cores
+        # are given back as soon as it gets them
+        waiting.add_done_callback(release_reserved)
+        raise
+
+    try:
+        yield cores
+    finally:
+        core_budget.release_gyre(cores)
@@ -1,4 +1,18 @@
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
+
+import re
+
+# Ways that MESA and GYRE runs can be performed, see the "engine" setting
+ENGINES = ["threads", "asyncio"]
+
+# Settings that limit how long each MESA or GYRE run may take, in seconds
+TIMEOUT_SETTINGS = [
+    "mesa_timeout",
+    "mesa_cpu_timeout",
+    "mesa_stall_timeout",
+    "gyre_timeout",
+    "gyre_cpu_timeout",
+]
 
 
 def validate_config(config: Dict[str, Any]) -> List[str]:
@@ -21,6 +35,94 @@ def validate_config(config: Dict[str, Any]) -> List[str]:
         '[no_mesa_configs] Could not find "mesa_configs" setting in "input" section in config. The "mesa_configs" setting must be present in order to run MESA.',
     )
 
+    for setting in ["max_parallel_mesa", "max_parallel_gyre", "total_cores"]:
+        if nested_in(config, ["settings", setting]):
+            value = config["settings"][setting]
+            assert_to_list(
+                errors,
+                isinstance(value, int) and value >= 1,
+                '[invalid_{}] "{}" setting in "settings" section of config must be a positive integer, but was: {}'.format(
+                    setting, setting, value
+                ),
+            )
+
+    if nested_in(config, ["settings", "mesa_retries"]):
+        value = config["settings"]["mesa_retries"]
+        assert_to_list(
+            errors,
+            isinstance(value, int) and not isinstance(value, bool) and value >= 0,
+            '[invalid_mesa_retries] "mesa_retries" setting in "settings" section of config must be a non-negative integer, but was: {}'.format(
+                value
+            ),
+        )
+
+    if nested_in(config, ["settings", "mesa_retry_backoff"]):
+        value = config["settings"]["mesa_retry_backoff"]
+        assert_to_list(
+            errors,
+            isinstance(value, (int, float))
+            and not isinstance(value, bool)
+            and value >= 0,
+            '[invalid_mesa_retry_backoff] "mesa_retry_backoff" setting in "settings" section of config must be a non-negative number of seconds, but was: {}'.format(
+                value
+            ),
+        )
+
+    for setting in TIMEOUT_SETTINGS:
+        if nested_in(config, ["settings", setting]):
+            value = config["settings"][setting]
+            assert_to_list(
+                errors,
+                isinstance(value, (int, float))
+                and not isinstance(value, bool)
+                and value > 0,
+                '[invalid_{}] "{}" setting in "settings" section of config must be a positive number of seconds, but was: {}'.format(
+                    setting, setting, value
+                ),
+            )
+
+    assert_to_list(
+        errors,
+        not nested_in(config, ["settings", "gyre_stall_timeout"]),
+        '[unsupported_gyre_stall_timeout] "gyre_stall_timeout" setting in "settings" section of config is not supported, since GYRE does not write any progress output that could be watched while it runs. Use "gyre_timeout" or "gyre_cpu_timeout" to limit GYRE runs instead.',
+    )
+
+    if nested_in(config, ["settings", "engine"]):
+        engine = config["settings"]["engine"]
+        assert_to_list(
+            errors,
+            engine in ENGINES,
+            '[invalid_engine] "engine" setting in "settings" section of config must be one of {}, but was: {}'.format(
+                ENGINES, engine
+            ),
+        )
+        assert_to_list(
+            errors,
+            engine != "asyncio"
+            or not nested_in(config, ["settings", "pipeline_gyre"])
+            or not config["settings"]["pipeline_gyre"],
+            '[asyncio_pipeline_gyre] "pipeline_gyre" setting in "settings" section of config cannot be used with the "asyncio" engine.',
+        )
+
+    if nested_in(config, ["settings", "gyre_batch_params"]):
+        value = config["settings"]["gyre_batch_params"]
+        is_valid = isinstance(value, list) and all(
+            isinstance(key, str) for key in value
+        )
+        assert_to_list(
+            errors,
+            is_valid,
+            '[invalid_gyre_batch_params] "gyre_batch_params" setting in "settings" section of config must be a list of GYRE parameter names, but was: {}'.format(
+                value
+            ),
+        )
+
+        if is_valid and should_run_gyre(config):
+            validate_gyre_batch_params(config, errors)
+
+    if nested_in(config, ["stages", "mesa_refine"]):
+        validate_mesa_refine(config, errors)
+
     if should_run_gyre(config):
         assert_to_list(
             errors,
@@ -45,6 +147,41 @@ def validate_config(config: Dict[str, Any]) -> List[str]:
             not nested_in(config, ["settings", "gyre_mp_threads"]),
             gyre_missing_msg.format("gyre_mp_threads", "settings"),
         )
+        assert_to_list(
+            errors,
+            not nested_in(config, ["settings", "read_mesa_history"]),
+            gyre_missing_msg.format("read_mesa_history", "settings"),
+        )
+        assert_to_list(
+            errors,
+            not nested_in(config, ["settings", "pipeline_gyre"]),
+            gyre_missing_msg.format("pipeline_gyre", "settings"),
+        )
+        assert_to_list(
+            errors,
+            not nested_in(config, ["settings", "stream_oscillations_summaries"]),
+            gyre_missing_msg.format("stream_oscillations_summaries", "settings"),
+        )
+        assert_to_list(
+            errors,
+            not nested_in(config, ["settings", "max_parallel_gyre"]),
+            gyre_missing_msg.format("max_parallel_gyre", "settings"),
+        )
+        assert_to_list(
+            errors,
+            not nested_in(config, ["settings", "gyre_timeout"]),
+            gyre_missing_msg.format("gyre_timeout", "settings"),
+        )
+        assert_to_list(
+            errors,
+            not nested_in(config, ["settings", "gyre_cpu_timeout"]),
+            gyre_missing_msg.format("gyre_cpu_timeout", "settings"),
+        )
+        assert_to_list(
+            errors,
+            not nested_in(config, ["settings", "gyre_batch_params"]),
+            gyre_missing_msg.format("gyre_batch_params", "settings"),
+        )
         assert_to_list(
             errors,
             not nested_in(config, ["stages", "gyre_params"]),
@@ -59,6 +196,125 @@ def validate_config(config: Dict[str, Any]) -> List[str]:
     return errors
 
 
+def validate_gyre_batch_params(config: Dict[str, Any], errors: List[str]) -> None:
+    """
+    Checks that each of the batched GYRE parameters is a column of the
+    oscillation summary, since the summary of a batched run is split back up
+    using those columns.
+    """
+    try:
+        with open(config["input"]["gyre_config"], "r") as template_file:
+            template = template_file.read()
+    except OSError:
+        # A missing template is reported when it is loaded
+        return
+
+    summary_items = read_summary_items(template)
+
+    # An item list set through the template cannot be checked until it is
+    # rendered, so it is checked in the rendered config of each batch instead
+    if summary_items is not None and "{{" in ",".join(summary_items):
+        return
+
+    missing = [
+        key
+        for key in config["settings"]["gyre_batch_params"]
+        if summary_items is None or key not in summary_items
+    ]
+    assert_to_list(
+        errors,
+        len(missing) == 0,
+        '[gyre_batch_params_not_in_summary] "gyre_batch_params" setting in "settings" section of config can only contain parameters that are listed in the summary_item_list of the &ad_output section of the GYRE config, since they are used to split up the summary of each batched GYRE run. Batching on other parameters, such as frequency scan settings, is not supported. Parameters not in the summary: {}'.format(
+            missing
+        ),
+    )
+
+
+def read_summary_items(template: str) -> Optional[List[str]]:
+    """
+    Returns the items in the summary_item_list of the &ad_output section of
+    the given GYRE config, or None if it has none.
+
+    >>> read_summary_items("&ad_output\\n  summary_item_list = 'l,n_pg, freq'\\n/")
+    ['l', 'n_pg', 'freq']
+    >>> read_summary_items("&ad_output\\n  summary_file = 'a.txt'\\n/") is None
+    True
+    """
+    section = re.search(
+        r"&ad_output\b(.*?)^\s*/", template, re.DOTALL | re.MULTILINE | re.IGNORECASE
+    )
+    if section is None:
+        return None
+
+    item_list = re.search(
+        r"summary_item_list\s*=\s*['\"]([^'\"]*)['\"]",
+        section.group(1),
+        re.IGNORECASE,
+    )
+    if item_list is None:
+        return None
+
+    return [item.strip() for item in item_list.group(1).split(",")]
+
+
+def validate_mesa_refine(config: Dict[str, Any], errors: List[str]) -> None:
+    refine = config["stages"]["mesa_refine"]
+    mesa_params = config.get("stages", {}).get("mesa_params")
+
+    if not isinstance(refine, dict):
+        assert_to_list(
+            errors,
+            False,
+            '[invalid_mesa_refine] "mesa_refine" setting in "stages" section of config must be a dict, but was: {}'.format(
+                refine
+            ),
+        )
+        return
+
+    assert_to_list(
+        errors,
+        isinstance(mesa_params, dict),
+        '[mesa_refine_needs_param_grid] "mesa_params" setting in "stages" section of config must be a dict of parameter values in order to use "mesa_refine".',
+    )
+    assert_to_list(
+        errors,
+        callable(refine.get("metric")),
+        '[mesa_refine_no_metric] "mesa_refine" setting in "stages" section of config must have a "metric" function.',
+    )
+
+    tolerance = refine.get("tolerance")
+    assert_to_list(
+        errors,
+        isinstance(tolerance, (int, float))
+        and not isinstance(tolerance, bool)
+        and tolerance >= 0,
+        '[invalid_mesa_refine_tolerance] "tolerance" of "mesa_refine" setting in "stages" section of config must be a non-negative number, but was: {}'.format(
+            tolerance
+        ),
+    )
+
+    for key in ["budget", "max_depth"]:
+        if key == "budget" or key in refine:
+            value = refine.get(key)
+            assert_to_list(
+                errors,
+                isinstance(value, int) and not isinstance(value, bool) and value >= 1,
+                '[invalid_mesa_refine_{}] "{}" of "mesa_refine" setting in "stages" section of config must be a positive integer, but was: {}'.format(
+                    key, key, value
+                ),
+            )
+
+    if "params" in refine and isinstance(mesa_params, dict):
+        unknown = [key for key in refine["params"] if key not in mesa_params]
+        assert_to_list(
+            errors,
+            len(unknown) == 0,
+            '[unknown_mesa_refine_params] "params" of "mesa_refine" setting in "stages" section of config must only contain parameters in "mesa_params", but contained: {}'.format(
+                unknown
+            ),
+        )
+
+
 def set_defaults(config: Dict[str, Any]) -> None:
     ### Output
     if not nested_in(config, ["output", "output_dir"]):
@@ -72,14 +328,62 @@ def set_defaults(config: Dict[str, Any]) -> None:
         )
 
     ### Settings
+    if not nested_in(config, ["settings", "refresh_mesa_profile_summary"]):
+        nested_put(config, ["settings", "refresh_mesa_profile_summary"], True)
+
     if not nested_in(config, ["settings", "mesa_star_location"]):
         nested_put(config, ["settings", "mesa_star_location"], "star")
 
     if not nested_in(config, ["settings", "gyre_location"]):
         nested_put(config, ["settings", "gyre_location"], "$GYRE_DIR/bin/gyre")
 
-    if not nested_in(config, ["settings", "gyre_mp_threads"]) and nested_in(
-        config, ["settings", "mesa_mp_threads"]
+    if not nested_in(config, ["settings", "max_parallel_mesa"]):
+        nested_put(config, ["settings", "max_parallel_mesa"], 1)
+
+    if not nested_in(config, ["settings", "max_parallel_gyre"]):
+        # With a core budget, GYRE runs can fan out over all of the cores, as
+        # the budget keeps them from using more cores than are free
+        max_parallel_gyre = config["settings"].get("total_cores", 1)
+        nested_put(config, ["settings", "max_parallel_gyre"], max_parallel_gyre)
+
+    if not nested_in(config, ["settings", "read_mesa_history"]):
+        nested_put(config, ["settings", "read_mesa_history"], False)
+
+    if not nested_in(config, ["settings", "stream_oscillations_summaries"]):
+        nested_put(config, ["settings", "stream_oscillations_summaries"], False)
+
+    if not nested_in(config, ["settings", "schedule_longest_first"]):
+        nested_put(config, ["settings", "schedule_longest_first"], True)
+
+    if not nested_in(config, ["settings", "task_store"]):
+        nested_put(config, ["settings", "task_store"], True)
+
+    if not nested_in(config, ["settings", "engine"]):
+        nested_put(config, ["settings", "engine"], "threads")
+
+    if not nested_in(config, ["settings", "pipeline_gyre"]):
+        nested_put(config, ["settings", "pipeline_gyre"], False)
+
+    if not nested_in(config, ["settings", "pipeline_poll_interval"]):
+        nested_put(config, ["settings", "pipeline_poll_interval"], 5.0)
+
+    if not nested_in(config, ["settings", "gyre_batch_params"]):
+        nested_put(config, ["settings", "gyre_batch_params"], [])
+
+    if not nested_in(config, ["settings", "resume_mesa_from_photos"]):
+        nested_put(config, ["settings", "resume_mesa_from_photos"], True)
+
+    if not nested_in(config, ["settings", "mesa_retries"]):
+        nested_put(config, ["settings", "mesa_retries"], 0)
+
+    if not nested_in(config, ["settings", "mesa_retry_backoff"]):
+        nested_put(config, ["settings", "mesa_retry_backoff"], 60.0)
+
+    # With a core budget, GYRE runs default to a single thread each instead
+    if (
+        not nested_in(config, ["settings", "gyre_mp_threads"])
+        and nested_in(config, ["settings", "mesa_mp_threads"])
+        and not nested_in(config, ["settings", "total_cores"])
     ):
         nested_put(
             config,
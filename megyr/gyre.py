@@ -1,12 +1,19 @@
-from typing import Any, cast, Dict
+from typing import Any, cast, Dict, List, Optional, Sequence
 
 import os.path
 
+import numpy as np
 import pandas as pd
 
+from . import budget
+from . import config_validation
+from . import store
+from . import supervision
+from . import tracing
 from . import util
 
 
+@tracing.traced("run_gyre", "gyre")
 def run_gyre(
     config: Dict[str, Any],
     mesa_comb: Dict[str, Any],
@@ -19,17 +26,115 @@ def run_gyre(
     gyre_dir_name: str,
     gyre_prefix: str,
     gyre_ad_output_summary: str,
+    history: Optional[pd.DataFrame] = None,
+    derived: Optional[Dict[str, Any]] = None,
 ) -> None:
+    gyre_config = setup_gyre_run(
+        config,
+        mesa_comb,
+        mesa_data,
+        gyre_comb,
+        work_dir,
+        output_dir,
+        mesa_dir_name,
+        logs_dir_name,
+        gyre_dir_name,
+        gyre_prefix,
+        gyre_ad_output_summary,
+        history,
+        derived,
+    )
+
+    exec_gyre(
+        config["settings"]["gyre_location"],
+        output_dir,
+        mesa_dir_name,
+        gyre_dir_name,
+        gyre_config,
+        mp_threads=config["settings"].get("gyre_mp_threads"),
+        limits=supervision.task_limits(config, "gyre"),
+    )
+
+
+async def run_gyre_async(
+    config: Dict[str, Any],
+    mesa_comb: Dict[str, Any],
+    mesa_data: pd.DataFrame,
+    gyre_comb: Dict[str, Any],
+    work_dir: str,
+    output_dir: str,
+    mesa_dir_name: str,
+    logs_dir_name: str,
+    gyre_dir_name: str,
+    gyre_prefix: str,
+    gyre_ad_output_summary: str,
+    history: Optional[pd.DataFrame] = None,
+    derived: Optional[Dict[str, Any]] = None,
+) -> None:
+    """
+    Runs GYRE in the same way as run_gyre, without blocking the event loop
+    while GYRE runs. The output of GYRE is written to a log file named after
+    the GYRE prefix in the GYRE directory.
+    """
+    with tracing.span("run_gyre", "gyre"):
+        gyre_config = setup_gyre_run(
+            config,
+            mesa_comb,
+            mesa_data,
+            gyre_comb,
+            work_dir,
+            output_dir,
+            mesa_dir_name,
+            logs_dir_name,
+            gyre_dir_name,
+            gyre_prefix,
+            gyre_ad_output_summary,
+            history,
+            derived,
+        )
+
+        await exec_gyre_async(
+            config["settings"]["gyre_location"],
+            output_dir,
+            mesa_dir_name,
+            gyre_dir_name,
+            gyre_config,
+            mp_threads=config["settings"].get("gyre_mp_threads"),
+            log_filename=gyre_prefix + ".log",
+            limits=supervision.task_limits(config, "gyre"),
+        )
+
+
+def setup_gyre_run(
+    config: Dict[str, Any],
+    mesa_comb: Dict[str, Any],
+    mesa_data: pd.DataFrame,
+    gyre_comb: Dict[str, Any],
+    work_dir: str,
+    output_dir: str,
+    mesa_dir_name: str,
+    logs_dir_name: str,
+    gyre_dir_name: str,
+    gyre_prefix: str,
+    gyre_ad_output_summary: str,
+    history: Optional[pd.DataFrame] = None,
+    derived: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Creates the GYRE directory and the GYRE config file for a GYRE run,
+    returning the name of the config file.
+    """
     mesa_dir = os.path.join(output_dir, mesa_dir_name)
 
     gyre_dir = os.path.join(mesa_dir, gyre_dir_name)
     util.create_dir(gyre_dir)
 
-    derived = extract_additional_values(config, mesa_comb, mesa_data, gyre_comb)
-
-    derived["ad_output_summary_file"] = gyre_ad_output_summary
+    if derived is None:
+        derived = create_gyre_values(
+            config, mesa_comb, mesa_data, gyre_comb, gyre_ad_output_summary, history
+        )
 
-    gyre_config = create_gyre_config(
+    return create_gyre_config(
         config,
         mesa_comb,
         derived,
@@ -41,25 +146,105 @@ def run_gyre(
         gyre_dir_name,
     )
 
-    exec_gyre(
-        config["settings"]["gyre_location"],
-        output_dir,
-        mesa_dir_name,
-        gyre_dir_name,
-        gyre_config,
+
+def create_gyre_values(
+    config: Dict[str, Any],
+    mesa_comb: Dict[str, Any],
+    mesa_data: pd.DataFrame,
+    gyre_comb: Dict[str, Any],
+    gyre_ad_output_summary: str,
+    history: Optional[pd.DataFrame] = None,
+) -> Dict[str, Any]:
+    """
+    Creates the values to render the GYRE config template with for the given
+    GYRE run.
+    """
+    derived = extract_additional_values(
+        config, mesa_comb, mesa_data, gyre_comb, history
     )
 
+    derived["ad_output_summary_file"] = gyre_ad_output_summary
+
+    return derived
+
+
+def create_gyre_batch_values(
+    config: Dict[str, Any],
+    mesa_comb: Dict[str, Any],
+    mesa_data: pd.DataFrame,
+    gyre_combs: List[Dict[str, Any]],
+    gyre_ad_output_summary: str,
+    history: Optional[pd.DataFrame] = None,
+) -> Dict[str, Any]:
+    """
+    Creates the values to render the GYRE config template with for a GYRE run
+    of a batch of GYRE combinations.
+    """
+    members = [
+        create_gyre_values(
+            config, mesa_comb, mesa_data, gyre_comb, gyre_ad_output_summary, history
+        )
+        for gyre_comb in gyre_combs
+    ]
+
+    return combine_batch_values(members, config["settings"]["gyre_batch_params"])
+
+
+def combine_batch_values(
+    members: List[Dict[str, Any]], batch_params: List[str]
+) -> Dict[str, Any]:
+    """
+    Combines the template values of each GYRE combination in a batch. The
+    values that are the same for every combination are kept at the top level,
+    apart from the batched parameters, and the values of each combination are
+    listed under "batch", each with a "batch_tag" to tag its modes with.
+
+    >>> values = combine_batch_values( \
+            [{"profile": 2, "l": 0}, {"profile": 2, "l": 1}], ["l"])
+    >>> values["profile"], "l" in values
+    (2, False)
+    >>> [(member["l"], member["batch_tag"]) for member in values["batch"]]
+    [(0, 'batch_1'), (1, 'batch_2')]
+    """
+    values = {
+        key: value
+        for key, value in members[0].items()
+        if key not in batch_params
+        and all(key in member and same_value(member[key], value) for member in members)
+    }
+
+    values["batch"] = [
+        dict(member, batch_tag="batch_{}".format(i + 1))
+        for i, member in enumerate(members)
+    ]
+
+    return values
+
+
+def same_value(a: Any, b: Any) -> bool:
+    try:
+        return bool(a == b)
+    except ValueError:
+        # Arrays have no single truth value, so are treated as differing
+        return False
+
 
 def extract_additional_values(
     config: Dict[str, Any],
     mesa_comb: Dict[str, Any],
     mesa_data: pd.DataFrame,
     gyre_comb: Dict[str, Any],
+    history: Optional[pd.DataFrame] = None,
 ) -> Dict[str, Any]:
     if "gyre_derived" in config["stages"]:
+        gyre_derived = config["stages"]["gyre_derived"]
+
+        if history is None:
+            return cast(Dict[str, Any], gyre_derived(mesa_comb, mesa_data, gyre_comb))
+
         return cast(
             Dict[str, Any],
-            config["stages"]["gyre_derived"](mesa_comb, mesa_data, gyre_comb),
+            gyre_derived(mesa_comb, mesa_data, gyre_comb, history=history),
         )
 
     return dict(gyre_comb)
@@ -84,6 +269,117 @@ def create_gyre_prefix(gyre_comb: Dict[str, Any]) -> str:
     return name
 
 
+def batch_gyre_grid(
+    gyre_grid: Sequence[Dict[str, Any]], batch_params: List[str]
+) -> List[List[int]]:
+    """
+    Groups the indices of the given GYRE combinations into batches to run with
+    one GYRE run each. The combinations in a batch differ only in the given
+    batched parameters. Without any batched parameters, each combination is
+    run on its own.
+
+    >>> grid = [{"profile": p, "l": l} for l in [0, 1] for p in [1, 2]]
+    >>> batch_gyre_grid(grid, ["l"])
+    [[0, 2], [1, 3]]
+    >>> batch_gyre_grid(grid, [])
+    [[0], [1], [2], [3]]
+    """
+    batches: Dict[str, List[int]] = {}
+    for i, gyre_comb in enumerate(gyre_grid):
+        shared = {
+            key: value for key, value in gyre_comb.items() if key not in batch_params
+        }
+
+        batches.setdefault(
+            create_gyre_prefix(shared) if len(batch_params) > 0 else str(i), []
+        ).append(i)
+
+    return list(batches.values())
+
+
+def merge_gyre_batch(
+    gyre_combs: List[Dict[str, Any]], batch_params: List[str]
+) -> Dict[str, Any]:
+    """
+    Merges a batch of GYRE combinations into the single combination that
+    identifies the batch, with the values of each batched parameter joined
+    together. A batch of one unbatched combination is left as it is.
+
+    >>> merge_gyre_batch([{"profile": 2, "l": 0}, {"profile": 2, "l": 1}], ["l"])
+    {'profile': 2, 'l': '0-1'}
+    """
+    merged = dict(gyre_combs[0])
+    for key in batch_params:
+        if key in merged:
+            merged[key] = "-".join(str(gyre_comb[key]) for gyre_comb in gyre_combs)
+
+    return merged
+
+
+def check_batch_summary_items(
+    rendered_config: str, gyre_combs: List[Dict[str, Any]], batch_params: List[str]
+) -> None:
+    """
+    Checks that the summary_item_list of the given rendered GYRE config of a
+    batch includes each of the batched parameters, which are needed to split
+    up the summary of the batch. Raises an Exception if it does not.
+
+    >>> config = "&ad_output\\n  summary_item_list = 'l,freq'\\n/"
+    >>> check_batch_summary_items(config, [{"l": 0, "profile": 1}], ["l"])
+    >>> check_batch_summary_items(config, [{"m": 0}], ["m"])
+    Traceback (most recent call last):
+    ...
+    Exception: The summary_item_list of a batched GYRE run must include the batched parameters, but is missing ['m'].
+    """
+    summary_items = config_validation.read_summary_items(rendered_config)
+
+    missing = [
+        key
+        for key in batch_params
+        if key in gyre_combs[0] and (summary_items is None or key not in summary_items)
+    ]
+    if len(missing) > 0:
+        raise Exception(
+            "The summary_item_list of a batched GYRE run must include the batched parameters, but is missing {}.".format(
+                missing
+            )
+        )
+
+
+def split_batch_summary(
+    rows: pd.DataFrame, gyre_combs: List[Dict[str, Any]], batch_params: List[str]
+) -> List[pd.DataFrame]:
+    """
+    Splits the oscillation summary of a batched GYRE run into the rows of each
+    GYRE combination in the batch, by the summary columns of the batched
+    parameters.
+
+    >>> rows = pd.DataFrame({"l": [0, 0, 1, 2], "freq": [1.0, 2.0, 3.0, 4.0]})
+    >>> splits = split_batch_summary(rows, [{"l": 0}, {"l": 1}, {"l": 3}], ["l"])
+    >>> [len(split) for split in splits]
+    [2, 1, 0]
+    """
+    keys = [key for key in batch_params if key in gyre_combs[0]]
+
+    missing = [key for key in keys if key not in rows.columns]
+    if len(missing) > 0:
+        raise Exception(
+            "The oscillation summary of a batched GYRE run is missing the columns {} needed to split it up. Add them to the summary_item_list of the GYRE config.".format(
+                missing
+            )
+        )
+
+    splits = []
+    for gyre_comb in gyre_combs:
+        mask = np.ones(len(rows), dtype=bool)
+        for key in keys:
+            mask &= rows[key].to_numpy() == gyre_comb[key]
+
+        splits.append(rows[mask].reset_index(drop=True))
+
+    return splits
+
+
 def create_gyre_config(
     config: Dict[str, Any],
     mesa_comb: Dict[str, Any],
@@ -98,25 +394,69 @@ def create_gyre_config(
     end = -1 * len(".mustache")
 
     config_file = cast(str, config["input"]["gyre_config"])
-    config_file_in = os.path.join(work_dir, config_file)
 
     config_file_out_name = config_file[:end] + "_" + gyre_prefix
     config_file_out = os.path.join(
         output_dir, mesa_dir_name, gyre_dir_name, config_file_out_name
     )
 
+    applied_contents = render_gyre_config(
+        config, mesa_comb, gyre_comb, work_dir, logs_dir_name, gyre_dir_name
+    )
+
+    with open(config_file_out, "w") as out:
+        out.write(applied_contents)
+
+    return config_file_out_name
+
+
+@tracing.traced("render_gyre_config", "render")
+def render_gyre_config(
+    config: Dict[str, Any],
+    mesa_comb: Dict[str, Any],
+    gyre_comb: Dict[str, Any],
+    work_dir: str,
+    logs_dir_name: str,
+    gyre_dir_name: str,
+) -> str:
+    config_file_in = os.path.join(work_dir, config["input"]["gyre_config"])
+
     data = mesa_comb.copy()
     data["logs_dir"] = logs_dir_name
 
     data.update(gyre_comb)
     data["gyre_dir"] = gyre_dir_name
 
-    applied_contents = util.render_mustache_file(config_file_in, data)
+    return util.render_mustache_file(config_file_in, data)
 
-    with open(config_file_out, "w") as out:
-        out.write(applied_contents)
 
-    return config_file_out_name
+@tracing.traced("create_gyre_task_key", "task")
+def create_gyre_task_key(
+    config: Dict[str, Any],
+    mesa_key: str,
+    rendered_config: str,
+    output_dir: str,
+    mesa_dir_name: str,
+    gyre_dir_name: str,
+    gyre_prefix: str,
+) -> str:
+    """
+    Creates a key identifying the inputs of a GYRE run, made from the key of
+    the MESA run that it uses the models of, its rendered config file, and
+    the GYRE executable.
+
+    The GYRE prefix is removed from the rendered config, so that runs whose
+    configs differ only in the names of their output files get the same key.
+    """
+    gyre_dir = os.path.join(output_dir, mesa_dir_name, gyre_dir_name)
+
+    parts = [
+        mesa_key,
+        store.executable_identity(config["settings"]["gyre_location"], gyre_dir),
+        rendered_config.replace(gyre_prefix, "{{gyre_prefix}}"),
+    ]
+
+    return store.create_task_key(parts)
 
 
 def exec_gyre(
@@ -125,9 +465,42 @@ def exec_gyre(
     mesa_dir_name: str,
     gyre_dir_name: str,
     gyre_config: str,
+    mp_threads: Optional[int] = None,
+    limits: Optional[supervision.TaskLimits] = None,
+) -> None:
+    gyre_dir = os.path.join(output_dir, mesa_dir_name, gyre_dir_name)
+
+    gyre_command = gyre_location + " " + gyre_config
+
+    with budget.reserve_gyre_threads(mp_threads) as num_threads:
+        gyre_env = util.create_mp_threads_env(num_threads)
+
+        with tracing.span("exec_gyre", "gyre", threads=num_threads):
+            util.run_in_dir(gyre_command, gyre_dir, env=gyre_env, limits=limits)
+
+
+async def exec_gyre_async(
+    gyre_location: str,
+    output_dir: str,
+    mesa_dir_name: str,
+    gyre_dir_name: str,
+    gyre_config: str,
+    mp_threads: Optional[int] = None,
+    log_filename: Optional[str] = None,
+    limits: Optional[supervision.TaskLimits] = None,
 ) -> None:
     gyre_dir = os.path.join(output_dir, mesa_dir_name, gyre_dir_name)
 
     gyre_command = gyre_location + " " + gyre_config
 
-    util.run_in_dir(gyre_command, gyre_dir)
+    log_filepath = (
+        os.path.join(gyre_dir, log_filename) if log_filename is not None else None
+    )
+
+    async with budget.reserve_gyre_threads_async(mp_threads) as num_threads:
+        gyre_env = util.create_mp_threads_env(num_threads)
+
+        with tracing.span("exec_gyre", "gyre", threads=num_threads):
+            await util.run_in_dir_async(
+                gyre_command, gyre_dir, gyre_env, log_filepath, limits
+            )
@@ -0,0 +1,158 @@
+from typing import Any, Dict, List, Optional
+
+import os
+import os.path
+import tempfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from . import profile
+from . import tracing
+
+CACHE_SOURCE_KEY = "__source__"
+CACHE_COLUMNS_KEY = "__columns__"
+
+
+@tracing.traced("read_history_file", "parse")
+def read_history_file(
+    filepath: str,
+    columns: Optional[List[str]] = None,
+    attributes_start_row: int = 1,
+    data_start_row: int = 5,
+    remove_restarts: bool = True,
+    complete_rows_only: bool = False,
+) -> "MESAHistory":
+    """
+    Reads in the given MESA history file, decoding only the given columns, or
+    all of the columns if none are given.
+
+    History files have the same fixed width format as profile files, so the
+    file is memory-mapped and parsed in the same way as a MappedMESAProfile.
+
+    If remove_restarts is set, then any rows that were superseded by MESA
+    being restarted from an earlier model are removed. If complete_rows_only
+    is set, then a last row without a line ending is ignored, which is useful
+    when MESA may still be writing to the file.
+    """
+    with profile.MappedMESAProfile(
+        filepath, attributes_start_row, data_start_row, complete_rows_only
+    ) as mapped:
+        to_read = list(mapped.columns) if columns is None else list(columns)
+        if remove_restarts and "model_number" not in to_read:
+            to_read.append("model_number")
+
+        data = mapped.get_columns(to_read)
+        attributes = mapped.attributes
+
+    if remove_restarts:
+        data = remove_restarted_rows(data)
+
+        if columns is not None and "model_number" not in columns:
+            data = data.drop(columns=["model_number"])
+
+    return MESAHistory(attributes, data)
+
+
+def remove_restarted_rows(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Removes rows from history data that were written before MESA was
+    restarted from an earlier model, keeping only the rows of each model from
+    the last time it was run.
+
+    >>> data = pd.DataFrame({"model_number": [1, 2, 3, 2, 3, 4]})
+    >>> list(remove_restarted_rows(data)["model_number"])
+    [1, 2, 3, 4]
+    """
+    model_numbers = data["model_number"].to_numpy()
+    if len(model_numbers) == 0:
+        return data
+
+    # A row is kept only if every later row is for a later model
+    later_min = np.minimum.accumulate(model_numbers[::-1])[::-1]
+    keep = np.append(model_numbers[:-1] < later_min[1:], True)
+
+    return data[keep].reset_index(drop=True)
+
+
+def load_or_read_history_data(
+    filepath: str, cache_filepath: str, columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    """
+    Reads in the data of the given MESA history file, using a cached copy of
+    the data if the history file has not changed since the cache was written.
+
+    The cache stores all of the columns of the history file as a NumPy .npz
+    file, so any set of columns can be loaded from it without parsing the
+    history file again.
+    """
+    stat = os.stat(filepath)
+    source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    if os.path.isfile(cache_filepath):
+        try:
+            with np.load(cache_filepath, allow_pickle=False) as cache:
+                if np.array_equal(cache[CACHE_SOURCE_KEY], source):
+                    to_load = (
+                        list(cache[CACHE_COLUMNS_KEY]) if columns is None else columns
+                    )
+
+                    return pd.DataFrame({column: cache[column] for column in to_load})
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # Unreadable caches are just replaced
+            pass
+
+    data = read_history_file(filepath).data
+
+    write_history_cache(cache_filepath, data, source)
+
+    if columns is not None:
+        data = data[columns]
+
+    return data
+
+
+def write_history_cache(
+    cache_filepath: str, data: pd.DataFrame, source: "np.ndarray[Any, Any]"
+) -> None:
+    arrays: Dict[str, Any] = {
+        str(column): data[column].to_numpy() for column in data.columns
+    }
+    arrays[CACHE_SOURCE_KEY] = source
+    arrays[CACHE_COLUMNS_KEY] = np.array(list(data.columns), dtype=str)
+
+    # Write to a temporary file first so that a partially written cache is
+    # never read
+    cache_dir = os.path.dirname(os.path.abspath(cache_filepath))
+    fd, temp_filepath = tempfile.mkstemp(dir=cache_dir, suffix=".npz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+
+        os.replace(temp_filepath, cache_filepath)
+    except BaseException:
+        os.remove(temp_filepath)
+        raise
+
+
+class MESAHistory:
+    def __init__(self, attributes: pd.DataFrame, data: pd.DataFrame) -> None:
+        self.attributes = attributes
+        self.data = data
+
+    def __str__(self) -> str:
+        return str(self.attributes) + "\n" + str(self.data)
+
+    def get_attribute(self, attr: str) -> Any:
+        if self.has_attribute(attr):
+            return self.attributes[attr].iloc[0]
+        else:
+            raise KeyError(
+                'Attribute "'
+                + attr
+                + '" is not a valid attribute for this MESA history.'
+            )
+
+    def has_attribute(self, attr: str) -> bool:
+        return attr in list(self.attributes.columns.values)
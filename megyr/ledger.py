@@ -0,0 +1,190 @@
+from typing import Dict, Iterator, Optional
+
+import contextlib
+import csv
+import fcntl
+import io
+import os
+import tempfile
+import threading
+
+COLUMNS = [
+    "task_name",
+    "start",
+    "end",
+    "duration",
+    "key",
+    "params",
+    "user_time",
+    "system_time",
+    "max_rss",
+    "read_bytes",
+    "write_bytes",
+    "status",
+]
+
+# Statuses of recorded tasks. Tasks recorded without a status, such as those
+# recorded by older versions of Megyr, were completed.
+COMPLETED = "completed"
+TIMED_OUT = "timed_out"
+
+
+class TaskLedger:
+    """
+    A record of the tasks that have been completed, backed by an append-only
+    csv file.
+
+    Lookups are done against an in-memory index of the records, so checking
+    whether a task has been completed does not depend on the number of tasks
+    recorded. Each record is written as a single append while holding an
+    exclusive lock, so many threads and processes can record tasks to the
+    same ledger at once. The lock is taken on a separate "<ledger>.lock" file,
+    which is never replaced, so that it still holds while an old ledger file
+    is being rewritten with new columns.
+
+    Each task can be recorded with a key identifying its inputs, in which
+    case it only counts as completed for that same key.
+
+    Tasks that were stopped for going over their time limits are recorded
+    with a status of TIMED_OUT, and do not count as completed, so they are
+    run again the next time Megyr is run.
+    """
+
+    def __init__(self, filepath: str) -> None:
+        self.filepath = filepath
+        self.records: Dict[str, Dict[str, str]] = {}
+
+        self._columns = list(COLUMNS)
+        self._read_offset = 0
+        self._thread_lock = threading.Lock()
+
+        with self._locked(fcntl.LOCK_EX):
+            self._create_if_missing()
+            self._add_missing_columns()
+
+        self.refresh()
+
+    def __contains__(self, task_name: str) -> bool:
+        return self.is_completed(task_name)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def is_completed(self, task_name: str, key: Optional[str] = None) -> bool:
+        """
+        Returns True if the given task has been recorded as completed. If a
+        key is given, then the task must also have been recorded with the
+        same key. Tasks recorded without a key, such as those recorded by
+        older versions of Megyr, are assumed to match any key.
+        """
+        record = self.records.get(task_name)
+        if record is None:
+            return False
+
+        if record.get("status", "") not in ["", COMPLETED]:
+            return False
+
+        recorded_key = record.get("key", "")
+
+        return key is None or recorded_key == "" or recorded_key == key
+
+    def record(self, task_name: str, values: Dict[str, str]) -> None:
+        """
+        Records the given task, along with the given values for the other
+        columns of the ledger. The task is recorded as completed unless a
+        different status is given in the values.
+        """
+        row = {"status": COMPLETED}
+        row.update(values)
+        row["task_name"] = task_name
+
+        line = io.StringIO()
+        csv.writer(line, lineterminator="\n").writerow(
+            [row.get(column, "") for column in self._columns]
+        )
+
+        with self._locked(fcntl.LOCK_EX):
+            fd = os.open(self.filepath, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, line.getvalue().encode("utf-8"))
+            finally:
+                os.close(fd)
+
+        self.records[task_name] = row
+
+    def refresh(self) -> None:
+        """
+        Reads in any records that have been appended to the ledger file since
+        it was last read, such as those recorded by other processes.
+        """
+        start = self._read_offset
+
+        with self._locked(fcntl.LOCK_SH):
+            with open(self.filepath, "rb") as f:
+                f.seek(start)
+                new_contents = f.read()
+
+        # Only consume complete lines, in case a record is still being written
+        new_contents = new_contents[: new_contents.rfind(b"\n") + 1]
+        self._read_offset += len(new_contents)
+
+        rows = csv.reader(io.StringIO(new_contents.decode("utf-8")))
+        if start == 0:
+            self._columns = next(rows, self._columns)
+
+        for row in rows:
+            if len(row) != len(self._columns):
+                continue
+
+            values = dict(zip(self._columns, row))
+            self.records[values["task_name"]] = values
+
+    def _create_if_missing(self) -> None:
+        try:
+            fd = os.open(self.filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return
+
+        try:
+            os.write(fd, (",".join(COLUMNS) + "\n").encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    def _add_missing_columns(self) -> None:
+        """
+        Rewrites a ledger file written by an older version of Megyr to add any
+        columns that it is missing, leaving them empty in the existing rows.
+
+        The exclusive lock must be held, so that no other process appends to
+        the old file while it is being replaced.
+        """
+        with open(self.filepath, newline="") as f:
+            rows = list(csv.reader(f))
+
+        header = rows[0] if len(rows) > 0 else []
+        missing = [column for column in COLUMNS if column not in header]
+        if len(missing) == 0:
+            return
+
+        fd, temp_filepath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.filepath)), suffix=".csv"
+        )
+        with os.fdopen(fd, "w", newline="") as out:
+            writer = csv.writer(out, lineterminator="\n")
+            writer.writerow(header + missing)
+
+            for row in rows[1:]:
+                if len(row) == len(header):
+                    writer.writerow(row + [""] * len(missing))
+
+        os.replace(temp_filepath, self.filepath)
+
+    @contextlib.contextmanager
+    def _locked(self, operation: int) -> Iterator[None]:
+        with self._thread_lock:
+            with open(self.filepath + ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, operation)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
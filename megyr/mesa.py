@@ -1,13 +1,35 @@
-from typing import Any, cast, Dict
+from typing import Any, cast, Dict, List, Optional, Tuple
 
+import os
 import os.path
+import subprocess
+import time
 
 import pandas as pd
 
+from . import budget
+from . import history
 from . import profile
+from . import store
+from . import supervision
+from . import tracing
 from . import util
 
+MESA_LOG_FILE_NAME = "mesa.log"
 
+# Directory that MESA saves photos to, relative to the MESA run directory
+PHOTOS_DIR_NAME = "photos"
+
+# File that MESA reads the name of the photo to restart from from, if it
+# exists when MESA starts
+RESTART_FILE_NAME = ".restart"
+
+# File in the MESA run directory that records the key of the MESA run that the
+# photos were saved by
+TASK_KEY_FILE_NAME = ".task_key"
+
+
+@tracing.traced("run_mesa", "mesa")
 def run_mesa(
     config: Dict[str, Any],
     comb: Dict[str, Any],
@@ -15,19 +37,143 @@ def run_mesa(
     output_dir: str,
     mesa_dir_name: str,
     logs_dir_name: str,
+    key: str = "",
 ) -> None:
+    """
+    Runs MESA for the given combination of MESA parameter values.
+
+    If "resume_mesa_from_photos" is set and an earlier run with the same key
+    was stopped part way through, then MESA is restarted from the newest
+    photo of that run instead of from the start. If MESA fails, then it is
+    retried up to "mesa_retries" times, restarting from its newest photo each
+    time, waiting "mesa_retry_backoff" seconds before the first retry and
+    twice as long before each retry after that.
+    """
     mesa_dir = os.path.join(output_dir, mesa_dir_name)
     util.create_dir(mesa_dir)
 
-    setup_mesa_dir(output_dir, mesa_dir_name, logs_dir_name)
+    retries = cast(int, config["settings"]["mesa_retries"])
+    backoff = cast(float, config["settings"]["mesa_retry_backoff"])
 
     derived = extract_additional_values(config, comb)
 
-    create_mesa_configs(
-        config, derived, work_dir, output_dir, mesa_dir_name, logs_dir_name
-    )
+    attempt = 0
+    while True:
+        restart_photo = prepare_mesa_run(
+            config, output_dir, mesa_dir_name, logs_dir_name, key
+        )
+        if restart_photo is not None:
+            util.print_progress("Resuming MESA from photo " + restart_photo)
+
+        setup_mesa_dir(output_dir, mesa_dir_name, logs_dir_name)
+
+        create_mesa_configs(
+            config, derived, work_dir, output_dir, mesa_dir_name, logs_dir_name
+        )
+
+        try:
+            exec_mesa(config, work_dir, output_dir, mesa_dir_name, logs_dir_name)
+        except subprocess.CalledProcessError as e:
+            if attempt >= retries:
+                raise
+
+            delay = backoff * 2**attempt
+            util.print_progress(
+                "MESA failed with exit code {}, retrying in {} seconds".format(
+                    e.returncode, delay
+                )
+            )
+            time.sleep(delay)
+
+            attempt += 1
+            continue
+
+        break
+
+    store.remove_outputs([os.path.join(mesa_dir, RESTART_FILE_NAME)])
+
 
-    exec_mesa(config, work_dir, output_dir, mesa_dir_name)
+def prepare_mesa_run(
+    config: Dict[str, Any],
+    output_dir: str,
+    mesa_dir_name: str,
+    logs_dir_name: str,
+    key: str,
+) -> Optional[str]:
+    """
+    Prepares the MESA run directory for a MESA run with the given key,
+    returning the name of the photo that MESA will restart from, or None if
+    MESA will start from the beginning.
+
+    When starting from the beginning, the outputs and photos of any earlier
+    run are removed. When restarting, the earlier logs are kept for MESA to
+    add to, with any files in them that are hard linked into the task store
+    replaced with copies.
+    """
+    mesa_dir = os.path.join(output_dir, mesa_dir_name)
+    logs_dir = os.path.join(mesa_dir, logs_dir_name)
+
+    restart_photo = None
+    if config["settings"]["resume_mesa_from_photos"]:
+        restart_photo = find_restart_photo(mesa_dir, key)
+
+    restart_file = os.path.join(mesa_dir, RESTART_FILE_NAME)
+    if restart_photo is None:
+        # The outputs of an earlier run may be hard linked into the task
+        # store, so they need to be removed rather than overwritten
+        store.remove_outputs(
+            [logs_dir, os.path.join(mesa_dir, PHOTOS_DIR_NAME), restart_file]
+        )
+    else:
+        store.break_links(logs_dir)
+
+        with open(restart_file, "w") as f:
+            f.write(restart_photo + "\n")
+
+    # Record which run any photos saved from now on belong to
+    with open(os.path.join(mesa_dir, TASK_KEY_FILE_NAME), "w") as f:
+        f.write(key + "\n")
+
+    return restart_photo
+
+
+def find_restart_photo(mesa_dir: str, key: str) -> Optional[str]:
+    """
+    Returns the name of the newest photo saved by a MESA run with the given
+    key in the given MESA run directory, or None if there is no such photo.
+
+    Photos are compared by modification time, in the same way as the "re"
+    script that comes with MESA, since photo names wrap around when the
+    photo interval is small.
+    """
+    try:
+        with open(os.path.join(mesa_dir, TASK_KEY_FILE_NAME)) as f:
+            recorded_key = f.read().strip()
+    except FileNotFoundError:
+        return None
+
+    if recorded_key != key:
+        return None
+
+    photos_dir = os.path.join(mesa_dir, PHOTOS_DIR_NAME)
+    try:
+        entries = list(os.scandir(photos_dir))
+    except FileNotFoundError:
+        return None
+
+    photos = []
+    for entry in entries:
+        if entry.name.startswith(".") or not entry.is_file():
+            continue
+
+        stat = entry.stat()
+        if stat.st_size > 0:
+            photos.append((stat.st_mtime_ns, entry.name))
+
+    if len(photos) == 0:
+        return None
+
+    return max(photos)[1]
 
 
 def create_mesa_dir_name(comb: Dict[str, Any]) -> str:
@@ -73,33 +219,101 @@ def create_mesa_configs(
     mesa_dir_name: str,
     logs_dir_name: str,
 ) -> None:
+    rendered = render_mesa_configs(config, comb, work_dir, logs_dir_name)
+
+    for config_file_name, applied_contents in rendered.items():
+        config_file_out = os.path.join(output_dir, mesa_dir_name, config_file_name)
+
+        with open(config_file_out, "w") as out:
+            out.write(applied_contents)
+
+
+@tracing.traced("render_mesa_configs", "render")
+def render_mesa_configs(
+    config: Dict[str, Any], comb: Dict[str, Any], work_dir: str, logs_dir_name: str
+) -> Dict[str, str]:
+    """
+    Renders the MESA config templates for the given combination of values,
+    returning the rendered contents by the name of the config file to write.
+    """
     end = -1 * len(".mustache")
 
+    rendered = {}
     for config_file in config["input"]["mesa_configs"]:
         config_file_in = os.path.join(work_dir, config_file)
-        config_file_out = os.path.join(output_dir, mesa_dir_name, config_file[:end])
 
         data = comb.copy()
         data["logs_dir"] = logs_dir_name
 
-        applied_contents = util.render_mustache_file(config_file_in, data)
+        rendered[config_file[:end]] = util.render_mustache_file(config_file_in, data)
 
-        with open(config_file_out, "w") as out:
-            out.write(applied_contents)
+    return rendered
+
+
+@tracing.traced("create_mesa_task_key", "task")
+def create_mesa_task_key(
+    config: Dict[str, Any], comb: Dict[str, Any], work_dir: str, logs_dir_name: str
+) -> str:
+    """
+    Creates a key identifying the inputs of the MESA run for the given
+    combination of MESA parameter values, made from its rendered config files
+    and the MESA executable. Any change to either gives a different key.
+    """
+    derived = extract_additional_values(config, comb)
+    rendered = render_mesa_configs(config, derived, work_dir, logs_dir_name)
+
+    mesa_command = os.path.join(work_dir, config["settings"]["mesa_star_location"])
+
+    parts = [store.executable_identity(mesa_command)]
+    for config_file_name in sorted(rendered):
+        parts += [config_file_name, rendered[config_file_name]]
+
+    return store.create_task_key(parts)
 
 
 def exec_mesa(
-    config: Dict[str, Any], work_dir: str, output_dir: str, mesa_dir_name: str
+    config: Dict[str, Any],
+    work_dir: str,
+    output_dir: str,
+    mesa_dir_name: str,
+    logs_dir_name: str,
 ) -> None:
     mesa_dir = os.path.join(output_dir, mesa_dir_name)
+    logs_dir = os.path.join(mesa_dir, logs_dir_name)
 
     mesa_command = os.path.abspath(
         os.path.join(work_dir, config["settings"]["mesa_star_location"])
     )
 
-    util.run_in_dir(mesa_command, mesa_dir)
+    mp_threads = config["settings"].get("mesa_mp_threads")
+
+    # The asyncio engine writes the output of each run to a log file, so the
+    # output of parallel runs is not interleaved in the terminal
+    log_filepath = (
+        os.path.join(mesa_dir, MESA_LOG_FILE_NAME)
+        if config["settings"]["engine"] == "asyncio"
+        else None
+    )
+
+    # MESA appends to the history and the profile index as it takes steps and
+    # saves profiles, so a run that stops writing to both has stalled
+    limits = supervision.task_limits(
+        config,
+        "mesa",
+        [
+            os.path.join(logs_dir, "history.data"),
+            os.path.join(logs_dir, "profiles.index"),
+        ],
+    )
+
+    with budget.reserve_mesa_threads(mp_threads) as num_threads:
+        mesa_env = util.create_mp_threads_env(num_threads)
+
+        with tracing.span("exec_mesa", "mesa", threads=num_threads):
+            util.run_in_dir(mesa_command, mesa_dir, mesa_env, log_filepath, limits)
 
 
+@tracing.traced("get_mesa_data", "parse")
 def get_mesa_data(
     config: Dict[str, Any], output_dir: str, mesa_dir_name: str, logs_dir_name: str
 ) -> "pd.DataFrame":
@@ -113,3 +327,116 @@ def get_mesa_data(
     data = profile.read_all_profile_attributes(logs_dir, num_profiles)
 
     return data
+
+
+def get_mesa_history(
+    output_dir: str,
+    mesa_dir_name: str,
+    logs_dir_name: str,
+    columns: Optional[List[str]] = None,
+    in_progress: bool = False,
+) -> "pd.DataFrame":
+    """
+    Gets the data from the history file of a MESA run. The parsed history is
+    cached in the MESA run directory, so it is only parsed once per run.
+
+    If the MESA run is still in progress, then the history is always parsed
+    and the cache is not used.
+    """
+    logs_dir = os.path.join(output_dir, mesa_dir_name, logs_dir_name)
+    history_file = os.path.join(logs_dir, "history.data")
+
+    if in_progress:
+        return history.read_history_file(
+            history_file, columns, complete_rows_only=True
+        ).data
+
+    cache_file = os.path.join(output_dir, mesa_dir_name, "history_cache.npz")
+
+    return history.load_or_read_history_data(history_file, cache_file, columns)
+
+
+@tracing.traced("refresh_mesa_data", "parse")
+def refresh_mesa_data(
+    output_dir: str,
+    mesa_dir_name: str,
+    logs_dir_name: str,
+    rows: "pd.DataFrame",
+    sources: Optional["pd.DataFrame"],
+) -> Tuple["pd.DataFrame", "pd.DataFrame"]:
+    """
+    Updates previously collected MESA profile attributes to match the current
+    profile files of a MESA run, reading in only the profiles that are new or
+    have changed since the attributes were collected. Rows for profiles that
+    no longer exist are dropped.
+
+    The sources record the size and modification time of each profile file
+    at the time that it was read. If no sources are given, then the existing
+    rows are assumed to be up to date.
+
+    Returns the updated rows along with their updated sources.
+    """
+    logs_dir = os.path.join(output_dir, mesa_dir_name, logs_dir_name)
+
+    profile_index_name = "profiles.index"
+    profile_index = os.path.join(logs_dir, profile_index_name)
+
+    num_profiles = profile.read_num_profiles(profile_index)
+
+    current = profile.read_profile_file_stats(logs_dir, range(1, num_profiles + 1))
+
+    if sources is None:
+        sources = current[current["profile"].isin(rows["profile"])]
+
+    compared = current.merge(sources, on="profile", how="left", suffixes=("", "_read"))
+    changed = compared[
+        (compared["size"] != compared["size_read"])
+        | (compared["mtime_ns"] != compared["mtime_ns_read"])
+    ]["profile"]
+
+    kept = rows[(rows["profile"] <= num_profiles) & ~rows["profile"].isin(changed)]
+
+    if len(changed) == 0:
+        return kept, current
+
+    new_rows = profile.read_profile_attributes(logs_dir, changed)
+
+    if len(kept) == 0:
+        return new_rows, current
+
+    updated = pd.concat([kept, new_rows]).sort_values("profile").reset_index(drop=True)
+
+    return updated, current
+
+
+def get_finished_mesa_data(
+    output_dir: str, mesa_dir_name: str, logs_dir_name: str, num_read: int
+) -> "pd.DataFrame":
+    """
+    Reads the attributes of the profiles that a still running MESA run has
+    finished writing, skipping the first num_read profiles that were already
+    read.
+
+    A profile is only considered finished once a later profile has been added
+    to "profiles.index", since MESA may still be writing the pulsation data
+    for the most recent profile.
+    """
+    logs_dir = os.path.join(output_dir, mesa_dir_name, logs_dir_name)
+
+    profile_index_name = "profiles.index"
+    profile_index = os.path.join(logs_dir, profile_index_name)
+
+    try:
+        num_profiles = profile.read_num_profiles(profile_index)
+    except (FileNotFoundError, ValueError):
+        # MESA has not written out any profiles yet, or is in the middle of
+        # rewriting the index
+        return pd.DataFrame()
+
+    num_finished = num_profiles - 1
+    if num_finished <= num_read:
+        return pd.DataFrame()
+
+    return profile.read_profile_attributes(
+        logs_dir, range(num_read + 1, num_finished + 1)
+    )
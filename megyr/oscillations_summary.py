@@ -1,34 +1,69 @@
-from typing import Any
+from typing import Any, List
 
+import numpy as np
 import pandas as pd
 
+from . import profile
+from . import tracing
 
+
+@tracing.traced("read_oscillations_summary_file", "parse")
 def read_oscillations_summary_file(
     filepath: str,
     attributes_start_row: int = 2,
     data_start_row: int = 5,
     column_width: int = 25,
 ) -> "OscillationsSummary":
-    num_attributes = get_num_attributes(filepath, attributes_start_row)
+    """
+    Reads in the given GYRE summary file in a single pass.
 
-    attr_widths = [column_width for _ in range(0, num_attributes)]
+    The attribute names are on the line before attributes_start_row, with
+    their values on that row, and the data column names are on
+    data_start_row, with the data on the rows after it. All of the values are
+    in fixed width columns of column_width characters.
+    """
+    with open(filepath, "rb") as f:
+        lines = f.read().splitlines()
 
-    attributes = pd.read_fwf(
-        filepath, skiprows=attributes_start_row, nrows=1, widths=attr_widths
+    attributes = parse_fixed_width_rows(
+        lines[attributes_start_row - 1],
+        lines[attributes_start_row : attributes_start_row + 1],
+        column_width,
     )
-    data = pd.read_fwf(filepath, skiprows=data_start_row)
+
+    data_rows = [line for line in lines[data_start_row + 1 :] if line.strip() != b""]
+    data = parse_fixed_width_rows(lines[data_start_row], data_rows, column_width)
 
     return OscillationsSummary(attributes, data)
 
 
-def get_num_attributes(filepath: str, attributes_start_row: int) -> int:
-    with open(filepath) as f:
-        for i, line in enumerate(f):
-            if i == attributes_start_row - 1:
-                return len(line.split())
+def parse_fixed_width_rows(
+    names_line: bytes, rows: List[bytes], column_width: int
+) -> pd.DataFrame:
+    """
+    Parses rows of values in fixed width columns into a DataFrame, with the
+    column names taken from the given names line. Each column is decoded
+    into a NumPy array of integers, floats, or strings.
+
+    >>> names = b"       l    freq"
+    >>> parse_fixed_width_rows(names, [b"       0 1.5E+02", b"       1 2.5E+02"], 8)
+       l   freq
+    0  0  150.0
+    1  1  250.0
+    """
+    names = names_line.decode("utf-8").split()
+    row_width = len(names) * column_width
+
+    padded = b"".join(row[:row_width].ljust(row_width) for row in rows)
+    cells = np.frombuffer(padded, dtype="S" + str(column_width)).reshape(
+        len(rows), len(names)
+    )
 
-    raise Exception(
-        "Unable to find attributes column number line in oscillations summary file."
+    return pd.DataFrame(
+        {
+            name: profile.decode_fixed_width_column(cells[:, i])
+            for i, name in enumerate(names)
+        }
     )
 
 
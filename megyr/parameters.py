@@ -1,104 +1,456 @@
-from typing import Any, Dict, List, Set, Union
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    overload,
+    Sequence,
+    Tuple,
+    Union,
+)
 
+import itertools
+import math
+import numbers
+import warnings
+
+import numpy as np
 import pandas as pd
 
+from . import sampling
+
+COMPARISONS = {
+    "gte": np.greater_equal,
+    "gt": np.greater,
+    "lte": np.less_equal,
+    "lt": np.less,
+    "eq": np.equal,
+    "ne": np.not_equal,
+}
+
 
 def create_grid(
-    rows: pd.DataFrame, params: Dict[str, Union[List[Any], Dict[str, Any]]]
-) -> List[Dict[str, Any]]:
+    rows: pd.DataFrame,
+    params: Union[Dict[str, Union[List[Any], Dict[str, Any]]], "Sampling"],
+) -> Sequence[Dict[str, Any]]:
     """
     Creates a grid of parameters using the given dict of possible parameter
-    values.
+    values. A Sampling is used as it is, in place of a grid.
+
+    The grid is lazy, so the combinations are only created as they are
+    accessed. The combinations are ordered with the first parameter varying
+    the slowest and the values of each parameter kept in the order that they
+    were given.
 
     >>> grid = create_grid([], { \
             "a": [0, 1, 2], \
             "b": ['a', "bob"] \
         })
-    >>> sorted([sorted(x.items()) for x in grid])
+    >>> len(grid)
+    6
+    >>> [sorted(x.items()) for x in grid]
     [[('a', 0), ('b', 'a')], [('a', 0), ('b', 'bob')], [('a', 1), ('b', 'a')], [('a', 1), ('b', 'bob')], [('a', 2), ('b', 'a')], [('a', 2), ('b', 'bob')]]
+    >>> grid[3]
+    {'a': 1, 'b': 'bob'}
     """
-    processed_params = process_params(rows, params)
+    if isinstance(params, Sampling):
+        return params
 
-    combinations = generate_param_combinations(processed_params)
+    processed_params = process_params(rows, params)
 
-    return combinations
+    return ParameterGrid(processed_params)
 
 
 def process_params(
     rows: pd.DataFrame, raw_params: Dict[str, Union[List[Any], Dict[str, Any]]]
-) -> Dict[str, Set[Any]]:
-    params = {}
+) -> Dict[str, List[Any]]:
+    params: Dict[str, List[Any]] = {}
     for key in raw_params:
         value = raw_params[key]
 
         if isinstance(value, list):
-            params[key] = set(value)
+            params[key] = unique_values(key, value)
         elif isinstance(value, dict):
-            assert "type" in value
-            if value["type"] == "where":
-                assert "check" in value
-                assert "then" in value
-
-                assert (
-                    "gte" in value
-                    or "gt" in value
-                    or "lte" in value
-                    or "lt" in value
-                    or "eq" in value
-                )
-
-                assert value["check"] in rows.columns
-                assert value["then"] in rows.columns
-
-                check = value["check"]
-                then = value["then"]
-
-                rows_filtered = rows
-                if "gte" in value:
-                    rows_filtered = rows_filtered[rows_filtered[check] >= value["gte"]]
-                if "gt" in value:
-                    rows_filtered = rows_filtered[rows_filtered[check] > value["gt"]]
-                if "lte" in value:
-                    rows_filtered = rows_filtered[rows_filtered[check] <= value["lte"]]
-                if "lt" in value:
-                    rows_filtered = rows_filtered[rows_filtered[check] < value["lt"]]
-                if "eq" in value:
-                    rows_filtered = rows_filtered[rows_filtered[check] == value["eq"]]
-
-                params[key] = set(rows_filtered[then])
-            else:
-                raise Exception()
+            params[key] = select_values(rows, value)
         else:
-            params[key] = set(value)
+            params[key] = unique_values(key, value)
 
     return params
 
 
-def generate_param_combinations(params: Dict[str, Set[Any]]) -> List[Dict[str, Any]]:
-    remaining = list(params.keys())
-    chosen: Dict[str, Any] = {}
-    combinations: List[Dict[str, Any]] = []
+def select_values(rows: pd.DataFrame, selector: Dict[str, Any]) -> List[Any]:
+    """
+    Selects the unique values of the "then" column of the rows picked out by
+    the given selector.
+
+    All selectors can have conditions on the rows to consider, given either
+    as comparisons on a "check" column or as lists of conditions to combine
+    with "and" and "or". The conditions are evaluated together into a single
+    mask. The selector type then picks from the rows that meet the
+    conditions:
+
+    * "where" - all of the rows
+    * "every" - every "k"-th row, starting from "offset"
+    * "nearest" - the row whose "column" value is nearest to each of "values"
+    * "top" - the "n" rows with the largest (or smallest, if "ascending")
+      values of the "by" column
+
+    >>> rows = pd.DataFrame({ \
+            "profile": [1, 2, 3, 4, 5, 6], \
+            "star_age": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0], \
+            "log_L": [0.1, 0.5, 0.3, 0.9, 0.2, 0.4], \
+        })
+    >>> select_values(rows, {"type": "where", "then": "profile", \
+            "or": [{"check": "star_age", "lt": 2}, {"check": "log_L", "gt": 0.35}]})
+    [1, 2, 4, 6]
+    >>> select_values(rows, {"type": "every", "then": "profile", "k": 2, \
+            "check": "star_age", "gte": 2})
+    [2, 4, 6]
+    >>> select_values(rows, {"type": "nearest", "then": "profile", \
+            "column": "star_age", "values": [2.2, 4.9]})
+    [2, 5]
+    >>> select_values(rows, {"type": "top", "then": "profile", "by": "log_L", "n": 2})
+    [4, 2]
+    """
+    assert "type" in selector
+    assert "then" in selector
+
+    assert selector["then"] in rows.columns
+
+    selector_type = selector["type"]
+
+    indices = np.flatnonzero(evaluate_condition(rows, selector))
+
+    if selector_type == "where":
+        assert has_condition(selector)
+    elif selector_type == "every":
+        assert "k" in selector
+        assert selector["k"] > 0
+
+        indices = indices[selector.get("offset", 0) :: selector["k"]]
+    elif selector_type == "nearest":
+        assert "column" in selector
+        assert "values" in selector
+        assert selector["column"] in rows.columns
+
+        if len(indices) > 0:
+            column = rows[selector["column"]].to_numpy()[indices]
+            targets = np.asarray(selector["values"])
+
+            distances = np.abs(column[np.newaxis, :] - targets[:, np.newaxis])
+            indices = indices[np.argmin(distances, axis=1)]
+    elif selector_type == "top":
+        assert "by" in selector
+        assert "n" in selector
+        assert selector["by"] in rows.columns
+
+        order = np.argsort(rows[selector["by"]].to_numpy()[indices], kind="stable")
+        if not selector.get("ascending", False):
+            order = order[::-1]
+
+        indices = indices[order[: selector["n"]]]
+    else:
+        raise Exception(
+            'Unknown parameter selector type "{}". Valid types are "where", "every", "nearest", and "top".'.format(
+                selector_type
+            )
+        )
+
+    values = rows[selector["then"]].to_numpy()[indices].tolist()
+
+    return list(dict.fromkeys(values))
+
+
+def evaluate_condition(rows: pd.DataFrame, condition: Dict[str, Any]) -> Any:
+    """
+    Returns a boolean mask of the rows that meet the given condition. The
+    comparisons on the "check" column and the "and" and "or" lists of
+    sub-conditions must all hold. A condition with none of these is met by
+    every row.
+
+    >>> rows = pd.DataFrame({"a": [1, 2, 3, 4], "b": [4, 3, 2, 1]})
+    >>> evaluate_condition(rows, {"check": "a", "gte": 2, "lt": 4})
+    array([False,  True,  True, False])
+    >>> evaluate_condition(rows, {"and": [{"check": "a", "gt": 1}, \
+            {"or": [{"check": "b", "eq": 3}, {"check": "b", "eq": 1}]}]})
+    array([False,  True, False,  True])
+    """
+    mask = np.ones(len(rows), dtype=bool)
+
+    if "check" in condition:
+        assert condition["check"] in rows.columns
+
+        column = rows[condition["check"]].to_numpy()
+        for comparison, compare in COMPARISONS.items():
+            if comparison in condition:
+                mask &= compare(column, condition[comparison])
+
+    for sub_condition in condition.get("and", []):
+        mask &= evaluate_condition(rows, sub_condition)
+
+    if "or" in condition:
+        any_mask = np.zeros(len(rows), dtype=bool)
+        for sub_condition in condition["or"]:
+            any_mask |= evaluate_condition(rows, sub_condition)
+
+        mask &= any_mask
+
+    return mask
+
+
+def has_condition(condition: Dict[str, Any]) -> bool:
+    has_comparison = "check" in condition and any(
+        comparison in condition for comparison in COMPARISONS
+    )
+
+    return has_comparison or "and" in condition or "or" in condition
+
+
+def unique_values(key: str, values: Iterable[Any]) -> List[Any]:
+    """
+    Returns the given values of a parameter with any duplicates removed,
+    keeping the first occurrence of each value. A warning is given if there
+    were any duplicates, since they are likely a mistake in the config.
+
+    >>> import warnings
+    >>> with warnings.catch_warnings():
+    ...     warnings.simplefilter("ignore")
+    ...     unique_values("l", [0, 1, 0, 2])
+    [0, 1, 2]
+    """
+    values = list(values)
+    unique = list(dict.fromkeys(values))
+
+    if len(unique) != len(values):
+        warnings.warn(
+            'Parameter "{}" has {} duplicate values, which will only be used once.'.format(
+                key, len(values) - len(unique)
+            )
+        )
+
+    return unique
+
 
-    generate_param_combinations_h(params, remaining, chosen, combinations)
+class ParameterGrid(Sequence[Dict[str, Any]]):
+    """
+    A lazy grid of all of the combinations of the given parameter values.
+
+    The combinations are created only as they are iterated over or indexed,
+    so the grid takes the same amount of memory no matter how many
+    combinations it has. Any combination can be found directly from its
+    index, which allows a range of the grid to be run without creating the
+    combinations before it.
+
+    >>> grid = ParameterGrid({"a": [0, 1], "b": ["x", "y", "z"]})
+    >>> len(grid)
+    6
+    >>> grid[4]
+    {'a': 1, 'b': 'y'}
+    >>> grid[-1]
+    {'a': 1, 'b': 'z'}
+    >>> grid[1:3]
+    [{'a': 0, 'b': 'y'}, {'a': 0, 'b': 'z'}]
+    """
+
+    def __init__(self, params: Dict[str, List[Any]]) -> None:
+        self.params = params
+
+        self._keys = list(params.keys())
+        self._values = [list(params[key]) for key in self._keys]
+        self._length = math.prod(len(values) for values in self._values)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for combination in itertools.product(*self._values):
+            yield dict(zip(self._keys, combination))
+
+    @overload
+    def __getitem__(self, index: int) -> Dict[str, Any]: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[Dict[str, Any]]: ...
+
+    def __getitem__(
+        self, index: Union[int, slice]
+    ) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+
+        if index < 0:
+            index += self._length
 
-    return combinations
+        if index < 0 or index >= self._length:
+            raise IndexError(
+                "Parameter grid index {} is out of range for a grid of {} combinations.".format(
+                    index, self._length
+                )
+            )
+
+        # Decode the index as a mixed-radix number, with the last parameter
+        # as the least significant digit
+        combination = {}
+        for key, values in reversed(list(zip(self._keys, self._values))):
+            index, value_index = divmod(index, len(values))
+            combination[key] = values[value_index]
+
+        return {key: combination[key] for key in self._keys}
+
+    def __repr__(self) -> str:
+        return "ParameterGrid({})".format(self.params)
+
+
+class Sampling(Sequence[Dict[str, Any]]):
+    """
+    A sample of parameter combinations spread out over continuous ranges of
+    parameter values, which can be used in place of a grid of values.
+
+    Each parameter is given either as a (low, high) tuple, which is sampled
+    over, or as a list of values. The given number of samples are drawn over
+    the ranges using the given method:
+
+    * "lhs" - a Latin hypercube
+    * "sobol" - a scrambled Sobol sequence, best with a power of two samples
+    * "halton" - a scrambled Halton sequence
+
+    Each sample is then combined with every combination of the listed values,
+    which vary the slowest. The samples are randomized using the given seed,
+    so the same seed always gives the same combinations. The sampled values
+    are rounded to the given number of significant figures, which keeps the
+    names of the run directories made from them short and deterministic. A
+    range of integers gives integer values, with both ends included.
+
+    >>> sampling = Sampling("lhs", {"z": [0.01, 0.02], "m": (1.0, 2.0)}, 4)
+    >>> len(sampling)
+    8
+    >>> sorted(int((c["m"] - 1.0) * 4) for c in sampling[:4])
+    [0, 1, 2, 3]
+    >>> sampling[0] == Sampling("lhs", {"z": [0.01, 0.02], "m": (1.0, 2.0)}, 4)[0]
+    True
+    >>> Sampling("sobol", {"n": (1, 8)}, 8, seed=3)[0]["n"] in range(1, 9)
+    True
+    """
 
+    def __init__(
+        self,
+        method: str,
+        params: Dict[str, Any],
+        num_samples: int,
+        seed: int = 0,
+        significant_figures: int = 6,
+    ) -> None:
+        self.method = method
+        self.params = params
+        self.num_samples = num_samples
+        self.seed = seed
+        self.significant_figures = significant_figures
 
-def generate_param_combinations_h(
-    params: Dict[str, Set[Any]],
-    remaining: List[str],
-    chosen: Dict[str, Any],
-    combinations: List[Dict[str, Any]],
-) -> None:
-    if len(remaining) == 0:
-        combinations.append(chosen)
+        if num_samples < 1:
+            raise Exception(
+                "Sampling needs at least one sample, but was asked for {}.".format(
+                    num_samples
+                )
+            )
+
+        ranges = {
+            key: value for key, value in params.items() if isinstance(value, tuple)
+        }
+        for key, value in ranges.items():
+            if len(value) != 2 or not value[0] <= value[1]:
+                raise Exception(
+                    'Range of parameter "{}" must be a (low, high) tuple with low <= high, but was {}.'.format(
+                        key, value
+                    )
+                )
+
+        self._keys = list(params.keys())
+        self._samples = self._sample(ranges)
+        self._choices = ParameterGrid(
+            {
+                key: unique_values(key, value)
+                for key, value in params.items()
+                if key not in ranges
+            }
+        )
+        self._length = len(self._choices) * len(self._samples)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for i in range(self._length):
+            yield self[i]
+
+    @overload
+    def __getitem__(self, index: int) -> Dict[str, Any]: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[Dict[str, Any]]: ...
+
+    def __getitem__(
+        self, index: Union[int, slice]
+    ) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+
+        if index < 0:
+            index += self._length
+
+        if index < 0 or index >= self._length:
+            raise IndexError(
+                "Sampling index {} is out of range for a sampling of {} combinations.".format(
+                    index, self._length
+                )
+            )
+
+        choice_index, sample_index = divmod(index, len(self._samples))
+
+        combination = dict(self._choices[choice_index])
+        combination.update(self._samples[sample_index])
+
+        return {key: combination[key] for key in self._keys}
+
+    def __repr__(self) -> str:
+        return "Sampling({!r}, {}, {}, seed={})".format(
+            self.method, self.params, self.num_samples, self.seed
+        )
+
+    def _sample(self, ranges: Dict[str, Tuple[Any, Any]]) -> List[Dict[str, Any]]:
+        if len(ranges) == 0:
+            return [{}]
+
+        points = sampling.sample_unit_cube(
+            self.method, self.num_samples, len(ranges), self.seed
+        )
+
+        samples = []
+        for point in points:
+            sample = {}
+            for (key, (low, high)), u in zip(ranges.items(), point):
+                sample[key] = self._scale(low, high, u)
+
+            samples.append(sample)
+
+        unique_samples: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+        for sample in samples:
+            unique_samples.setdefault(tuple(sample.values()), sample)
+
+        unique = list(unique_samples.values())
+        if len(unique) != len(samples):
+            warnings.warn(
+                "Sampling has {} duplicate samples after rounding, which will only be used once.".format(
+                    len(samples) - len(unique)
+                )
+            )
 
-        return None
+        return unique
 
-    p = remaining[0]
-    for v in params[p]:
-        new_chosen = dict(chosen)
+    def _scale(self, low: Any, high: Any, u: float) -> Any:
+        if isinstance(low, numbers.Integral) and isinstance(high, numbers.Integral):
+            return min(int(low) + int(u * (int(high) - int(low) + 1)), int(high))
 
-        new_chosen[p] = v
+        value = low + u * (high - low)
 
-        generate_param_combinations_h(params, remaining[1:], new_chosen, combinations)
+        return float("{:.{}g}".format(value, self.significant_figures))
@@ -1,9 +1,15 @@
-from typing import Any, Optional
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
+import concurrent.futures
+import mmap
 import os.path
 
+import numpy as np
+import numpy.typing as npt
 import pandas as pd
 
+from . import tracing
+
 
 def read_num_profiles(filepath: str, column_length: int = 12) -> int:
     with open(filepath, "r") as f:
@@ -20,19 +26,113 @@ def read_all_profile_attributes(
     profile_prefix: str = "profile",
     profile_suffix: str = ".data",
 ) -> pd.DataFrame:
-    attributes = pd.DataFrame()
-    for i in range(1, num_profiles + 1):
-        name = profile_prefix + str(i) + profile_suffix
-        filepath = os.path.join(logs_dir, name)
+    return read_profile_attributes(
+        logs_dir, range(1, num_profiles + 1), profile_prefix, profile_suffix
+    )
+
+
+@tracing.traced("read_profile_attributes", "parse")
+def read_profile_attributes(
+    logs_dir: str,
+    profile_numbers: Iterable[int],
+    profile_prefix: str = "profile",
+    profile_suffix: str = ".data",
+    num_threads: int = 8,
+) -> pd.DataFrame:
+    """
+    Reads the header attributes of the given profiles into one DataFrame, with
+    one row per profile.
+
+    Only the header lines of each profile file are read, and the files are
+    read on a pool of threads, which helps on the networked filesystems that
+    MESA runs are often stored on.
+    """
+    profile_numbers = list(profile_numbers)
+
+    filepaths = [
+        os.path.join(logs_dir, profile_prefix + str(i) + profile_suffix)
+        for i in profile_numbers
+    ]
+
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as pool:
+        headers = list(pool.map(read_profile_header, filepaths))
 
-        attr = read_profile_file(filepath, read_data=False).attributes
-        attr["profile"] = i
+    attributes = pd.DataFrame(headers)
+    for column in attributes.columns:
+        attributes[column] = infer_column_type(attributes[column])
 
-        attributes = pd.concat([attributes, attr])
+    attributes["profile"] = profile_numbers
 
     return attributes
 
 
+def read_profile_file_stats(
+    logs_dir: str,
+    profile_numbers: Iterable[int],
+    profile_prefix: str = "profile",
+    profile_suffix: str = ".data",
+) -> pd.DataFrame:
+    """
+    Gets the size and modification time of each of the given profile files,
+    which can be used to check if a profile has changed since it was read.
+    """
+    profile_numbers = list(profile_numbers)
+
+    sizes = []
+    mtimes = []
+    for i in profile_numbers:
+        filepath = os.path.join(logs_dir, profile_prefix + str(i) + profile_suffix)
+        stat = os.stat(filepath)
+
+        sizes.append(stat.st_size)
+        mtimes.append(stat.st_mtime_ns)
+
+    return pd.DataFrame({"profile": profile_numbers, "size": sizes, "mtime_ns": mtimes})
+
+
+def read_profile_header(filepath: str, attributes_start_row: int = 1) -> Dict[str, str]:
+    """
+    Reads the attribute names and values from the header of the given MESA
+    profile file, without reading the rest of the file. The values are
+    returned as the strings that appear in the file.
+    """
+    with open(filepath, "r") as f:
+        for _ in range(0, attributes_start_row):
+            f.readline()
+
+        names_line = f.readline()
+        values_line = f.readline()
+
+    return parse_fixed_width_header(names_line, values_line)
+
+
+def parse_fixed_width_header(names_line: str, values_line: str) -> Dict[str, str]:
+    """
+    Parses a pair of fixed width header lines, where each value is right
+    aligned to the end of its name.
+
+    >>> parse_fixed_width_header("   a        b_c", "   1  x y 2.5")
+    {'a': '1', 'b_c': 'x y 2.5'}
+    """
+    names = names_line.split()
+
+    return {
+        name: values_line[start:end].strip()
+        for name, (start, end) in zip(names, find_column_spans(names_line))
+    }
+
+
+def infer_column_type(column: "pd.Series[Any]") -> "pd.Series[Any]":
+    """
+    Converts the given column of strings into numbers if all of its values
+    are numeric, otherwise leaves it as strings.
+    """
+    try:
+        return pd.to_numeric(column)
+    except (ValueError, TypeError):
+        return column
+
+
 def read_profile_file(
     filepath: str,
     attributes_start_row: int = 1,
@@ -45,6 +145,12 @@ def read_profile_file(
     return MESAProfile(attributes, data)
 
 
+def map_profile_file(
+    filepath: str, attributes_start_row: int = 1, data_start_row: int = 5
+) -> "MappedMESAProfile":
+    return MappedMESAProfile(filepath, attributes_start_row, data_start_row)
+
+
 class MESAProfile:
     def __init__(self, attributes: pd.DataFrame, data: Optional[pd.DataFrame]) -> None:
         self.attributes = attributes
@@ -65,3 +171,182 @@ class MESAProfile:
 
     def has_attribute(self, attr: str) -> bool:
         return attr in list(self.attributes.columns.values)
+
+
+class MappedMESAProfile(MESAProfile):
+    """
+    A MESA profile whose data is memory-mapped instead of being read in.
+
+    The line and column offsets of the data are indexed once when the profile
+    is opened, and then only the columns that are asked for are decoded into
+    NumPy arrays. This is much faster and uses much less memory than reading
+    in the whole profile when only a few columns are needed.
+
+    Should be closed once it is no longer needed, or used as a context
+    manager.
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        attributes_start_row: int = 1,
+        data_start_row: int = 5,
+        complete_rows_only: bool = False,
+    ) -> None:
+        header = read_profile_header(filepath, attributes_start_row)
+        attributes = pd.DataFrame([header])
+        for column in attributes.columns:
+            attributes[column] = infer_column_type(attributes[column])
+
+        super().__init__(attributes, None)
+
+        self.filepath = filepath
+        self._decoded: Dict[str, npt.NDArray[Any]] = {}
+
+        with open(filepath, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._buffer = np.frombuffer(self._mmap, dtype=np.uint8)
+
+        line_ends = np.flatnonzero(self._buffer == ord("\n"))
+        if self._buffer[-1] != ord("\n") and not complete_rows_only:
+            line_ends = np.append(line_ends, len(self._buffer))
+        line_starts = np.concatenate(([0], line_ends + 1))[: len(line_ends)]
+
+        names_line = self._line(line_starts, line_ends, data_start_row)
+        self.columns = names_line.split()
+        self._column_spans = find_column_spans(names_line)
+
+        # Skip any blank lines, such as at the end of the file
+        self._row_starts = line_starts[data_start_row + 1 :]
+        self._row_ends = line_ends[data_start_row + 1 :]
+
+        non_blank = self._row_ends > self._row_starts
+        self._row_starts = self._row_starts[non_blank]
+        self._row_ends = self._row_ends[non_blank]
+
+    def __enter__(self) -> "MappedMESAProfile":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._row_starts)
+
+    def close(self) -> None:
+        self._decoded = {}
+        del self._buffer
+        self._mmap.close()
+
+    def has_column(self, column: str) -> bool:
+        return column in self.columns
+
+    def get_column(self, column: str) -> npt.NDArray[Any]:
+        """
+        Gets the values of the given data column, decoded into a NumPy array of
+        integers, floats, or strings depending on the values in the column.
+        """
+        if not self.has_column(column):
+            raise KeyError(
+                'Column "' + column + '" is not a valid column for this MESA profile.'
+            )
+
+        if column not in self._decoded:
+            start, end = self._column_spans[self.columns.index(column)]
+
+            self._decoded[column] = decode_fixed_width_column(
+                self._column_bytes(start, end)
+            )
+
+        return self._decoded[column]
+
+    def get_columns(self, columns: List[str]) -> pd.DataFrame:
+        return pd.DataFrame({column: self.get_column(column) for column in columns})
+
+    def _line(
+        self,
+        line_starts: npt.NDArray[np.intp],
+        line_ends: npt.NDArray[np.intp],
+        i: int,
+    ) -> str:
+        return bytes(self._mmap[line_starts[i] : line_ends[i]]).decode("utf-8")
+
+    def _column_bytes(self, start: int, end: Optional[int]) -> npt.NDArray[Any]:
+        lengths = self._row_ends - self._row_starts
+        if len(lengths) == 0:
+            return np.array([], dtype="S1")
+
+        if end is None:
+            end = int(lengths.max())
+
+        width = end - start
+
+        first = int(self._row_starts[0])
+        row_length = int(lengths[0]) + 1
+        uniform = (
+            bool(np.all(lengths == lengths[0]))
+            and bool(np.all(np.diff(self._row_starts) == row_length))
+            and first + len(lengths) * row_length <= len(self._buffer)
+        )
+
+        if uniform:
+            # All of the rows have the same length, so the data can be viewed
+            # as a 2D array of characters without copying it
+            num_rows = len(lengths)
+            rows = self._buffer[first : first + num_rows * row_length].reshape(
+                num_rows, row_length
+            )
+
+            cells = np.ascontiguousarray(rows[:, start:end])
+        else:
+            cells = np.full((len(lengths), width), ord(" "), dtype=np.uint8)
+            for i, (row_start, row_end) in enumerate(
+                zip(self._row_starts, self._row_ends)
+            ):
+                cell = self._buffer[row_start + start : min(row_start + end, row_end)]
+                cells[i, : len(cell)] = cell
+
+        return cells.view("S" + str(width)).ravel()
+
+
+def find_column_spans(names_line: str) -> List[Tuple[int, Optional[int]]]:
+    """
+    Finds the character spans of the columns of a fixed width table, where the
+    values of each column are right aligned to the end of its name. The last
+    column extends to the end of each line.
+
+    >>> find_column_spans("   a        b_c")
+    [(0, 4), (4, None)]
+    """
+    names = names_line.split()
+
+    spans: List[Tuple[int, Optional[int]]] = []
+    start = 0
+    for i, name in enumerate(names):
+        end = names_line.index(name, start) + len(name)
+
+        spans.append((start, end if i < len(names) - 1 else None))
+
+        start = end
+
+    return spans
+
+
+def decode_fixed_width_column(cells: npt.NDArray[Any]) -> npt.NDArray[Any]:
+    """
+    Decodes an array of fixed width byte strings into integers if possible,
+    otherwise into floats, otherwise into strings.
+
+    >>> decode_fixed_width_column(np.array([b"  1", b" 20"]))
+    array([ 1, 20])
+    >>> decode_fixed_width_column(np.array([b" 1.5E+00", b"-2.0E-01"]))
+    array([ 1.5, -0.2])
+    """
+    for dtype in [np.int64, np.float64]:
+        try:
+            return cells.astype(dtype)
+        except ValueError:
+            pass
+
+    return np.char.strip(cells.astype(str))
@@ -0,0 +1,251 @@
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import itertools
+import numbers
+
+from . import parameters
+
+
+def refinable_params(params: Dict[str, List[Any]]) -> List[str]:
+    """
+    Returns the names of the parameters that a grid can be refined along by
+    default, which are the parameters with at least two values that are all
+    numbers.
+
+    >>> refinable_params({"m": [1.0, 2.0], "z": [0.02], "name": ["a", "b"]})
+    ['m']
+    """
+    return [
+        key
+        for key, values in params.items()
+        if len(values) >= 2 and all(is_number(value) for value in values)
+    ]
+
+
+def is_number(value: Any) -> bool:
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def midpoint(low: Any, high: Any) -> Optional[Any]:
+    """
+    Returns the value halfway between the given values of a parameter, or None
+    if there is no value between them.
+
+    Integer parameters are kept as integers. Other values are rounded to 12
+    significant figures, so that the names of the MESA run directories made
+    from them do not depend on floating point error.
+
+    >>> midpoint(0.1, 0.2)
+    0.15
+    >>> midpoint(1, 4)
+    2
+    >>> midpoint(1, 2) is None
+    True
+    """
+    if isinstance(low, numbers.Integral) and isinstance(high, numbers.Integral):
+        if int(high) - int(low) < 2:
+            return None
+
+        return (int(low) + int(high)) // 2
+
+    middle = float("{:.12g}".format((low + high) / 2))
+    if middle == low or middle == high:
+        return None
+
+    return middle
+
+
+class Cell:
+    """
+    A cell of a parameter grid, spanning the given range of values of each of
+    the refined parameters, with the other parameters held at the given fixed
+    values.
+    """
+
+    def __init__(
+        self,
+        fixed: Dict[str, Any],
+        bounds: Dict[str, Tuple[Any, Any]],
+        depth: int = 0,
+    ) -> None:
+        self.fixed = fixed
+        self.bounds = bounds
+        self.depth = depth
+
+    def corners(self) -> Iterator[Dict[str, Any]]:
+        return self._points({key: list(bound) for key, bound in self.bounds.items()})
+
+    def split(self) -> Optional[Tuple[List["Cell"], List[Dict[str, Any]]]]:
+        """
+        Splits the cell in half along each of its parameters that has a value
+        between its bounds, returning the new cells and all of their corners.
+        Returns None if the cell cannot be split along any parameter.
+        """
+        cuts: Dict[str, List[Any]] = {}
+        for key, (low, high) in self.bounds.items():
+            middle = midpoint(low, high)
+            cuts[key] = [low, high] if middle is None else [low, middle, high]
+
+        if all(len(values) == 2 for values in cuts.values()):
+            return None
+
+        keys = list(cuts.keys())
+        intervals = [list(zip(cuts[key][:-1], cuts[key][1:])) for key in keys]
+
+        children = [
+            Cell(self.fixed, dict(zip(keys, bounds)), self.depth + 1)
+            for bounds in itertools.product(*intervals)
+        ]
+
+        return children, list(self._points(cuts))
+
+    def _points(self, values: Dict[str, List[Any]]) -> Iterator[Dict[str, Any]]:
+        keys = list(values.keys())
+        for combination in itertools.product(*[values[key] for key in keys]):
+            point = dict(self.fixed)
+            point.update(zip(keys, combination))
+
+            yield point
+
+
+class GridRefinement:
+    """
+    Adaptive refinement of a grid of parameter combinations.
+
+    The refinement starts from the full grid of the given parameter values.
+    The grid is divided into cells between neighbouring values of the refined
+    parameters, and once the metric of every combination has been found,
+    each cell whose metric varies by more than the tolerance between its
+    corners is split in half along each refined parameter. This repeats with
+    the new cells until no cells need to be split, or splitting any more would
+    take the total number of combinations over the budget. The cells that
+    vary the most are split first. The initial grid is always used in full,
+    even if it is larger than the budget.
+
+    Combinations whose metric is None, such as MESA runs that timed out, are
+    not refined around.
+
+    >>> refinement = GridRefinement({"m": [0.0, 1.0, 2.0]}, ["m"], 0.5, budget=6)
+    >>> combs = refinement.initial_combs()
+    >>> while len(combs) > 0:
+    ...     for comb in combs:
+    ...         refinement.add_metric(comb, 0.0 if comb["m"] < 1.3 else 1.0)
+    ...     combs = refinement.refine()
+    ...     print(combs)
+    [{'m': 1.5}]
+    [{'m': 1.25}]
+    [{'m': 1.375}]
+    []
+    """
+
+    def __init__(
+        self,
+        params: Dict[str, List[Any]],
+        refine_params: Sequence[str],
+        tolerance: float,
+        budget: int,
+        max_depth: Optional[int] = None,
+    ) -> None:
+        self.params = params
+        self.refine_params = list(refine_params)
+        self.tolerance = tolerance
+        self.budget = budget
+        self.max_depth = max_depth
+
+        self.metrics: Dict[Tuple[Any, ...], Optional[float]] = {}
+
+        self._keys = list(params.keys())
+        self._combs: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+        self._cells = self._initial_cells()
+
+    def initial_combs(self) -> List[Dict[str, Any]]:
+        combs = list(parameters.ParameterGrid(self.params))
+        for comb in combs:
+            self._combs[self._comb_key(comb)] = comb
+
+        return combs
+
+    @property
+    def num_combs(self) -> int:
+        return len(self._combs)
+
+    def add_metric(self, comb: Dict[str, Any], metric: Optional[float]) -> None:
+        self.metrics[self._comb_key(comb)] = metric
+
+    def refine(self) -> List[Dict[str, Any]]:
+        """
+        Splits the cells whose metric varies by more than the tolerance,
+        returning the new combinations to find the metrics of. Returns an
+        empty list once the refinement is finished.
+        """
+        candidates = []
+        for i, cell in enumerate(self._cells):
+            if self.max_depth is not None and cell.depth >= self.max_depth:
+                continue
+
+            spread = self._spread(cell)
+            if spread is not None and spread > self.tolerance:
+                candidates.append((-spread, i))
+
+        new_combs: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+        new_cells: List[Cell] = []
+        split_cells = set()
+        for _, i in sorted(candidates):
+            split = self._cells[i].split()
+            if split is None:
+                continue
+
+            children, points = split
+
+            fresh = {}
+            for point in points:
+                key = self._comb_key(point)
+                if key not in self._combs and key not in new_combs:
+                    fresh[key] = {name: point[name] for name in self._keys}
+
+            if self.num_combs + len(new_combs) + len(fresh) > self.budget:
+                continue
+
+            new_combs.update(fresh)
+            new_cells.extend(children)
+            split_cells.add(i)
+
+        self._cells = [
+            cell for i, cell in enumerate(self._cells) if i not in split_cells
+        ] + new_cells
+        self._combs.update(new_combs)
+
+        return list(new_combs.values())
+
+    def _spread(self, cell: Cell) -> Optional[float]:
+        values = []
+        for corner in cell.corners():
+            metric = self.metrics.get(self._comb_key(corner))
+            if metric is None:
+                return None
+
+            values.append(metric)
+
+        return max(values) - min(values)
+
+    def _initial_cells(self) -> List[Cell]:
+        fixed_params = {
+            key: values
+            for key, values in self.params.items()
+            if key not in self.refine_params
+        }
+
+        intervals = []
+        for key in self.refine_params:
+            values = sorted(self.params[key])
+            intervals.append(list(zip(values[:-1], values[1:])))
+
+        cells = []
+        for fixed in parameters.ParameterGrid(fixed_params):
+            for bounds in itertools.product(*intervals):
+                cells.append(Cell(fixed, dict(zip(self.refine_params, bounds))))
+
+        return cells
+
+    def _comb_key(self, comb: Dict[str, Any]) -> Tuple[Any, ...]:
+        return tuple(comb[key] for key in self._keys)
@@ -0,0 +1,446 @@
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import asyncio
+import contextlib
+import contextvars
+import os
+import signal
+import subprocess
+import sys
+import time
+import types
+
+from .supervision import CHECK_INTERVAL, Supervisor, TaskLimits
+
+# Size of the blocks counted in the block input and output fields of rusage
+BLOCK_SIZE = 512
+
+# Resource usage collectors that are open in the current context
+_collectors: contextvars.ContextVar[Tuple["ResourceUsage", ...]] = (
+    contextvars.ContextVar("collectors", default=())
+)
+
+# Longest time between polls of a child process, in seconds, when waiting for
+# it to exit on platforms without pidfds
+POLL_INTERVAL = 0.1
+
+RUSAGE_FIELDS = ["ru_utime", "ru_stime", "ru_maxrss", "ru_inblock", "ru_oublock"]
+
+# Time that a command is given to exit after being asked to stop, in seconds,
+# before it is killed
+STOP_GRACE_PERIOD = 5.0
+
+# Script run by the launcher process, which runs the command given as its
+# second argument in a child process, writes the resource usage of the child
+# to the file descriptor given as its first argument, and exits in the same
+# way as the child. If a third argument is given, then it is the soft and hard
+# CPU time limits of the child.
+#
+# The child is put in its own process group, so that it can be stopped along
+# with any processes that it starts. Interrupt, terminate, and hangup signals
+# are passed on to the whole group. Once the group has been asked to stop, it
+# is killed if the child has not exited after STOP_GRACE_PERIOD seconds, and
+# any processes left in the group after the child exits are killed.
+LAUNCHER = """
+import os, signal, sys
+
+report_fd = int(sys.argv[1])
+
+pid = os.fork()
+if pid == 0:
+    os.close(report_fd)
+    try:
+        os.setpgid(0, 0)
+        if len(sys.argv) > 3:
+            import resource
+            limits = tuple(int(limit) for limit in sys.argv[3].split(","))
+            resource.setrlimit(resource.RLIMIT_CPU, limits)
+        os.execv("/bin/sh", ["/bin/sh", "-c", "exec " + sys.argv[2]])
+    finally:
+        os._exit(127)
+
+# Also set the group here, so that the group exists before any signal is
+# passed on to it, even if the child has not been scheduled yet
+try:
+    os.setpgid(pid, pid)
+except OSError:
+    pass
+
+stopping = False
+
+def signal_group(signum):
+    try:
+        os.killpg(pid, signum)
+    except ProcessLookupError:
+        pass
+
+def forward(signum, frame):
+    global stopping
+    signal_group(signum)
+    if not stopping:
+        stopping = True
+        signal.setitimer(signal.ITIMER_REAL, %r)
+
+signal.signal(signal.SIGALRM, lambda signum, frame: signal_group(signal.SIGKILL))
+for signum in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+    signal.signal(signum, forward)
+
+_, status, rusage = os.wait4(pid, 0)
+
+signal.setitimer(signal.ITIMER_REAL, 0)
+if stopping:
+    signal_group(signal.SIGKILL)
+
+fields = %r
+os.write(report_fd, " ".join(str(getattr(rusage, f)) for f in fields).encode())
+os.close(report_fd)
+
+code = os.waitstatus_to_exitcode(status)
+if code < 0:
+    signal.signal(-code, signal.SIG_DFL)
+    os.kill(os.getpid(), -code)
+
+sys.exit(code)
+""" % (
+    STOP_GRACE_PERIOD,
+    RUSAGE_FIELDS,
+)
+
+
+class ResourceUsage:
+    """
+    The resources used by one or more child processes, as reported by the
+    operating system when each process was reaped.
+
+    The read and write bytes are from the number of blocks that the processes
+    read from and wrote to the filesystem, so reads that are served from the
+    page cache are not counted.
+    """
+
+    def __init__(
+        self,
+        user_time: float = 0.0,
+        system_time: float = 0.0,
+        max_rss: int = 0,
+        read_bytes: int = 0,
+        write_bytes: int = 0,
+        num_processes: int = 0,
+    ) -> None:
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+        self.num_processes = num_processes
+
+    @staticmethod
+    def from_rusage(rusage: Any) -> "ResourceUsage":
+        # Linux reports the peak resident set size in kilobytes, but macOS
+        # reports it in bytes
+        rss_unit = 1 if sys.platform == "darwin" else 1024
+
+        return ResourceUsage(
+            user_time=rusage.ru_utime,
+            system_time=rusage.ru_stime,
+            max_rss=int(rusage.ru_maxrss) * rss_unit,
+            read_bytes=int(rusage.ru_inblock) * BLOCK_SIZE,
+            write_bytes=int(rusage.ru_oublock) * BLOCK_SIZE,
+            num_processes=1,
+        )
+
+    def add(self, other: "ResourceUsage") -> None:
+        """
+        Adds the usage of the given processes to this usage. The times and
+        bytes are summed, while the peak resident set size is the largest
+        peak of any of the processes.
+
+        >>> usage = ResourceUsage(1.0, 0.5, 100, 0, 2048, 1)
+        >>> usage.add(ResourceUsage(2.0, 0.25, 50, 512, 0, 1))
+        >>> usage.to_record()["user_time"], usage.to_record()["max_rss"]
+        ('3.0', '100')
+        """
+        self.user_time += other.user_time
+        self.system_time += other.system_time
+        self.max_rss = max(self.max_rss, other.max_rss)
+        self.read_bytes += other.read_bytes
+        self.write_bytes += other.write_bytes
+        self.num_processes += other.num_processes
+
+    def to_record(self) -> Dict[str, str]:
+        """
+        Returns the usage as values for the columns of the task ledger. The
+        values are left empty if no processes were run.
+        """
+        values = {
+            "user_time": round(self.user_time, 6),
+            "system_time": round(self.system_time, 6),
+            "max_rss": self.max_rss,
+            "read_bytes": self.read_bytes,
+            "write_bytes": self.write_bytes,
+        }
+
+        if self.num_processes == 0:
+            return {name: "" for name in values}
+
+        return {name: str(value) for name, value in values.items()}
+
+
+def run_command(
+    command: str,
+    directory: str,
+    env: Optional[Dict[str, str]] = None,
+    log_filepath: Optional[str] = None,
+    limits: Optional[TaskLimits] = None,
+) -> Tuple[int, ResourceUsage]:
+    """
+    Runs the given shell command in the given directory, returning its return
+    code and the resources that it used. The usage is also added to any
+    resource usage collectors that are open in the current context. If a log
+    filepath is given, then the output of the command is written to that file
+    instead of the terminal.
+
+    The command is started by a small launcher process rather than by Megyr
+    itself. This is because Linux counts the peak memory of the process that
+    a program was started from towards the peak memory of the program, which
+    would hide the memory used by programs smaller than Megyr. The launcher
+    reports the resource usage of the command back through a pipe.
+
+    If limits are given, then the command is stopped if it goes over one of
+    them, in which case a TaskTimeoutError is raised once it has exited.
+
+    If waiting is interrupted, such as by a KeyboardInterrupt, then the
+    command is stopped.
+    """
+    process, report_fd = start_launcher(command, directory, env, log_filepath, limits)
+    supervisor = Supervisor(process.pid, limits) if limits is not None else None
+
+    try:
+        if supervisor is None or not supervisor.limits.needs_supervision:
+            _, status, launcher_rusage = os.wait4(process.pid, 0)
+        else:
+            status, launcher_rusage = wait_supervised(process.pid, supervisor)
+    except BaseException:
+        stop_process(process)
+        os.close(report_fd)
+        raise
+
+    return finish_launcher(process, report_fd, status, launcher_rusage, supervisor)
+
+
+async def run_command_async(
+    command: str,
+    directory: str,
+    env: Optional[Dict[str, str]] = None,
+    log_filepath: Optional[str] = None,
+    limits: Optional[TaskLimits] = None,
+) -> Tuple[int, ResourceUsage]:
+    """
+    Runs the given shell command in the same way as run_command, but waits
+    for it to finish without blocking the event loop, so that many commands
+    can be run at once from a single thread.
+
+    If the waiting task is cancelled, then the command is stopped.
+    """
+    process, report_fd = start_launcher(command, directory, env, log_filepath, limits)
+    supervisor = Supervisor(process.pid, limits) if limits is not None else None
+
+    check_interval: Optional[float] = None
+    if supervisor is not None and supervisor.limits.needs_supervision:
+        check_interval = CHECK_INTERVAL
+
+    exit_task = asyncio.ensure_future(wait_for_exit(process.pid))
+    try:
+        while True:
+            done, _ = await asyncio.wait({exit_task}, timeout=check_interval)
+            if len(done) > 0:
+                break
+
+            if supervisor is not None:
+                supervisor.check()
+
+        status, launcher_rusage = exit_task.result()
+    except BaseException:
+        exit_task.cancel()
+        stop_process(process)
+        os.close(report_fd)
+        raise
+
+    return finish_launcher(process, report_fd, status, launcher_rusage, supervisor)
+
+
+def start_launcher(
+    command: str,
+    directory: str,
+    env: Optional[Dict[str, str]],
+    log_filepath: Optional[str],
+    limits: Optional[TaskLimits] = None,
+) -> Tuple["subprocess.Popen[Any]", int]:
+    """
+    Starts the launcher process for the given command, returning the process
+    and the file descriptor that the launcher reports the resource usage of
+    the command to.
+
+    If limits are given, then the launcher is told the CPU time limit of the
+    command.
+    """
+    read_fd, write_fd = os.pipe()
+    log_file = open(log_filepath, "wb") if log_filepath is not None else None
+
+    args = [sys.executable, "-I", "-S", "-c", LAUNCHER, str(write_fd), command]
+    cpu_rlimit = limits.cpu_rlimit() if limits is not None else None
+    if cpu_rlimit is not None:
+        args.append("{},{}".format(*cpu_rlimit))
+
+    try:
+        process = subprocess.Popen(
+            args,
+            cwd=directory,
+            env=env,
+            pass_fds=[write_fd],
+            stdout=log_file,
+            stderr=subprocess.STDOUT if log_file is not None else None,
+        )
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+
+        if log_file is not None:
+            log_file.close()
+
+    return process, read_fd
+
+
+def finish_launcher(
+    process: "subprocess.Popen[Any]",
+    report_fd: int,
+    status: int,
+    launcher_rusage: Any,
+    supervisor: Optional[Supervisor] = None,
+) -> Tuple[int, ResourceUsage]:
+    """
+    Reads the resource usage of the command run by the given launcher process,
+    which has been reaped with the given wait status and resource usage.
+
+    If the command was run under the given supervisor and was stopped for
+    going over one of its limits, then a TaskTimeoutError is raised after the
+    usage has been collected.
+    """
+    # The process has been reaped, so let the Popen object know its status
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    with os.fdopen(report_fd, "rb") as report:
+        values = report.read().split()
+
+    if len(values) == len(RUSAGE_FIELDS):
+        usage = ResourceUsage.from_rusage(
+            types.SimpleNamespace(**dict(zip(RUSAGE_FIELDS, map(float, values))))
+        )
+    else:
+        # The launcher failed before the command finished
+        usage = ResourceUsage.from_rusage(launcher_rusage)
+
+    for collector in _collectors.get():
+        collector.add(usage)
+
+    if supervisor is not None:
+        supervisor.check_exit(process.returncode, usage.user_time + usage.system_time)
+
+    return process.returncode, usage
+
+
+def wait_supervised(pid: int, supervisor: Supervisor) -> Tuple[int, Any]:
+    """
+    Waits for the given child process to exit while checking it against the
+    limits of the given supervisor, then reaps it, returning its wait status
+    and resource usage. The process is polled, with the time between polls
+    growing up to POLL_INTERVAL.
+    """
+    interval = 0.001
+    while True:
+        exited_pid, status, rusage = os.wait4(pid, os.WNOHANG)
+        if exited_pid != 0:
+            return status, rusage
+
+        supervisor.check()
+
+        time.sleep(interval)
+        interval = min(2 * interval, POLL_INTERVAL)
+
+
+async def wait_for_exit(pid: int) -> Tuple[int, Any]:
+    """
+    Waits for the given child process to exit without blocking the event
+    loop, then reaps it, returning its wait status and resource usage.
+
+    Where supported (Linux 5.3 and later), the event loop watches a pidfd of
+    the process to be told when it exits. Otherwise the process is polled,
+    with the time between polls growing up to POLL_INTERVAL.
+    """
+    pidfd: Optional[int] = None
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(pid)
+        except OSError:
+            pidfd = None
+
+    if pidfd is not None:
+        loop = asyncio.get_running_loop()
+        exited: "asyncio.Future[None]" = loop.create_future()
+
+        def on_exit() -> None:
+            if not exited.done():
+                exited.set_result(None)
+
+        loop.add_reader(pidfd, on_exit)
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+
+        _, status, rusage = os.wait4(pid, 0)
+
+        return status, rusage
+
+    interval = 0.001
+    while True:
+        exited_pid, status, rusage = os.wait4(pid, os.WNOHANG)
+        if exited_pid != 0:
+            return status, rusage
+
+        await asyncio.sleep(interval)
+        interval = min(2 * interval, POLL_INTERVAL)
+
+
+def stop_process(
+    process: "subprocess.Popen[Any]", timeout: float = 2 * STOP_GRACE_PERIOD
+) -> None:
+    """
+    Stops the given launcher process, which passes the signal on to the
+    command that it is running, killing it if it does not stop in time.
+    """
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+@contextlib.contextmanager
+def collect_usage() -> Iterator[ResourceUsage]:
+    """
+    Collects the resource usage of all of the child processes that are waited
+    on in the current context while the context manager is open. Each thread
+    and each asyncio task has its own context, so tasks running at the same
+    time do not collect each other's usage.
+    """
+    usage = ResourceUsage()
+
+    token = _collectors.set(_collectors.get() + (usage,))
+    try:
+        yield usage
+    finally:
+        _collectors.reset(token)
@@ -0,0 +1,225 @@
+from typing import Any, List, Optional, Tuple
+
+import math
+
+import numpy as np
+
+# Number of bits of precision of the Sobol points
+SOBOL_BITS = 32
+
+# Direction numbers of the Sobol sequence, from the "new-joe-kuo-6.21201" set
+# of Joe and Kuo (2008), as the degree "s" and coefficients "a" of the
+# primitive polynomial and the initial direction numbers "m" of each
+# dimension after the first
+SOBOL_DIRECTIONS: List[Tuple[int, int, List[int]]] = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]),
+    (4, 4, [1, 3, 5, 13]),
+    (5, 2, [1, 1, 5, 5, 17]),
+    (5, 4, [1, 1, 5, 5, 5]),
+    (5, 7, [1, 1, 7, 11, 19]),
+    (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]),
+    (5, 14, [1, 3, 5, 5, 31]),
+    (6, 1, [1, 3, 3, 9, 7, 49]),
+    (6, 13, [1, 1, 1, 15, 21, 21]),
+    (6, 16, [1, 3, 1, 13, 27, 49]),
+    (6, 19, [1, 1, 1, 15, 7, 5]),
+    (6, 22, [1, 3, 1, 15, 13, 25]),
+    (6, 25, [1, 1, 5, 5, 19, 61]),
+    (7, 1, [1, 3, 7, 11, 23, 15, 103]),
+    (7, 4, [1, 3, 7, 13, 13, 15, 69]),
+]
+
+METHODS = ["lhs", "sobol", "halton"]
+
+
+def sample_unit_cube(
+    method: str, num_samples: int, num_dims: int, seed: int
+) -> "np.ndarray[Any, Any]":
+    """
+    Returns the given number of points in the unit hypercube of the given
+    number of dimensions, spread out over it using the given method. The
+    points are randomized using the given seed, so the same seed always
+    gives the same points.
+
+    >>> points = sample_unit_cube("lhs", 8, 2, seed=1)
+    >>> points.shape
+    (8, 2)
+    >>> sorted(np.floor(points[:, 0] * 8).astype(int).tolist())
+    [0, 1, 2, 3, 4, 5, 6, 7]
+    >>> bool(np.all(points == sample_unit_cube("lhs", 8, 2, seed=1)))
+    True
+    """
+    rng = np.random.default_rng(seed)
+
+    if method == "lhs":
+        return latin_hypercube(num_samples, num_dims, rng)
+    elif method == "sobol":
+        return sobol(num_samples, num_dims, rng)
+    elif method == "halton":
+        return halton(num_samples, num_dims, rng)
+
+    raise Exception(
+        'Unknown sampling method "{}". Valid methods are {}.'.format(method, METHODS)
+    )
+
+
+def latin_hypercube(
+    num_samples: int, num_dims: int, rng: np.random.Generator
+) -> "np.ndarray[Any, Any]":
+    """
+    Returns a Latin hypercube sample, which has exactly one point in each of
+    the equal width intervals that each dimension is divided into. The point
+    in each interval is placed uniformly at random within it.
+    """
+    strata = np.stack([rng.permutation(num_samples) for _ in range(num_dims)], axis=1)
+
+    return (strata + rng.random((num_samples, num_dims))) / num_samples
+
+
+def sobol(
+    num_samples: int, num_dims: int, rng: Optional[np.random.Generator]
+) -> "np.ndarray[Any, Any]":
+    """
+    Returns the first points of a Sobol sequence, scrambled with a random
+    linear matrix scramble and digital shift. The points are not scrambled if
+    no random number generator is given.
+
+    The points are best balanced when the number of samples is a power of
+    two.
+
+    The points are generated in their natural rather than Gray code order,
+    which gives the same first 2 ** m points in a different order:
+
+    >>> sobol(4, 3, rng=None).tolist()
+    [[0.0, 0.0, 0.0], [0.5, 0.5, 0.5], [0.25, 0.75, 0.75], [0.75, 0.25, 0.25]]
+    """
+    if num_dims > len(SOBOL_DIRECTIONS) + 1:
+        raise Exception(
+            "Sobol sampling supports at most {} parameters, but was given {}.".format(
+                len(SOBOL_DIRECTIONS) + 1, num_dims
+            )
+        )
+
+    if num_samples > 2**SOBOL_BITS:
+        raise Exception(
+            "Sobol sampling supports at most {} samples, but was asked for {}.".format(
+                2**SOBOL_BITS, num_samples
+            )
+        )
+
+    directions = np.stack(
+        [sobol_directions(dim) for dim in range(num_dims)]
+    )  # (num_dims, SOBOL_BITS)
+
+    shift = np.zeros(num_dims, dtype=np.uint64)
+    if rng is not None:
+        directions = scramble_directions(directions, rng)
+        shift = rng.integers(0, 2**SOBOL_BITS, size=num_dims, dtype=np.uint64)
+
+    indices = np.arange(num_samples, dtype=np.uint64)
+
+    points = np.zeros((num_samples, num_dims), dtype=np.uint64)
+    for bit in range(SOBOL_BITS):
+        has_bit = ((indices >> np.uint64(bit)) & np.uint64(1)).astype(bool)
+        points[has_bit] ^= directions[:, bit]
+
+    return (points ^ shift) / float(2**SOBOL_BITS)
+
+
+def sobol_directions(dim: int) -> "np.ndarray[Any, Any]":
+    """
+    Returns the direction numbers of the given dimension of the Sobol
+    sequence, as integers scaled by 2 ** SOBOL_BITS.
+    """
+    v = [0] * SOBOL_BITS
+
+    if dim == 0:
+        for k in range(SOBOL_BITS):
+            v[k] = 1 << (SOBOL_BITS - 1 - k)
+
+        return np.array(v, dtype=np.uint64)
+
+    s, a, m = SOBOL_DIRECTIONS[dim - 1]
+    for k in range(min(s, SOBOL_BITS)):
+        v[k] = m[k] << (SOBOL_BITS - 1 - k)
+
+    for k in range(s, SOBOL_BITS):
+        v[k] = v[k - s] ^ (v[k - s] >> s)
+        for i in range(1, s):
+            if (a >> (s - 1 - i)) & 1:
+                v[k] ^= v[k - i]
+
+    return np.array(v, dtype=np.uint64)
+
+
+def scramble_directions(
+    directions: "np.ndarray[Any, Any]", rng: np.random.Generator
+) -> "np.ndarray[Any, Any]":
+    """
+    Applies a random linear matrix scramble to the given direction numbers of
+    each dimension, which multiplies their bits by a random lower triangular
+    binary matrix with a unit diagonal. This keeps the balance of the points.
+    """
+    num_dims = directions.shape[0]
+
+    # The bits of each direction number, with the most significant bit first
+    powers = np.uint64(1) << np.arange(SOBOL_BITS - 1, -1, -1, dtype=np.uint64)
+    bits = ((directions[:, :, np.newaxis] & powers) > 0).astype(np.int64)
+
+    scrambled = np.zeros_like(directions)
+    for dim in range(num_dims):
+        matrix = np.tril(rng.integers(0, 2, size=(SOBOL_BITS, SOBOL_BITS)), -1)
+        matrix += np.eye(SOBOL_BITS, dtype=np.int64)
+
+        new_bits = (bits[dim] @ matrix.T) % 2
+        scrambled[dim] = (new_bits.astype(np.uint64) * powers).sum(axis=1)
+
+    return scrambled
+
+
+def halton(
+    num_samples: int, num_dims: int, rng: np.random.Generator
+) -> "np.ndarray[Any, Any]":
+    """
+    Returns the first points of a Halton sequence, scrambled with random
+    permutations of the digits of each dimension.
+    """
+    points = np.zeros((num_samples, num_dims))
+    indices = np.arange(num_samples)
+
+    for dim, base in enumerate(first_primes(num_dims)):
+        # Enough digits to reach the precision of a float
+        num_digits = math.ceil(52 / math.log2(base))
+
+        remaining = indices.copy()
+        scale = 1.0 / base
+        for _ in range(num_digits):
+            remaining, digits = np.divmod(remaining, base)
+            points[:, dim] += rng.permutation(base)[digits] * scale
+            scale /= base
+
+    return points
+
+
+def first_primes(n: int) -> List[int]:
+    """
+    Returns the first n prime numbers.
+
+    >>> first_primes(5)
+    [2, 3, 5, 7, 11]
+    """
+    primes: List[int] = []
+
+    candidate = 2
+    while len(primes) < n:
+        if all(candidate % prime != 0 for prime in primes):
+            primes.append(candidate)
+
+        candidate += 1
+
+    return primes
@@ -0,0 +1,159 @@
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import json
+import numbers
+
+import numpy as np
+
+from . import ledger
+
+# Number of pending tasks to compare against the task history at once, which
+# bounds the memory used for the distance matrix
+CHUNK_SIZE = 1024
+
+
+def order_longest_first(
+    combs: Sequence[Dict[str, Any]],
+    completed: ledger.TaskLedger,
+    task_name: Callable[[Dict[str, Any]], str],
+    shared_params: Optional[Dict[str, Any]] = None,
+) -> Sequence[int]:
+    """
+    Returns the indices of the given parameter combinations in the order to
+    run them in, with the tasks that are expected to take the longest first.
+
+    The duration of each pending task is estimated from the recorded duration
+    of the completed task nearest to it in parameter space. Tasks that have
+    already been completed are placed last. If there are no recorded tasks
+    with the same parameters, then the combinations are kept in order.
+
+    The given shared parameters, such as the MESA parameters of a GYRE
+    sub-grid, are added to each combination when comparing it against the
+    history.
+    """
+    shared = shared_params if shared_params is not None else {}
+    params = [dict(shared, **comb) for comb in combs]
+
+    if len(params) == 0:
+        return range(0)
+
+    history_params, history_durations = read_task_history(completed, set(params[0]))
+    if len(history_params) == 0:
+        return range(len(params))
+
+    estimates = estimate_durations(params, history_params, history_durations)
+
+    for i, comb in enumerate(combs):
+        if completed.is_completed(task_name(comb)):
+            estimates[i] = -1.0
+
+    return list(np.argsort(-estimates, kind="stable"))
+
+
+def read_task_history(
+    completed: ledger.TaskLedger, keys: Set[str]
+) -> Tuple[List[Dict[str, Any]], "np.ndarray[Any, Any]"]:
+    """
+    Returns the parameters and durations of the recorded tasks that have
+    exactly the given parameter names.
+
+    Tasks that did not complete, such as those that timed out, are left out,
+    since their durations were cut short and would make similar tasks look
+    quicker than they are.
+    """
+    history_params = []
+    durations = []
+    for record in completed.records.values():
+        if record.get("params", "") == "":
+            continue
+
+        if record.get("status", "") not in ["", ledger.COMPLETED]:
+            continue
+
+        try:
+            params = json.loads(record["params"])
+            duration = float(record["duration"])
+        except ValueError:
+            continue
+
+        if set(params) == keys:
+            history_params.append(params)
+            durations.append(duration)
+
+    return history_params, np.array(durations, dtype=float)
+
+
+def estimate_durations(
+    params: List[Dict[str, Any]],
+    history_params: List[Dict[str, Any]],
+    history_durations: "np.ndarray[Any, Any]",
+) -> "np.ndarray[Any, Any]":
+    """
+    Estimates the duration of each of the given parameter combinations as the
+    duration of the nearest combination in the history.
+
+    Numeric parameters are scaled by their range, so that each parameter has
+    the same weight, and other parameters add a distance of one when their
+    values differ.
+
+    >>> history = [{"m": 1.0, "z": "a"}, {"m": 5.0, "z": "a"}, {"m": 5.0, "z": "b"}]
+    >>> estimate_durations([{"m": 4.0, "z": "a"}, {"m": 1.0, "z": "b"}], \
+            history, np.array([10.0, 100.0, 50.0]))
+    array([100.,  10.])
+    """
+    keys = sorted(params[0])
+    is_numeric = [is_numeric_param(key, params + history_params) for key in keys]
+
+    points = encode_params(keys, is_numeric, params + history_params)
+    pending = points[: len(params)]
+    history = points[len(params) :]
+
+    estimates = np.empty(len(params))
+    for start in range(0, len(params), CHUNK_SIZE):
+        chunk = pending[start : start + CHUNK_SIZE]
+
+        distances = np.zeros((len(chunk), len(history)))
+        for i in range(len(keys)):
+            difference = chunk[:, i, np.newaxis] - history[np.newaxis, :, i]
+
+            if is_numeric[i]:
+                distances += difference**2
+            else:
+                distances += difference != 0
+
+        nearest = np.argmin(distances, axis=1)
+        estimates[start : start + CHUNK_SIZE] = history_durations[nearest]
+
+    return estimates
+
+
+def is_numeric_param(key: str, params: List[Dict[str, Any]]) -> bool:
+    return all(
+        isinstance(p.get(key), numbers.Real) and not isinstance(p.get(key), bool)
+        for p in params
+    )
+
+
+def encode_params(
+    keys: List[str], is_numeric: List[bool], params: List[Dict[str, Any]]
+) -> "np.ndarray[Any, Any]":
+    """
+    Encodes the given parameter combinations as an array of points, with one
+    column per parameter. Numeric parameters are scaled to the range [0, 1]
+    and other parameters are replaced with a code for each distinct value.
+    """
+    points = np.zeros((len(params), len(keys)))
+    for i, key in enumerate(keys):
+        if is_numeric[i]:
+            values = np.array([p[key] for p in params], dtype=float)
+
+            value_range = values.max() - values.min()
+            if value_range > 0:
+                points[:, i] = (values - values.min()) / value_range
+        else:
+            codes: Dict[str, int] = {}
+            for j, p in enumerate(params):
+                value = json.dumps(p.get(key), sort_keys=True, default=str)
+                points[j, i] = codes.setdefault(value, len(codes))
+
+    return points
@@ -0,0 +1,187 @@
+from typing import Dict, List, Optional
+
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+
+
+class TaskStore:
+    """
+    A content-addressed store of the outputs of completed tasks.
+
+    Each entry is a directory named after the key of the task that created
+    it, so any task with the same key can reuse the outputs instead of being
+    run again. Outputs are hard linked into and out of the store where
+    possible, so the store takes up little extra disk space.
+
+    Since the outputs are hard linked, they must be removed (rather than
+    overwritten in place) before a task is run again. See remove_outputs.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def contains(self, key: str) -> bool:
+        return os.path.isdir(self.entry_path(key))
+
+    def put(self, key: str, outputs: Dict[str, str]) -> None:
+        """
+        Adds the given outputs to the store under the given key. The outputs
+        are a dict of the names to store them under and the filepaths of the
+        files or directories. Outputs that do not exist are skipped.
+
+        If there is already an entry for the key, then it is kept as-is.
+        """
+        entry = self.entry_path(key)
+        if os.path.isdir(entry):
+            return
+
+        parent = os.path.dirname(entry)
+        os.makedirs(parent, exist_ok=True)
+
+        # Build the entry in a temporary directory and then move it into
+        # place, so that partial entries are never visible
+        temp_entry = tempfile.mkdtemp(dir=parent, prefix=".tmp_")
+        try:
+            for name, source in outputs.items():
+                if os.path.exists(source):
+                    link_tree(source, os.path.join(temp_entry, name))
+
+            os.rename(temp_entry, entry)
+        except OSError:
+            shutil.rmtree(temp_entry, ignore_errors=True)
+
+            # Another process may have added the same entry first
+            if not os.path.isdir(entry):
+                raise
+
+    def get(self, key: str, outputs: Dict[str, str]) -> bool:
+        """
+        Places the stored outputs for the given key at the given filepaths,
+        replacing anything already there. Returns False if the key is not in
+        the store.
+        """
+        entry = self.entry_path(key)
+        if not os.path.isdir(entry):
+            return False
+
+        for name, destination in outputs.items():
+            stored = os.path.join(entry, name)
+
+            remove_outputs([destination])
+            if os.path.exists(stored):
+                link_tree(stored, destination)
+
+        return True
+
+
+def create_task_key(parts: List[str]) -> str:
+    """
+    Creates a key for a task by hashing the given parts that identify it,
+    such as its rendered config files and the identity of the executable
+    that it runs.
+
+    >>> create_task_key(["a", "bc"]) == create_task_key(["a", "bc"])
+    True
+    >>> create_task_key(["a", "bc"]) == create_task_key(["ab", "c"])
+    False
+    """
+    sha = hashlib.sha256()
+    for part in parts:
+        encoded = part.encode("utf-8")
+
+        # Include the length of each part, so that the boundaries between the
+        # parts are part of the key
+        sha.update(str(len(encoded)).encode("utf-8") + b":")
+        sha.update(encoded)
+
+    return sha.hexdigest()
+
+
+def executable_identity(command: str, directory: Optional[str] = None) -> str:
+    """
+    Returns a string identifying the executable of the given command, based on
+    its absolute path, size, and modification time, so that it changes when
+    the executable is rebuilt.
+
+    Environment variables and "~" in the command are expanded first, as the
+    shell would when running it. Commands with a path are looked up relative
+    to the given directory, which should be the directory they are run in.
+    Commands without a path are looked up on the PATH. If the executable
+    cannot be found, then the command itself is used.
+
+    >>> directory = tempfile.mkdtemp()
+    >>> open(os.path.join(directory, "gyre"), "w").close()
+    >>> os.environ["MEGYR_DOCTEST_DIR"] = directory
+    >>> identity = executable_identity("$MEGYR_DOCTEST_DIR/gyre")
+    >>> identity.startswith(os.path.join(directory, "gyre") + ":")
+    True
+    >>> del os.environ["MEGYR_DOCTEST_DIR"]
+    >>> shutil.rmtree(directory)
+    """
+    command = os.path.expanduser(os.path.expandvars(command))
+
+    if os.sep in command:
+        filepath: Optional[str] = os.path.abspath(
+            os.path.join(directory if directory is not None else ".", command)
+        )
+    else:
+        filepath = shutil.which(command)
+
+    if filepath is None or not os.path.isfile(filepath):
+        return command
+
+    stat = os.stat(filepath)
+
+    return "{}:{}:{}".format(filepath, stat.st_size, stat.st_mtime_ns)
+
+
+def link_tree(source: str, destination: str) -> None:
+    if os.path.isdir(source):
+        shutil.copytree(source, destination, copy_function=link_file)
+    else:
+        link_file(source, destination)
+
+
+def link_file(source: str, destination: str) -> None:
+    try:
+        os.link(source, destination)
+    except OSError:
+        # Hard links are not supported across filesystems, so fall back to
+        # copying the file
+        shutil.copy2(source, destination)
+
+
+def remove_outputs(filepaths: List[str]) -> None:
+    """
+    Removes the given output files and directories, if they exist.
+    """
+    for filepath in filepaths:
+        if os.path.isdir(filepath) and not os.path.islink(filepath):
+            shutil.rmtree(filepath)
+        elif os.path.lexists(filepath):
+            os.remove(filepath)
+
+
+def break_links(directory: str) -> None:
+    """
+    Replaces each file in the given directory that is hard linked elsewhere,
+    such as into a task store, with a copy of itself, so that the file can be
+    changed in place without changing the other links to it.
+    """
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            filepath = os.path.join(root, filename)
+            if os.path.islink(filepath) or os.stat(filepath).st_nlink <= 1:
+                continue
+
+            fd, temp_filepath = tempfile.mkstemp(dir=root, prefix=".tmp_")
+            os.close(fd)
+
+            shutil.copy2(filepath, temp_filepath)
+            os.replace(temp_filepath, filepath)
@@ -0,0 +1,175 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import math
+import os
+import signal
+import time
+
+# Longest time between checks of the limits of a running process, in seconds
+CHECK_INTERVAL = 1.0
+
+# Extra CPU time a process is given past its CPU time limit to exit after
+# being sent SIGXCPU, in seconds, before the kernel kills it
+CPU_GRACE_PERIOD = 5
+
+
+class TaskTimeoutError(Exception):
+    """
+    Raised when a MESA or GYRE run is stopped for going over one of its time
+    limits.
+    """
+
+
+class TaskLimits:
+    """
+    Limits on how long a MESA or GYRE run may take.
+
+    * wall_time - seconds that the run may take
+    * cpu_time - seconds of CPU time that the run may use, summed over all of
+      its threads
+    * stall_time - seconds that the run may go without any of the watched
+      files growing or being modified, such as a MESA run whose timestep has
+      collapsed. Files that do not exist yet count as not having changed.
+    """
+
+    def __init__(
+        self,
+        wall_time: Optional[float] = None,
+        cpu_time: Optional[float] = None,
+        stall_time: Optional[float] = None,
+        watched_files: Optional[List[str]] = None,
+    ) -> None:
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.stall_time = stall_time
+        self.watched_files = watched_files if watched_files is not None else []
+
+    @property
+    def needs_supervision(self) -> bool:
+        """
+        Whether the run needs to be checked while it is running. The CPU time
+        limit is enforced by the operating system, so it does not.
+        """
+        return self.wall_time is not None or self.stall_time is not None
+
+    def cpu_rlimit(self) -> Optional[Tuple[int, int]]:
+        """
+        Returns the soft and hard RLIMIT_CPU values that enforce the CPU time
+        limit, or None if there is no CPU time limit.
+
+        >>> TaskLimits(cpu_time=59.5).cpu_rlimit()
+        (60, 65)
+        """
+        if self.cpu_time is None:
+            return None
+
+        soft = max(1, math.ceil(self.cpu_time))
+
+        return soft, soft + CPU_GRACE_PERIOD
+
+
+def task_limits(
+    config: Dict[str, Any], program: str, watched_files: Optional[List[str]] = None
+) -> Optional[TaskLimits]:
+    """
+    Creates the limits for a run of the given program ("mesa" or "gyre") from
+    its timeout settings, or returns None if none of them are set.
+
+    Only MESA runs have a stall limit, since GYRE does not write any progress
+    output that could be watched while it runs.
+    """
+    settings = config["settings"]
+
+    wall_time = settings.get(program + "_timeout")
+    cpu_time = settings.get(program + "_cpu_timeout")
+    stall_time = settings.get("mesa_stall_timeout") if program == "mesa" else None
+
+    if wall_time is None and cpu_time is None and stall_time is None:
+        return None
+
+    return TaskLimits(wall_time, cpu_time, stall_time, watched_files)
+
+
+class Supervisor:
+    """
+    Checks a running launcher process against the limits of the command that
+    it runs, sending it SIGTERM if the command goes over one of them. The
+    launcher then stops the process group of the command, killing it if it
+    does not stop in time.
+    """
+
+    def __init__(self, pid: int, limits: TaskLimits) -> None:
+        self.pid = pid
+        self.limits = limits
+
+        self.timeout_reason: Optional[str] = None
+
+        self._start = time.monotonic()
+        self._last_progress = self._start
+        self._last_file_states = self._watched_file_states()
+
+    def check(self) -> None:
+        """
+        Checks the process against its limits. Should be called regularly
+        while the process is running.
+        """
+        now = time.monotonic()
+
+        if self.timeout_reason is not None:
+            return
+
+        self.timeout_reason = self._find_timeout(now)
+
+        if self.timeout_reason is not None:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def check_exit(self, exit_code: int, cpu_time: float) -> None:
+        """
+        Raises a TaskTimeoutError if the process, which exited with the given
+        exit code after using the given CPU time, was stopped for going over
+        one of its limits.
+        """
+        if self.timeout_reason is None and self.limits.cpu_time is not None:
+            killed_by = -exit_code
+            if killed_by == signal.SIGXCPU or (
+                killed_by == signal.SIGKILL and cpu_time >= self.limits.cpu_time
+            ):
+                self.timeout_reason = "used more than {} seconds of CPU time".format(
+                    self.limits.cpu_time
+                )
+
+        if self.timeout_reason is not None:
+            raise TaskTimeoutError(self.timeout_reason)
+
+    def _find_timeout(self, now: float) -> Optional[str]:
+        if self.limits.wall_time is not None:
+            if now - self._start > self.limits.wall_time:
+                return "ran for more than {} seconds".format(self.limits.wall_time)
+
+        # Without any files to watch there is no way to tell that the run is
+        # making progress, so it is never treated as stalled
+        if self.limits.stall_time is not None and len(self.limits.watched_files) > 0:
+            file_states = self._watched_file_states()
+            if file_states != self._last_file_states:
+                self._last_file_states = file_states
+                self._last_progress = now
+            elif now - self._last_progress > self.limits.stall_time:
+                return "made no progress for more than {} seconds".format(
+                    self.limits.stall_time
+                )
+
+        return None
+
+    def _watched_file_states(self) -> List[Optional[Tuple[int, int]]]:
+        states: List[Optional[Tuple[int, int]]] = []
+        for filepath in self.limits.watched_files:
+            try:
+                stat = os.stat(filepath)
+                states.append((stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                states.append(None)
+
+        return states
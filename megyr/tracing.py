@@ -0,0 +1,226 @@
+from typing import Any, Callable, cast, Dict, Iterator, List, Optional, TypeVar
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+from . import util
+
+# The tracer to record spans to, if tracing is enabled
+_tracer: Optional["Tracer"] = None
+
+# Number of events to buffer in each process before appending them to the
+# events file
+FLUSH_SIZE = 1000
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Tracer:
+    """
+    Records timed spans of the stages of a run as Chrome trace events.
+
+    Events are buffered in each process and appended to a shared events file
+    when flushed, so the spans from forked worker processes are collected
+    along with those of the main process. Once the run is finished, the
+    events are written out as a Chrome trace file, which can be opened in
+    chrome://tracing or Perfetto, along with a summary table of the time
+    spent in each stage.
+    """
+
+    def __init__(self, trace_filepath: str) -> None:
+        self.trace_filepath = trace_filepath
+        self.events_filepath = trace_filepath + ".events.jsonl"
+
+        self._start_ns = time.perf_counter_ns()
+        self._events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+        if os.path.isfile(self.events_filepath):
+            os.remove(self.events_filepath)
+
+    def add_span(
+        self, name: str, category: str, start_ns: int, end_ns: int, args: Dict[str, Any]
+    ) -> None:
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start_ns - self._start_ns) / 1000,
+            "dur": (end_ns - start_ns) / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": args,
+        }
+
+        with self._lock:
+            self._events.append(event)
+            should_flush = len(self._events) >= FLUSH_SIZE
+
+        if should_flush:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Appends the buffered events of this process to the events file.
+        """
+        with self._lock:
+            events = self._events
+            self._events = []
+
+        if len(events) == 0:
+            return
+
+        lines = "".join(json.dumps(event, default=str) + "\n" for event in events)
+
+        with util.output_lock():
+            with open(self.events_filepath, "a") as f:
+                f.write(lines)
+
+    def reset_after_fork(self) -> None:
+        # The events buffered before the fork belong to the parent process
+        self._events = []
+        self._lock = threading.Lock()
+
+    def write_trace(self) -> pd.DataFrame:
+        """
+        Writes out the Chrome trace file and the summary table of the events
+        recorded so far, returning the summary table.
+        """
+        self.flush()
+
+        events = []
+        if os.path.isfile(self.events_filepath):
+            with open(self.events_filepath) as f:
+                events = [json.loads(line) for line in f if line.strip() != ""]
+
+        for pid in sorted({event["pid"] for event in events}):
+            events.append(
+                {
+                    "name": "process_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "args": {"name": "megyr" if pid == os.getpid() else "megyr worker"},
+                }
+            )
+
+        with open(self.trace_filepath, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+        summary = summarize_spans([event for event in events if event["ph"] == "X"])
+        summary.to_csv(self.trace_filepath + ".summary.csv", index=False)
+
+        os.remove(self.events_filepath)
+
+        return summary
+
+
+def summarize_spans(spans: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Creates a table of the number of spans of each stage and the time spent
+    in them, in seconds, with the stages that took the most time first.
+
+    >>> summarize_spans([ \
+            {"name": "exec_gyre", "cat": "gyre", "dur": 2000000.0}, \
+            {"name": "exec_gyre", "cat": "gyre", "dur": 1000000.0}, \
+            {"name": "render_template", "cat": "render", "dur": 500.0}, \
+        ])
+      category            stage  count   total    mean     max
+    0     gyre        exec_gyre      2  3.0000  1.5000  2.0000
+    1   render  render_template      1  0.0005  0.0005  0.0005
+    """
+    if len(spans) == 0:
+        return pd.DataFrame(
+            columns=["category", "stage", "count", "total", "mean", "max"]
+        )
+
+    data = pd.DataFrame(
+        {
+            "category": [span["cat"] for span in spans],
+            "stage": [span["name"] for span in spans],
+            "duration": [span["dur"] / 1e6 for span in spans],
+        }
+    )
+
+    summary = data.groupby(["category", "stage"])["duration"].agg(
+        ["count", "sum", "mean", "max"]
+    )
+    summary = summary.rename(columns={"sum": "total"})
+
+    summary = summary.sort_values("total", ascending=False).round(4)
+
+    return summary.reset_index()
+
+
+def start_tracing(trace_filepath: str) -> None:
+    global _tracer
+
+    _tracer = Tracer(trace_filepath)
+
+
+def finish_tracing() -> Optional[pd.DataFrame]:
+    """
+    Writes out the trace of the run and stops tracing, returning the summary
+    table of the trace, or None if tracing was not enabled.
+    """
+    global _tracer
+
+    if _tracer is None:
+        return None
+
+    summary = _tracer.write_trace()
+    _tracer = None
+
+    return summary
+
+
+def flush() -> None:
+    if _tracer is not None:
+        _tracer.flush()
+
+
+@contextlib.contextmanager
+def span(name: str, category: str, **args: Any) -> Iterator[None]:
+    """
+    Records the time spent in the context as a span with the given name,
+    category, and arguments, if tracing is enabled.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+
+    start_ns = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        tracer.add_span(name, category, start_ns, time.perf_counter_ns(), args)
+
+
+def traced(name: str, category: str) -> Callable[[F], F]:
+    """
+    Decorator that records each call of the decorated function as a span.
+    """
+
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name, category):
+                return func(*args, **kwargs)
+
+        return cast(F, wrapper)
+
+    return decorator
+
+
+def _reset_after_fork() -> None:
+    if _tracer is not None:
+        _tracer.reset_after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
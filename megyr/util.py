@@ -1,29 +1,134 @@
-from typing import Any, Callable, cast, Dict, List, Optional
+from typing import Any, Callable, cast, Dict, Iterator, List, Optional, Tuple
 
+import contextlib
 import datetime
 import importlib.util
 import os
 import os.path
 import subprocess
 import sys
+import threading
 
+import numpy as np
 import pandas as pd
 import pystache
+import pystache.loader
+
+from . import resources
+from .supervision import TaskLimits
 
 MP_THREADS_ENV_VAR = "OMP_NUM_THREADS"
 
+# Lock used to keep console output and appends to shared files from
+# interleaving. Replaced with a process shared lock during parallel runs.
+_output_lock: Any = threading.Lock()
+
 
 def create_dir(path: str) -> None:
     os.makedirs(path, exist_ok=True)
 
 
-def run_in_dir(command: str, directory: str) -> None:
-    subprocess.check_call(command, cwd=directory, shell=True)
+def run_in_dir(
+    command: str,
+    directory: str,
+    env: Optional[Dict[str, str]] = None,
+    log_filepath: Optional[str] = None,
+    limits: Optional[TaskLimits] = None,
+) -> resources.ResourceUsage:
+    """
+    Runs the given shell command in the given directory, returning the
+    resources used by it. Raises a CalledProcessError if the command fails,
+    or a TaskTimeoutError if it goes over one of the given limits.
+
+    If a log filepath is given, then the output of the command is written to
+    that file instead of the terminal.
+    """
+    return_code, usage = resources.run_command(
+        command, directory, env, log_filepath, limits
+    )
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, command)
+
+    return usage
+
+
+async def run_in_dir_async(
+    command: str,
+    directory: str,
+    env: Optional[Dict[str, str]] = None,
+    log_filepath: Optional[str] = None,
+    limits: Optional[TaskLimits] = None,
+) -> resources.ResourceUsage:
+    """
+    Runs the given shell command in the same way as run_in_dir, without
+    blocking the event loop while it runs.
+    """
+    return_code, usage = await resources.run_command_async(
+        command, directory, env, log_filepath, limits
+    )
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, command)
+
+    return usage
 
 
 def render_mustache_file(f: str, values: Dict[str, str]) -> str:
-    renderer = pystache.Renderer()
-    return cast(str, renderer.render_path(f, values))
+    return _template_cache.render(f, values)
+
+
+class TemplateCache:
+    """
+    A cache of parsed mustache templates, so that each template file is only
+    read and parsed once no matter how many times it is rendered.
+
+    The modification time and size of the file are checked each time the
+    template is used, and the template is loaded again if the file has
+    changed since it was cached.
+    """
+
+    def __init__(self) -> None:
+        self.renderer = pystache.Renderer()
+
+        self._templates: Dict[str, Tuple[Tuple[int, int], Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, f: str) -> Any:
+        stat = os.stat(f)
+        source = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            cached = self._templates.get(f)
+
+        if cached is not None and cached[0] == source:
+            return cached[1]
+
+        contents = pystache.loader.Loader().read(f)
+        template = pystache.parse(contents)
+
+        with self._lock:
+            self._templates[f] = (source, template)
+
+        return template
+
+    def render(self, f: str, values: Dict[str, Any]) -> str:
+        return cast(str, self.renderer.render(self.get(f), values))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._templates.clear()
+
+
+_template_cache = TemplateCache()
+
+
+def preload_templates(filepaths: List[str]) -> None:
+    """
+    Loads the given template files into the template cache, so that they are
+    already parsed in any worker processes that are forked afterwards.
+    """
+    for f in filepaths:
+        if os.path.isfile(f):
+            _template_cache.get(f)
 
 
 def set_num_mp_threads(num: int) -> None:
@@ -32,6 +137,46 @@ def set_num_mp_threads(num: int) -> None:
     os.environ[MP_THREADS_ENV_VAR] = str(num)
 
 
+def set_output_lock(lock: Optional[Any]) -> None:
+    global _output_lock
+
+    _output_lock = lock if lock is not None else threading.Lock()
+
+
+@contextlib.contextmanager
+def output_lock() -> Iterator[None]:
+    with _output_lock:
+        yield
+
+
+def print_progress(message: str) -> None:
+    with output_lock():
+        print(message, flush=True)
+
+
+def create_mp_threads_env(num: Optional[int]) -> Dict[str, str]:
+    """
+    Creates a copy of the current environment variables for a child process,
+    with the number of Open MP threads set to the given number. If no number
+    is given, then the child inherits the current number of threads.
+
+    Unlike set_num_mp_threads, this does not modify the environment of the
+    current process, so different children can be given different numbers of
+    threads at the same time.
+
+    >>> create_mp_threads_env(2)[MP_THREADS_ENV_VAR]
+    '2'
+    """
+    env = dict(os.environ)
+
+    if num is not None:
+        assert num > 0
+
+        env[MP_THREADS_ENV_VAR] = str(num)
+
+    return env
+
+
 def eprint(*args: Any, **kwargs: Any) -> None:
     print(*args, file=sys.stderr, **kwargs)
 
@@ -40,30 +185,177 @@ def print_runtime_error_divider() -> None:
     eprint("------------------------")
 
 
+def add_constant_columns(rows: pd.DataFrame, values: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Returns a copy of the given rows with a column added for each of the given
+    values, with the value repeated in every row. Any existing columns with
+    the same names are replaced in place.
+
+    >>> rows = pd.DataFrame({"l": [1, 1], "freq": [1.5, 2.5]})
+    >>> add_constant_columns(rows, {"l": 2, "profile": 10})
+       l  freq  profile
+    0  2   1.5       10
+    1  2   2.5       10
+    """
+    num_rows = len(rows)
+
+    columns = {column: rows[column].to_numpy() for column in rows.columns}
+    columns.update({key: np.full(num_rows, value) for key, value in values.items()})
+
+    return pd.DataFrame(columns, index=rows.index, copy=False)
+
+
 class DataFrameAggregator:
-    def __init__(self, should_read: bool) -> None:
-        self.data = pd.DataFrame()
+    """
+    Collects rows of data from many files into one table.
+
+    Appended rows are kept as separate chunks and concatenated once, when the
+    data is needed, so appending takes the same time no matter how many rows
+    have been collected. Constant values to attach to each chunk, such as the
+    grid parameters that produced it, are stored once per chunk and only
+    expanded into categorical columns when the chunks are concatenated.
+
+    If a stream filepath is given, then each chunk is instead written to that
+    csv file as soon as it is appended, so memory use does not grow with the
+    number of rows. The rows are written to a temporary ".partial" file until
+    write_to_file is called. When streaming, every chunk must have the same
+    columns as the first one, though columns may be missing from later chunks.
+    """
+
+    def __init__(
+        self, should_read: bool, stream_filepath: Optional[str] = None
+    ) -> None:
         self.should_read = should_read
+        self.stream_filepath = stream_filepath
+
+        self._chunks: List[pd.DataFrame] = []
+        self._chunk_constants: List[Dict[str, Any]] = []
+        self._stream_columns: Optional[List[str]] = None
+
+    @property
+    def data(self) -> pd.DataFrame:
+        if self.stream_filepath is not None:
+            raise Exception(
+                "Tried to get the data of a DataFrameAggregator that is streaming its rows to a file."
+            )
+
+        if len(self._chunks) != 1 or len(self._chunk_constants[0]) > 0:
+            self._chunks = [self._concat_chunks()]
+            self._chunk_constants = [{}]
+
+        return self._chunks[0]
 
     def append_from_file(
         self,
         filepath: str,
         read_function: Callable[[str], Optional[pd.DataFrame]] = pd.read_csv,
         transform_func: Callable[[pd.DataFrame], pd.DataFrame] = lambda r: r,
+        constants: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        if self.should_read:
+            self.append_rows(read_function(filepath), transform_func, constants)
+
+    def append_rows(
+        self,
+        new_rows: Optional[pd.DataFrame],
+        transform_func: Callable[[pd.DataFrame], pd.DataFrame] = lambda r: r,
+        constants: Optional[Dict[str, Any]] = None,
     ) -> None:
+        """
+        Appends the given rows, after applying the given transformation to
+        them and adding a column for each of the given constant values.
+        """
         if self.should_read:
-            new_rows = read_function(filepath)
             assert new_rows is not None
 
             transformed = transform_func(new_rows)
+            constants = constants if constants is not None else {}
 
-            # TODO: is tranformed supposed to be used here instead of new_rows?
-            self.data = pd.concat([self.data, new_rows])
+            if self.stream_filepath is not None:
+                self._write_chunk(
+                    self.stream_filepath + ".partial",
+                    add_constant_columns(transformed, constants),
+                )
+            else:
+                self._chunks.append(transformed)
+                self._chunk_constants.append(dict(constants))
 
     def write_to_file(self, filepath: str) -> None:
-        if self.should_read:
-            self.data.to_csv(filepath, index=False)
-        else:
+        if not self.should_read:
             raise Exception(
                 "Tried to write out DataFrameAggregator that has reading disabled."
             )
+
+        if self.stream_filepath is None:
+            self.data.to_csv(filepath, index=False)
+            return
+
+        partial_filepath = self.stream_filepath + ".partial"
+        if self._stream_columns is None:
+            pd.DataFrame().to_csv(partial_filepath, index=False)
+
+        os.replace(partial_filepath, filepath)
+
+        self._stream_columns = None
+
+    def _concat_chunks(self) -> pd.DataFrame:
+        if len(self._chunks) == 0:
+            return pd.DataFrame()
+
+        keys: Dict[str, None] = {}
+        for constants in self._chunk_constants:
+            keys.update(dict.fromkeys(constants))
+
+        if not all(len(constants) == len(keys) for constants in self._chunk_constants):
+            # Not every chunk has every constant, so fall back to adding the
+            # constants to each chunk separately
+            chunks = [
+                add_constant_columns(chunk, constants)
+                for chunk, constants in zip(self._chunks, self._chunk_constants)
+            ]
+
+            return pd.concat(chunks, ignore_index=True)
+
+        data = pd.concat(self._chunks, ignore_index=True)
+        lengths = [len(chunk) for chunk in self._chunks]
+
+        constant_columns = {}
+        for key in keys:
+            values = pd.Series([constants[key] for constants in self._chunk_constants])
+            codes, categories = pd.factorize(values)
+
+            constant_columns[key] = pd.Categorical.from_codes(
+                np.repeat(codes, lengths), categories=categories
+            )
+
+        columns = list(data.columns) + [key for key in keys if key not in data.columns]
+
+        return pd.DataFrame(
+            {
+                column: (
+                    constant_columns[column]
+                    if column in constant_columns
+                    else data[column].to_numpy()
+                )
+                for column in columns
+            },
+            copy=False,
+        )
+
+    def _write_chunk(self, filepath: str, chunk: pd.DataFrame) -> None:
+        if self._stream_columns is None:
+            self._stream_columns = list(chunk.columns)
+
+            chunk.to_csv(filepath, index=False)
+        else:
+            new_columns = set(chunk.columns) - set(self._stream_columns)
+            if len(new_columns) > 0:
+                raise Exception(
+                    "Tried to stream rows with columns {} that are not in the streamed file {}.".format(
+                        sorted(new_columns), filepath
+                    )
+                )
+
+            chunk.reindex(columns=self._stream_columns).to_csv(
+                filepath, mode="a", header=False, index=False
+            )
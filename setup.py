@@ -16,5 +16,6 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     packages=["megyr"],
-    install_requires=["pandas", "pystache"],
+    install_requires=["numpy", "pandas", "pystache"],
+    python_requires=">=3.9",
 )